@@ -0,0 +1,247 @@
+import argparse
+import gc
+import json
+import platform
+import tracemalloc
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import scipy
+
+from clusterisation import (make_sparce_category_matrix, make_sparse_cooccurrence_matrix, calculate_jaccard,
+                            filter_categories, leveled_jaccard_similarity)
+from retrieve import make_final_stage
+from storage import read_stage_file, write_stage_file, set_project_format
+from support_functions import generate_stages, data_path, regroup_categories, convert_lists
+
+# names of categories, which are removed by category filter (like real "Living people" or "1990 births")
+SPECIAL_NAMES = ['{year} births', '{year} deaths', 'People from Town {i}', 'Topic {i} stubs', 'Works by Author {i}',
+                 'Living people']
+
+
+def _run(name: str, f: Callable, *args, **kwargs):
+    return f(*args, **kwargs)
+
+
+def measure(f: Callable, *args, memory: bool = True, **kwargs) -> tuple[object, float, Optional[float]]:
+    """
+    Run function once and measure its time and peak memory. Memory is traced by tracemalloc (numpy arrays are traced
+    too) in the same run, so time includes overhead of tracing (noticeable only for pure python code), measure with
+    memory=False to get exact time
+    :param f: function
+    :param args: arguments of function
+    :param memory: measure peak memory
+    :param kwargs: keyword arguments of function
+    :return: result, time in seconds and peak memory in MB (None if memory is False)
+    """
+    gc.collect()
+    if memory:
+        tracemalloc.start()
+    try:
+        ts = perf_counter()
+        res = f(*args, **kwargs)
+        seconds = perf_counter() - ts
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20 if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return res, seconds, peak
+
+
+def _category_names(num: int, rng: np.random.Generator, special_share: float) -> list[str]:
+    names = [f'Cat {i}' for i in range(num)]
+    used = set()
+    for i in np.flatnonzero(rng.random(num) < special_share):
+        name = SPECIAL_NAMES[rng.integers(len(SPECIAL_NAMES))].format(year=1800 + i % 200, i=i)
+        if name not in used:
+            names[i] = name
+            used.add(name)
+    return names
+
+
+def _sample_lists(rng: np.random.Generator, rows: int, mean: float, weights: np.ndarray,
+                  exclude_self: bool = False) -> list[list[int]]:
+    """For each row sample ~mean distinct items (at least one) with probabilities weights"""
+    lengths = 1 + rng.poisson(max(mean - 1, 0), rows)
+    row_ids = np.repeat(np.arange(rows), lengths)
+    items = rng.choice(len(weights), size=len(row_ids), p=weights)
+    keep = items != row_ids if exclude_self else np.ones(len(items), dtype=bool)
+    pairs = np.unique(np.stack([row_ids[keep], items[keep]]), axis=1)
+    offsets = np.searchsorted(pairs[0], np.arange(rows + 1))
+    items = pairs[1].tolist()
+    return [items[start: stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def synthetic_lists(n: int, categories_per_article: float = 3., parents_per_category: float = 2.,
+                    exponent: float = 1.1, offset: float = 50., special_share: float = 0.05,
+                    seed: int = 0) -> tuple[list[str], list[list[int]], list[list[int]]]:
+    """
+    Generate reproducible Wikipedia-like categories in memory. Popularity of categories follows power law, so there are
+    few huge categories and many small ones. Parents are taken from the same pool of categories (also by popularity),
+    so categories are met on several levels and there are cycles
+    :param n: number of articles
+    :param categories_per_article: average number of categories of article
+    :param parents_per_category: average number of parents of category
+    :param exponent: exponent of power law of popularity of categories
+    :param offset: offset of rank in power law (Zipf-Mandelbrot), bigger offset - smaller share of the largest
+    categories
+    :param special_share: share of categories with names, which are removed by category filter
+    :param seed: random seed
+    :return: names of categories, ids of categories of each article, ids of parents of each category
+    """
+    rng = np.random.default_rng(seed)
+    num_categories = max(100, n // 3)
+    weights = 1 / (np.arange(num_categories) + offset) ** exponent
+    weights = weights / weights.sum()
+    names = _category_names(num_categories, rng, special_share)
+    article_categories = _sample_lists(rng, n, categories_per_article, weights)
+    parents = _sample_lists(rng, num_categories, parents_per_category, weights, exclude_self=True)
+    return names, article_categories, parents
+
+
+def synthetic_categories(n: int, **kwargs) -> pd.DataFrame:
+    """
+    Categories of synthetic articles (see synthetic_lists) like result of regroup_categories
+    :param n: number of articles
+    :param kwargs: other arguments of synthetic_lists
+    :return: DataFrame with columns 'category' and 'index' (list of ids of articles)
+    """
+    names, article_categories, _ = synthetic_lists(n, **kwargs)
+    df = pd.DataFrame({'index': np.arange(n), 'category': [[names[i] for i in x] for x in article_categories]})
+    return regroup_categories(df, 'category', 'index', lists=False)
+
+
+def synthetic_project(project: str, n: int, levels: int = 3, data_folder_name: str = 'data', fmt: str = 'csv',
+                      run: Callable = _run, **kwargs) -> None:
+    """
+    Generate reproducible Wikipedia-like project (see synthetic_lists) and write stage files in real layout (title,
+    title_with_category, category_with_infra1, ..., final), as get_articles_with_infracategories does
+    :param project: name of subfolder in data folder
+    :param n: number of articles
+    :param levels: number of infracategories levels
+    :param data_folder_name: name of data folder
+    :param fmt: format of stage files, 'csv' or 'npz'
+    :param run: function, which runs each stage as run(stage_name, f, *args) (to measure stages)
+    :param kwargs: other arguments of synthetic_lists (categories_per_article, exponent, offset, seed...)
+    """
+    names, article_categories, parents = synthetic_lists(n, **kwargs)
+    ids = {name: i for i, name in enumerate(names)}
+    set_project_format(project, fmt, data_folder_name)
+    stages = generate_stages(levels)
+
+    def write_titles():
+        df_ = pd.DataFrame({'title': [f'Article {i}' for i in range(n)]})
+        write_stage_file(df_, data_path(stages[0], project, data_folder_name))
+        return df_
+
+    def write_categories(df_):
+        df_ = df_.reset_index()[['title', 'index']]
+        df_['category'] = [[names[i] for i in x] for x in article_categories]
+        write_stage_file(df_, data_path(stages[1], project, data_folder_name))
+        return df_
+
+    def write_parents(df_, stage):
+        df_[stage[1]] = [[names[i] for i in parents[ids[name[len('Category:'):]]]] for name in df_[stage[0]]]
+        write_stage_file(df_, data_path(stage, project, data_folder_name))
+        return df_
+
+    df = run(stages[0][0], write_titles)
+    df = run('_with_'.join(stages[1]), write_categories, df)
+    for stage_num, stage in enumerate(stages[2:-1], 2):
+        prev_stage = stages[stage_num - 1]
+        df = run(f'regroup_categories:{prev_stage[1]}', regroup_categories, df, prev_stage[1], 'index',
+                 stage_num != 2)
+        df = run('_with_'.join(stage), write_parents, df, stage)
+    run(stages[-1][0], make_final_stage, stages, project, data_folder_name)
+
+
+def run_benchmarks(sizes: Sequence[int] = (1_000, 10_000, 100_000), levels: int = 3, fmt: str = 'csv',
+                   seed: int = 0, memory: bool = True, max_old_n: int = 2_000,
+                   data_folder_name: Optional[str] = None, output: Optional[str] = None) -> dict:
+    """
+    Benchmark of all stages of pipeline on synthetic projects: generation of stage files (with regroup_categories and
+    make_final_stage), filter_categories, make_sparce_category_matrix, make_sparse_cooccurrence_matrix,
+    calculate_jaccard and leveled_jaccard_similarity
+    :param sizes: numbers of articles in projects (1k - 1M)
+    :param levels: number of infracategories levels
+    :param fmt: format of stage files, 'csv' or 'npz'
+    :param seed: random seed of projects
+    :param memory: measure peak memory of each stage (time then includes overhead of tracing)
+    :param max_old_n: make_sparce_category_matrix (python dict of all pairs, gigabytes for 10k articles) is measured
+    only for projects up to this size
+    :param data_folder_name: folder for projects, temporary folder by default
+    :param output: path of json report
+    :return: report: dict with environment description and list of results (n, stage, seconds, peak_mb)
+    """
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                              'scipy': scipy.__version__, 'machine': platform.machine(),
+                              'processor': platform.processor()},
+              'parameters': {'sizes': list(sizes), 'levels': levels, 'fmt': fmt, 'seed': seed, 'memory': memory},
+              'results': []}
+    with TemporaryDirectory() as tmp_folder:
+        folder = data_folder_name or tmp_folder
+        for n in sizes:
+            def run(stage: str, f: Callable, *args, **kwargs):
+                res, seconds, peak = measure(f, *args, memory=memory, **kwargs)
+                report['results'].append({'n': n, 'stage': stage, 'seconds': seconds, 'peak_mb': peak})
+                print(f'n={n} {stage}: {seconds:.3f} sec' + (f', {peak:.1f} MB' if peak is not None else ''))
+                return res
+
+            project = f'synthetic_{n}'
+            synthetic_project(project, n, levels, folder, fmt=fmt, seed=seed, run=run)
+            df = read_stage_file(data_path(('title', 'category'), project, folder))
+            df = regroup_categories(convert_lists(df, 'category'), 'category', 'index', lists=False)
+            run('filter_categories', filter_categories, df, 'category')
+            if n <= max_old_n:
+                run('make_sparce_category_matrix', make_sparce_category_matrix, df.copy(), n)
+            matrix = run('make_sparse_cooccurrence_matrix', make_sparse_cooccurrence_matrix, df, n)
+            counts = np.bincount(np.concatenate(df['index'].tolist()), minlength=n).astype(np.float32)
+            run('calculate_jaccard', calculate_jaccard, matrix, counts)
+            run('leveled_jaccard_similarity', leveled_jaccard_similarity, project, levels + 1,
+                data_folder_name=folder)
+            # report is written after each project, so results of small ones are kept if big one runs out of memory
+            if output is not None:
+                with open(output, 'w') as f:
+                    json.dump(report, f, indent=1)
+    return report
+
+
+def compare_reports(old: str, new: str, tolerance: float = 0.2) -> pd.DataFrame:
+    """
+    Compare two reports of run_benchmarks
+    :param old: path to json report of base run
+    :param new: path to json report of new run
+    :param tolerance: relative growth of time or memory, which is considered as regression
+    :return: DataFrame with time and memory of each stage in both runs, their ratios (new / old) and regression flag
+    """
+    frames = []
+    for path in (old, new):
+        with open(path) as f:
+            frames.append(pd.DataFrame(json.load(f)['results']).groupby(['n', 'stage'], sort=False).last())
+    res = frames[0].join(frames[1], lsuffix='_old', rsuffix='_new', how='outer')
+    res['time_ratio'] = res['seconds_new'] / res['seconds_old']
+    res['memory_ratio'] = res['peak_mb_new'] / res['peak_mb_old']
+    res['regression'] = (res['time_ratio'] > 1 + tolerance) | (res['memory_ratio'] > 1 + tolerance)
+    return res.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of pipeline on synthetic projects')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help='numbers of articles (1k - 1M)')
+    parser.add_argument('--levels', type=int, default=3, help='number of infracategories levels')
+    parser.add_argument('--fmt', default='csv', choices=['csv', 'npz'], help='format of stage files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument('--output', default='benchmark_report.json', help='path of json report')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two reports instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        print(compare_reports(*args.compare).to_string())
+    else:
+        run_benchmarks(args.sizes, args.levels, args.fmt, args.seed, not args.no_memory, output=args.output)
@@ -0,0 +1,118 @@
+from time import perf_counter
+
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from benchmark_suite import synthetic_lists, synthetic_categories
+from category_graph import CategoryGraph
+from clusterisation import make_sparce_category_matrix, make_sparse_cooccurrence_matrix, binary_csr
+from vocabulary import CategoryVocabulary, flatten_lists
+from parallel_cooccurrence import parallel_cooccurrence_matrix
+
+
+def benchmark_cooccurrence(sizes: tuple[int, ...] = (10_000, 100_000), offset: float = 1000.,
+                           seed: int = 0) -> pd.DataFrame:
+    """
+    Compare make_sparce_category_matrix (loop over pairs) with make_sparse_cooccurrence_matrix (sparse product)
+    :param sizes: numbers of articles in synthetic data (see benchmark_suite.synthetic_categories)
+    :param offset: offset of power law of popularity of categories, bigger offset - smaller largest categories. Note
+    that make_sparce_category_matrix needs ~100 bytes per pair of articles, so with big categories it could run out
+    of memory
+    :param seed: random seed
+    :return: DataFrame with time of both functions, speedup and number of differing cells for each size
+    """
+    res = []
+    for n in sizes:
+        df = synthetic_categories(n, offset=offset, seed=seed)
+        ts = perf_counter()
+        old = make_sparce_category_matrix(df.copy(), n).tocsr()
+        old_time = perf_counter() - ts
+        ts = perf_counter()
+        new = make_sparse_cooccurrence_matrix(df, n)
+        new_time = perf_counter() - ts
+        res.append({'n': n, 'categories': len(df), 'old_sec': old_time, 'new_sec': new_time,
+                    'speedup': old_time / new_time, 'nnz': new.nnz, 'differing_cells': (old != new).nnz})
+    return pd.DataFrame(res)
+
+
+def benchmark_parallel_cooccurrence(n: int = 200_000, workers: tuple[int, ...] = (1, 2, 4, 8), offset: float = 50.,
+                                    max_nnz: int = 10_000_000, seed: int = 0) -> pd.DataFrame:
+    """
+    Scaling of parallel_cooccurrence_matrix with number of processes, compared with single-process
+    make_sparse_cooccurrence_matrix
+    :param n: number of articles in synthetic data (see benchmark_suite.synthetic_categories)
+    :param workers: numbers of processes
+    :param offset: offset of power law of popularity of categories, bigger offset - smaller largest categories
+    :param max_nnz: memory limit of each worker (see parallel_cooccurrence_from_incidence)
+    :param seed: random seed
+    :return: DataFrame with time, speedup against single process and number of differing cells for each number of
+    workers
+    """
+    df = synthetic_categories(n, offset=offset, seed=seed)
+    ts = perf_counter()
+    base = make_sparse_cooccurrence_matrix(df, n, max_nnz=max_nnz)
+    base_time = perf_counter() - ts
+    res = []
+    for workers_num in workers:
+        ts = perf_counter()
+        matrix = parallel_cooccurrence_matrix(df, n, workers=workers_num, max_nnz=max_nnz)
+        seconds = perf_counter() - ts
+        res.append({'workers': workers_num, 'sec': seconds, 'speedup': base_time / seconds, 'nnz': matrix.nnz,
+                    'differing_cells': (base != matrix).nnz})
+    return pd.DataFrame(res)
+
+
+def synthetic_graph(n: int, **kwargs) -> CategoryGraph:
+    """
+    CategoryGraph of synthetic articles with parents of categories, so it has any number of levels
+    :param n: number of articles
+    :param kwargs: arguments of benchmark_suite.synthetic_lists (categories_per_article, exponent, offset, seed...)
+    """
+    names, article_categories, parents = synthetic_lists(n, **kwargs)
+    vocabulary = CategoryVocabulary(names)
+    return CategoryGraph(binary_csr(*flatten_lists(article_categories), (n, len(names))),
+                         binary_csr(*flatten_lists(parents), (len(names), len(names))), vocabulary,
+                         [f'Article {i}' for i in range(n)])
+
+
+def benchmark_minhash(graph: CategoryGraph, mults: Optional[Sequence[float]] = None, depth: Optional[int] = None,
+                      settings: tuple[tuple[int, int], ...] = ((64, 16), (128, 32), (256, 64)),
+                      threshold: float = 0.5) -> pd.DataFrame:
+    """
+    Accuracy and speed of CategoryGraph.approximate_similarity (MinHash + LSH) against exact CategoryGraph.similarity
+    on same project
+    :param graph: index of project (project_graph) or synthetic_graph
+    :param mults: weight of each level, if None - all weights =1
+    :param depth: number of levels, len(mults) by default
+    :param settings: pairs (length of signature, number of bands)
+    :param threshold: similarity, for which recall and precision of pairs are calculated
+    :return: DataFrame with time, speedup, mean and max absolute error of found pairs, recall and precision of pairs
+    with similarity >= threshold for each setting
+    """
+    graph.levels(depth or (len(mults) if mults is not None else 1))  # levels are cached and not counted in timing
+    ts = perf_counter()
+    exact = graph.similarity(mults, depth)
+    exact_time = perf_counter() - ts
+    exact_pairs = exact >= threshold
+    res = []
+    for num_perm, bands in settings:
+        ts = perf_counter()
+        approximate = graph.approximate_similarity(mults, depth, num_perm=num_perm, bands=bands)
+        seconds = perf_counter() - ts
+        errors = np.abs(np.asarray(exact[approximate.nonzero()]).ravel() - approximate.data)
+        found = approximate >= threshold
+        true_found = found.multiply(exact_pairs).nnz
+        res.append({'num_perm': num_perm, 'bands': bands, 'exact_sec': exact_time, 'sec': seconds,
+                    'speedup': exact_time / seconds, 'pairs': approximate.nnz, 'exact_pairs': exact.nnz,
+                    'mean_error': errors.mean() if len(errors) else 0.,
+                    'max_error': errors.max() if len(errors) else 0.,
+                    'recall': true_found / max(exact_pairs.nnz, 1), 'precision': true_found / max(found.nnz, 1)})
+    return pd.DataFrame(res)
+
+
+if __name__ == '__main__':
+    print(benchmark_cooccurrence().to_string())
+    print(benchmark_parallel_cooccurrence().to_string())
+    print(benchmark_minhash(synthetic_graph(100_000)).to_string())
@@ -0,0 +1,125 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Callable
+from os.path import dirname
+from time import time
+from typing import Optional
+
+DAY = 24 * 60 * 60
+
+
+class CategoryCache:
+    """
+    Persistent cache of article (or category) categories, keyed by (lang, title). It is stored in SQLite file, so one
+    cache could be shared by all projects and stages. Entries older than ttl are treated as missing, and if there
+    are more than max_entries entries, least recently used are removed
+    """
+    def __init__(self, path: str = 'data/category_cache.sqlite', ttl: Optional[float] = 30 * DAY,
+                 max_entries: Optional[int] = None, chunk: int = 500):
+        """
+        :param path: path to SQLite file, it will be created if not exists
+        :param ttl: time to live of each entry in seconds, None for infinite
+        :param max_entries: maximum number of entries in cache, None for unlimited
+        :param chunk: number of titles per one SQL query (SQLite limits number of query parameters)
+        """
+        if dirname(path):
+            os.makedirs(dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.chunk = chunk
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS categories ('
+            'lang TEXT, title TEXT, categories TEXT, fetched REAL, accessed REAL, PRIMARY KEY (lang, title))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS accessed_index ON categories (accessed)')
+        self._connection.commit()
+        # running number of entries, so eviction doesn't count the whole table on each write
+        self._size = self._count() if max_entries is not None else None
+
+    def _count(self) -> int:
+        return self._connection.execute('SELECT count(*) FROM categories').fetchone()[0]
+
+    def get_many(self, titles: list[str], lang: str = 'en') -> dict[str, list[str]]:
+        """
+        Get cached categories of titles
+        :param titles: list of titles
+        :param lang: wikipedia language code
+        :return: dict title: list of categories, only for titles which are in cache and not expired
+        """
+        now = time()
+        min_fetched = now - self.ttl if self.ttl is not None else 0
+        res = {}
+        with self._lock:
+            for pos in range(0, len(titles), self.chunk):
+                chunk = titles[pos: pos + self.chunk]
+                rows = self._connection.execute(
+                    f'SELECT title, categories FROM categories WHERE lang = ? AND fetched >= ? '
+                    f'AND title IN ({",".join("?" * len(chunk))})', [lang, min_fetched, *chunk]).fetchall()
+                res.update((title, json.loads(categories)) for title, categories in rows)
+            self._connection.executemany('UPDATE categories SET accessed = ? WHERE lang = ? AND title = ?',
+                                         [(now, lang, title) for title in res])
+            self._connection.commit()
+            self.hits += len(res)
+            self.misses += len(set(titles)) - len(res)
+        return res
+
+    def set_many(self, categories: dict[str, list[str]], lang: str = 'en') -> None:
+        """
+        Save categories to cache and evict least recently used entries, if cache is too big
+        :param categories: dict title: list of categories
+        :param lang: wikipedia language code
+        """
+        now = time()
+        titles = list(categories)
+        with self._lock:
+            if self.max_entries is not None:
+                for pos in range(0, len(titles), self.chunk):
+                    chunk = titles[pos: pos + self.chunk]
+                    known = self._connection.execute(
+                        f'SELECT count(*) FROM categories WHERE lang = ? AND title IN ({",".join("?" * len(chunk))})',
+                        [lang, *chunk]).fetchone()[0]
+                    self._size += len(chunk) - known
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO categories VALUES (?, ?, ?, ?, ?)',
+                [(lang, title, json.dumps(cats), now, now) for title, cats in categories.items()])
+            if self.max_entries is not None and self._size > self.max_entries:
+                self._connection.execute(
+                    'DELETE FROM categories WHERE rowid IN (SELECT rowid FROM categories ORDER BY accessed LIMIT ?)',
+                    [self._size - self.max_entries])
+                self._size = self.max_entries
+            self._connection.commit()
+
+    def fetch(self, titles: list[str], lang: str, f: Callable, **kwargs) -> dict[str, list[str]]:
+        """
+        Get categories of titles from cache, and retrieve only missing ones with function f
+        :param titles: list of titles
+        :param lang: wikipedia language code
+        :param f: function like get_category_mass, which is called for titles, missing in cache
+        :param kwargs: arguments, which will be passed to the f function
+        :return: dict title: list of categories for all titles
+        """
+        res = self.get_many(titles, lang)
+        missing = [title for title in dict.fromkeys(titles) if title not in res]
+        if missing:
+            retrieved = f(missing, lang=lang, **kwargs)
+            retrieved = {title: retrieved.get(title, []) for title in missing}
+            self.set_many(retrieved, lang)
+            res.update(retrieved)
+        return res
+
+    def stats(self) -> dict[str, float]:
+        """Hits, misses and hit rate since cache was opened, and total number of entries"""
+        with self._lock:
+            size = self._count()
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else 0., 'entries': size}
+
+    def close(self) -> None:
+        self._connection.close()
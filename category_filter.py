@@ -0,0 +1,136 @@
+import json
+import re
+from os.path import exists
+from typing import Optional
+
+import pandas as pd
+
+# Regexps of categories, which are too wide and doesn't in fact mark some real similarity. Add list for other
+# languages here (or pass patterns to CategoryFilter)
+EXCLUDE_PATTERNS = {
+    'en': ['[Dd]isambiguation',
+           ' stubs$',
+           "(?:^|:)Living people",
+           '[0-9]+s? (?:births$|deaths)',
+           '(?:^|:)Deaths (?:by|due|from)',
+           '(?:Alcohol-related|Accidental|Road incident|Tuberculosis|Sports?) deaths',
+           '(?:century|animal|racehorse|BC) (?:births|deaths)',
+           '(?:^|:)Alumni',
+           'alumni$',
+           'People educated at',
+           '(?:^|:)People from',
+           "people of .+ descent",
+           '(?:^|:)[0-9]+(?:th|st)-century.+(?:women|people)$',
+           '(?:^|:)Burials at',
+           '(?:^|:)[0-9]+ (?:dis)?establishments in',
+           'century (?:dis)?establishments',
+           '(?:^|:)Years',
+           'by time',
+           'Main topic classifications',
+           '(?:^|:)Humans$',
+           'by decade',
+           'Individual apes',
+           ' beginnings$',
+           'by country',
+           'by type and year$',
+           'by nationality',
+           'by year',
+           'Categories by',
+           'by continent',
+           'Works by',
+           '(?:^|:)[0-9][0-9][0-9][0-9]s?$',
+           'by century',
+           'by occupation',
+           'Populated places by',
+           '(?:p|P)eople by university',
+           'by religion'
+           ],
+    'de': ['Begriffsklärung',
+           '(?:^|:)Mann$',
+           '(?:^|:)Frau$',
+           '(?:^|:)Geboren (?:im )?[0-9]+',
+           '(?:^|:)Gestorben (?:im )?[0-9]+',
+           '(?:^|:)Person nach',
+           '(?:^|:)Gegründet (?:im )?[0-9]+',
+           '(?:^|:)Aufgelöst (?:im )?[0-9]+',
+           '(?:^|:)[0-9]+(?:er)?$',
+           '(?:^|:)[0-9]+\\. Jahrhundert$',
+           ' nach (?:Staat|Jahr|Jahrzehnt|Jahrhundert|Typ|Thema|Ort|Kontinent|Nationalität)$',
+           'Sachsystematik',
+           ],
+    'fr': ['Homonymie',
+           '(?:^|:)Naissance (?:en|à|au|aux|dans)',
+           '(?:^|:)Décès (?:en|à|au|aux|dans)',
+           '(?:^|:)Personnalité ',
+           'fondée? en [0-9]+',
+           'disparue? en [0-9]+',
+           '(?:^|:)[0-9]+$',
+           '(?:^|:)Années [0-9]+$',
+           '(?:^|:)[XVI]+e siècle$',
+           ' par (?:pays|année|décennie|siècle|type|thème|nationalité|continent|ville)$',
+           '(?:^|:)Ébauche',
+           ],
+}
+FILTER_FILE = 'category_filter.json'
+
+
+class CategoryFilter:
+    """
+    Filter of categories by list of regexps. All regexps are compiled in one alternation, each unique category is
+    checked only once and verdicts are memoized, so filter could be reused for all levels (and saved with project)
+    """
+    def __init__(self, patterns: Optional[list[str]] = None, lang: str = 'en'):
+        """
+        :param patterns: regexps of categories to exclude. If None, EXCLUDE_PATTERNS for lang are used
+        :param lang: wikipedia language code, saved with filter
+        """
+        self.lang = lang
+        if patterns is None:
+            if lang not in EXCLUDE_PATTERNS:
+                raise ValueError(f'No exclude patterns for language {lang}, set patterns explicitly')
+            patterns = EXCLUDE_PATTERNS[lang]
+        self.patterns = list(dict.fromkeys(patterns))
+        self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern in self.patterns))
+        self.verdicts = {}
+
+    def is_excluded(self, category: str) -> bool:
+        """Check if category matches any of patterns"""
+        verdict = self.verdicts.get(category)
+        if verdict is None:
+            verdict = self.verdicts[category] = self.regex.search(category) is not None
+        return verdict
+
+    def filter(self, df: pd.DataFrame, cat_col: str = 'category') -> pd.DataFrame:
+        """Remove rows of DataFrame, where category in cat_col matches any of patterns"""
+        categories = df[cat_col].astype(str)
+        for category in pd.unique(categories):
+            self.is_excluded(category)
+        return df[~categories.map(self.verdicts).values.astype(bool)]
+
+    def save(self, path: str) -> None:
+        """Save language, patterns and memoized verdicts to json file"""
+        with open(path, 'w') as f:
+            json.dump({'lang': self.lang, 'patterns': self.patterns,
+                       'excluded': [cat for cat, verdict in self.verdicts.items() if verdict],
+                       'kept': [cat for cat, verdict in self.verdicts.items() if not verdict]}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'CategoryFilter':
+        """Load filter saved by save method"""
+        with open(path) as f:
+            data = json.load(f)
+        category_filter = cls(data['patterns'], data.get('lang', 'en'))  # filters were saved without lang for en only
+        category_filter.verdicts.update(dict.fromkeys(data['excluded'], True))
+        category_filter.verdicts.update(dict.fromkeys(data['kept'], False))
+        return category_filter
+
+
+def project_filter(project: str, lang: str = 'en', data_folder_name: str = 'data') -> CategoryFilter:
+    """Load filter saved with project, or create new one for language lang"""
+    path = f'{data_folder_name}/{project}/{FILTER_FILE}'
+    if exists(path):
+        category_filter = CategoryFilter.load(path)
+        if category_filter.lang != lang:
+            raise ValueError(f'Filter of project {project} was saved for language {category_filter.lang}, not {lang}')
+        return category_filter
+    return CategoryFilter(lang=lang)
@@ -0,0 +1,256 @@
+import json
+import os
+from os.path import exists
+from typing import Optional, Sequence
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from category_filter import CategoryFilter, project_filter
+from clusterisation import binary_csr, kept_categories, cooccurrence_from_incidence, calculate_jaccard, integer_mults
+from knn import knn_graph
+from minhash import minhash_similarity
+from storage import read_stage_file
+from support_functions import generate_stages, data_path, convert_lists
+from vocabulary import CategoryVocabulary, project_vocabulary, VOCABULARY_FILE
+
+GRAPH_FOLDER = 'graph'
+
+
+def resize_sparse(matrix: csr_matrix, shape: tuple[int, int]) -> csr_matrix:
+    """Extend sparse matrix with empty rows and columns (vocabulary could grow after matrix was built)"""
+    if matrix.shape == shape:
+        return matrix
+    matrix = matrix.tocoo()
+    return csr_matrix((matrix.data, (matrix.row, matrix.col)), shape=shape)
+
+
+class CategoryGraph:
+    """
+    Index of project: sparse matrix of articles and their categories, and sparse adjacency matrix category -> parent
+    category (all infra levels together). Levels of categories of articles (with filtering of wide categories on each
+    level) are calculated from it and cached, so similarity with any weights could be calculated without reading
+    stage files
+    """
+    def __init__(self, articles: csr_matrix, parents: csr_matrix, vocabulary: CategoryVocabulary, titles: list[str]):
+        """
+        :param articles: binary matrix articles X category ids
+        :param parents: binary matrix category ids X category ids, (i, j) is 1 if j is parent of i
+        :param vocabulary: vocabulary of category ids
+        :param titles: titles of articles (article id is position in list)
+        """
+        self.vocabulary = vocabulary
+        self.titles = titles
+        self.articles = resize_sparse(articles, (len(titles), len(vocabulary)))
+        self.parents = resize_sparse(parents, (len(vocabulary), len(vocabulary)))
+        self._levels = {}
+
+    @classmethod
+    def from_project(cls, project: str, stages_num: int, data_folder_name: str = 'data') -> 'CategoryGraph':
+        """
+        Build index from stage files of project
+        :param project: name of subfolder in data folder
+        :param stages_num: number of levels (1 for categories only, 2 for categories and infra1 etc.)
+        :param data_folder_name: name of data folder
+        :return: CategoryGraph
+        """
+        stages = generate_stages(stages_num - 1)[1:-1]
+        vocabulary = project_vocabulary(project, data_folder_name)
+        df0 = read_stage_file(data_path(stages[0], project, data_folder_name))
+        df0 = convert_lists(df0, stages[0][1]).sort_values('index')
+        offsets, values = vocabulary.encode_lists(df0[stages[0][1]].tolist())
+        articles = binary_csr(offsets, values, (len(df0), len(vocabulary)), rows=df0['index'].values.astype(np.int64))
+        rows, cols = [], []
+        for stage in stages[1:]:
+            df_ = read_stage_file(data_path(stage, project, data_folder_name))
+            df_ = convert_lists(df_, stage[1])
+            offsets, values = vocabulary.encode_lists(df_[stage[1]].tolist())
+            rows.append(np.repeat(vocabulary.encode(df_[stage[0]].astype(str)), np.diff(offsets)))
+            cols.append(values)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int32)
+        parents = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                             shape=(len(vocabulary), len(vocabulary)))
+        parents.data[:] = 1
+        return cls(articles, parents, vocabulary, df0['title'].tolist())
+
+    def cycles(self) -> list[np.ndarray]:
+        """Find cycles in category graph: return ids of categories of each strongly connected component with cycle"""
+        _, labels = connected_components(self.parents, directed=True, connection='strong')
+        sizes = np.bincount(labels)
+        self_loops = np.flatnonzero(self.parents.diagonal())
+        in_cycle = np.flatnonzero(sizes[labels] > 1)
+        res = [np.flatnonzero(labels == label) for label in np.unique(labels[in_cycle])]
+        return res + [np.array([i]) for i in self_loops if sizes[labels[i]] == 1]
+
+    def levels(self, depth: int,
+               category_filter: Optional[CategoryFilter] = None) -> list[tuple[csr_matrix, np.ndarray]]:
+        """
+        Categories of articles on each level: level 0 is categories, level 1 is their parents and so on. As in
+        clusterisation.leveled_jaccard_similarity, only parents of categories, which passed filter, are taken to next
+        level, but articles of category are all articles, which reach it by any path (like in stage files).
+        Cycles in graph are not a problem, because depth is bounded
+        :param depth: number of levels
+        :param category_filter: filter of too wide categories, English filter by default
+        :return: list of tuples (binary matrix articles X category ids, ids of categories, which passed filter)
+        """
+        if category_filter is None:
+            category_filter = CategoryFilter()
+        key = tuple(category_filter.patterns)
+        levels = self._levels.setdefault(key, [])
+        while len(levels) < depth:
+            if not levels:
+                level = unfiltered = self.articles
+            else:
+                _, prev_kept, prev_unfiltered = levels[-1]
+                level = prev_unfiltered[:, prev_kept] @ self.parents[prev_kept]
+                level.data[:] = 1
+                unfiltered = prev_unfiltered @ self.parents
+                unfiltered.data[:] = 1
+            levels.append((level, kept_categories(level, self.vocabulary, category_filter), unfiltered))
+        return [(level, kept) for level, kept, _ in levels[:depth]]
+
+    def ancestors(self, depth: Optional[int] = None, category_filter: Optional[CategoryFilter] = None) -> csr_matrix:
+        """
+        Depth-bounded ancestor sets of articles: binary matrix articles X category ids, with all categories on levels
+        up to depth. If depth is None, walk up until no new ancestors are found (closure)
+        """
+        if depth is not None:
+            res = scipy.sparse.csr_matrix(self.articles.shape, dtype=np.int32)
+            for level, _ in self.levels(depth, category_filter):
+                res = res + level
+            res.data[:] = 1
+            return res
+        res = frontier = self.articles
+        while frontier.nnz:
+            frontier = frontier @ self.parents
+            frontier.data[:] = 1
+            frontier = frontier - frontier.multiply(res)
+            frontier.eliminate_zeros()
+            res = res + frontier
+        return res
+
+    def similarity(self, mults: Optional[Sequence[float]] = None, depth: Optional[int] = None,
+                   category_filter: Optional[CategoryFilter] = None, min_similarity: Optional[float] = None,
+                   workers: Optional[int] = None) -> csr_matrix:
+        """
+        Weighted Jaccard similarity of articles, same as in clusterisation.leveled_jaccard_similarity (but without
+        removing of disambiguation pages)
+        :param mults: weight of each level, if None - all weights =1
+        :param depth: number of levels, len(mults) by default
+        :param category_filter: filter of too wide categories, English filter by default
+        :param min_similarity: if set, similarities less than it are removed from result
+        :param workers: if set, co-occurrences of each level are calculated in pool of this number of processes
+        :return: sparse matrix with Jaccard similarities of articles
+        """
+        if depth is None:
+            depth = len(mults) if mults is not None else 1
+        mults = integer_mults(mults, depth)
+        matrix = csr_matrix(self.articles.shape[:1] * 2, dtype=np.float32)
+        cat_count_weighted = np.zeros(self.articles.shape[0])
+        for (level, kept), mult in zip(self.levels(depth, category_filter), mults):
+            cat_count_weighted += np.diff(level.indptr) * mult
+            matrix += cooccurrence_from_incidence(level[:, kept], workers=workers) * mult
+        return calculate_jaccard(matrix, cat_count_weighted.astype(np.float32), min_similarity=min_similarity)
+
+    def knn(self, k: int, mults: Optional[Sequence[float]] = None, depth: Optional[int] = None,
+            category_filter: Optional[CategoryFilter] = None,
+            max_nnz: Optional[int] = 10_000_000) -> tuple[np.ndarray, np.ndarray]:
+        """
+        k most similar articles for each article, with same similarity as in similarity method, but full similarity
+        matrix is never built (see knn.knn_graph)
+        :param k: number of neighbours
+        :param mults: weight of each level, if None - all weights =1
+        :param depth: number of levels, len(mults) by default
+        :param category_filter: filter of too wide categories, English filter by default
+        :param max_nnz: maximum number of non-zero values in one block of rows
+        :return: int32 array n X k with ids of neighbours (-1 if missing) and float32 array n X k with similarities
+        """
+        if depth is None:
+            depth = len(mults) if mults is not None else 1
+        levels = self.levels(depth, category_filter)
+        cat_count_weighted = np.zeros(self.articles.shape[0])
+        for (level, _), mult in zip(levels, integer_mults(mults, depth)):
+            cat_count_weighted += np.diff(level.indptr) * mult
+        return knn_graph([level[:, kept] for level, kept in levels], cat_count_weighted, k, mults, max_nnz)
+
+    def approximate_similarity(self, mults: Optional[Sequence[float]] = None, depth: Optional[int] = None,
+                               category_filter: Optional[CategoryFilter] = None, num_perm: int = 128,
+                               bands: int = 32, min_similarity: Optional[float] = None, seed: int = 0) -> csr_matrix:
+        """
+        Approximate version of similarity method by weighted MinHash and LSH (see minhash.minhash_similarity): its
+        time doesn't depend on number of pairs of articles with common categories
+        :param mults: weight of each level, if None - all weights =1
+        :param depth: number of levels, len(mults) by default
+        :param category_filter: filter of too wide categories, English filter by default
+        :param num_perm: length of MinHash signature
+        :param bands: number of LSH bands
+        :param min_similarity: if set, similarities less than it are removed from result
+        :param seed: random seed of hash functions
+        :return: sparse matrix with estimated Jaccard similarities of articles
+        """
+        if depth is None:
+            depth = len(mults) if mults is not None else 1
+        return minhash_similarity(self.levels(depth, category_filter), mults, num_perm, bands, min_similarity, seed)
+
+    def save(self, folder: str) -> None:
+        """Save index (with all calculated levels) to folder"""
+        os.makedirs(folder, exist_ok=True)
+        scipy.sparse.save_npz(f'{folder}/articles.npz', self.articles)
+        scipy.sparse.save_npz(f'{folder}/parents.npz', self.parents)
+        self.vocabulary.save(f'{folder}/{VOCABULARY_FILE}')
+        with open(f'{folder}/titles.txt', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.titles))
+        meta = []
+        for num, (patterns, levels) in enumerate(self._levels.items()):
+            meta.append({'patterns': list(patterns), 'depth': len(levels)})
+            for depth, (level, kept, unfiltered) in enumerate(levels):
+                scipy.sparse.save_npz(f'{folder}/level_{num}_{depth}.npz', level)
+                np.save(f'{folder}/kept_{num}_{depth}.npy', kept)
+                scipy.sparse.save_npz(f'{folder}/unfiltered_{num}_{depth}.npz', unfiltered)
+        with open(f'{folder}/levels.json', 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, folder: str) -> 'CategoryGraph':
+        """Load index saved by save method"""
+        with open(f'{folder}/titles.txt', encoding='utf-8') as f:
+            titles = f.read().split('\n')
+        graph = cls(scipy.sparse.load_npz(f'{folder}/articles.npz').tocsr(),
+                    scipy.sparse.load_npz(f'{folder}/parents.npz').tocsr(),
+                    CategoryVocabulary.load(f'{folder}/{VOCABULARY_FILE}'), titles)
+        with open(f'{folder}/levels.json') as f:
+            meta = json.load(f)
+        for num, levels in enumerate(meta):
+            graph._levels[tuple(levels['patterns'])] = [
+                (scipy.sparse.load_npz(f'{folder}/level_{num}_{depth}.npz').tocsr(),
+                 np.load(f'{folder}/kept_{num}_{depth}.npy'),
+                 scipy.sparse.load_npz(f'{folder}/unfiltered_{num}_{depth}.npz').tocsr())
+                for depth in range(levels['depth'])]
+        return graph
+
+
+def project_graph(project: str, stages_num: int, data_folder_name: str = 'data', lang: str = 'en',
+                  rebuild: bool = False) -> CategoryGraph:
+    """
+    Load index of project from <data_folder_name>/<project>/graph, or build it from stage files (with all levels for
+    project filter) and save
+    :param project: name of subfolder in data folder
+    :param stages_num: number of levels (1 for categories only, 2 for categories and infra1 etc.)
+    :param data_folder_name: name of data folder
+    :param lang: wikipedia language code, used to choose patterns of filtered categories
+    :param rebuild: build index from stage files even if it was saved
+    :return: CategoryGraph
+    """
+    folder = f'{data_folder_name}/{project}/{GRAPH_FOLDER}'
+    if exists(folder) and not rebuild:
+        return CategoryGraph.load(folder)
+    graph = CategoryGraph.from_project(project, stages_num, data_folder_name)
+    cycles = graph.cycles()
+    if cycles:
+        print(f'{len(cycles)} cycles found in category graph ({sum(map(len, cycles))} categories)')
+    graph.levels(stages_num, project_filter(project, lang, data_folder_name))
+    graph.save(folder)
+    return graph
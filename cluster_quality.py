@@ -0,0 +1,115 @@
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+from scipy.sparse import csr_matrix, spmatrix
+from scipy.stats import norm
+
+
+def _encode_labels(labels: Sequence) -> tuple[np.ndarray, int]:
+    """Convert any cluster labels to codes 0..k-1, return codes and k"""
+    _, codes = np.unique(np.asarray(labels), return_inverse=True)
+    return codes, codes.max() + 1 if len(codes) else 0
+
+
+def silhouette_samples_sparse(similarity: spmatrix, labels: Sequence, rows: Optional[np.ndarray] = None,
+                              max_cells: int = 10_000_000) -> np.ndarray:
+    """
+    Silhouette coefficient of each sample, where distance is 1 - similarity and missing values of sparse
+    similarity matrix mean distance 1. Same as sklearn.metrics.silhouette_samples on dense 1 - similarity matrix (with
+    zero diagonal), but no n X n arrays are created: rows are processed by chunks of rows X clusters cells
+    :param similarity: sparse symmetric similarity matrix (like Jaccard similarity from leveled_jaccard_similarity)
+    :param labels: cluster label of each sample
+    :param rows: if set, calculate coefficients only for these samples
+    :param max_cells: maximum size of dense array rows X clusters, created at once
+    :return: array of silhouette coefficients (for all samples or for rows)
+    """
+    similarity = csr_matrix(similarity)
+    codes, k = _encode_labels(labels)
+    n = len(codes)
+    sizes = np.bincount(codes, minlength=k).astype(np.float64)
+    one_hot = csr_matrix((np.ones(n), (np.arange(n), codes)), shape=(n, k))
+    diagonal = similarity.diagonal()
+    rows = np.arange(n) if rows is None else np.asarray(rows)
+    chunk = max(1, max_cells // max(k, 1))
+    res = np.zeros(len(rows))
+    for start in range(0, len(rows), chunk):
+        chunk_rows = rows[start: start + chunk]
+        chunk_codes = codes[chunk_rows]
+        positions = np.arange(len(chunk_rows))
+        sums = (similarity[chunk_rows] @ one_hot).toarray()
+        sums[positions, chunk_codes] -= diagonal[chunk_rows]
+        counts = np.tile(sizes, (len(chunk_rows), 1))
+        counts[positions, chunk_codes] -= 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_dist = (counts - sums) / counts
+        intra = mean_dist[positions, chunk_codes]
+        mean_dist[positions, chunk_codes] = np.inf
+        mean_dist[counts == 0] = np.inf
+        inter = mean_dist.min(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = (inter - intra) / np.maximum(intra, inter)
+        values[(counts[positions, chunk_codes] == 0) | ~np.isfinite(values)] = 0
+        res[start: start + len(chunk_rows)] = values
+    return res
+
+
+def silhouette_score_sparse(similarity: spmatrix, labels: Sequence, sample_size: Optional[int] = None,
+                            confidence: float = 0.95, random_state: Optional[int] = None,
+                            max_cells: int = 10_000_000) -> tuple[float, tuple[float, float]]:
+    """
+    Mean silhouette coefficient for sparse similarity matrix (see silhouette_samples_sparse). In exact mode all samples
+    are used, in sampled mode coefficients are calculated only for random sample of points (but against all points),
+    and confidence interval of mean is estimated
+    :param similarity: sparse symmetric similarity matrix
+    :param labels: cluster label of each sample
+    :param sample_size: None for exact score, or number of samples
+    :param confidence: confidence level of interval
+    :param random_state: random seed of sample
+    :param max_cells: maximum size of dense array rows X clusters, created at once
+    :return: silhouette score and its confidence interval (score, score) in exact mode
+    """
+    n = similarity.shape[0]
+    if sample_size is None or sample_size >= n:
+        score = silhouette_samples_sparse(similarity, labels, max_cells=max_cells).mean()
+        return score, (score, score)
+    rows = np.random.default_rng(random_state).choice(n, sample_size, replace=False)
+    values = silhouette_samples_sparse(similarity, labels, rows, max_cells=max_cells)
+    score = values.mean()
+    half_width = norm.ppf(0.5 + confidence / 2) * values.std(ddof=1) / np.sqrt(sample_size)
+    return score, (score - half_width, score + half_width)
+
+
+def _cluster_weights(similarity: spmatrix, codes: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray, float]:
+    """Weights of edges inside each cluster, total weights (volumes) of clusters and total weight of graph"""
+    similarity = similarity.tocoo()
+    not_loop = similarity.row != similarity.col
+    rows, cols, data = similarity.row[not_loop], similarity.col[not_loop], similarity.data[not_loop]
+    inside = codes[rows] == codes[cols]
+    internal = np.bincount(codes[rows[inside]], weights=data[inside], minlength=k)
+    volumes = np.bincount(codes[rows], weights=data, minlength=k)
+    return internal, volumes, data.sum()
+
+
+def modularity(similarity: spmatrix, labels: Sequence) -> float:
+    """
+    Newman modularity of clustering of weighted graph, given by sparse symmetric similarity matrix (diagonal is
+    ignored)
+    """
+    codes, k = _encode_labels(labels)
+    internal, volumes, total = _cluster_weights(similarity, codes, k)
+    if total == 0:
+        return 0.
+    return (internal / total - (volumes / total) ** 2).sum()
+
+
+def conductance(similarity: spmatrix, labels: Sequence) -> np.ndarray:
+    """
+    Conductance of each cluster: weight of edges going out of cluster divided by minimum of volume of cluster and
+    volume of the rest of graph. Lower is better. Clusters are ordered as np.unique(labels)
+    """
+    codes, k = _encode_labels(labels)
+    internal, volumes, total = _cluster_weights(similarity, codes, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = (volumes - internal) / np.minimum(volumes, total - volumes)
+    return np.nan_to_num(res, nan=0.)
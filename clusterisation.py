@@ -1,14 +1,18 @@
 import scipy.sparse
 from scipy.sparse import dok_matrix, lil_matrix, spmatrix, csr_matrix
 import pandas as pd
-from itertools import combinations
+from os.path import exists
+from itertools import combinations, chain
 from typing import Optional, Callable, Union, Sequence
 
 from support_functions import timing
 from sklearn.metrics import silhouette_score
 import numpy as np
-from support_functions import regroup_categories, convert_lists, generate_stages, data_path, fillna_list
-from sentence_transformers import util
+from support_functions import convert_lists, generate_stages, data_path, fillna_list
+from storage import read_stage_file
+from similarity_store import save_similarity
+from category_filter import CategoryFilter, project_filter, FILTER_FILE
+from vocabulary import CategoryVocabulary, project_vocabulary, flatten_lists, PREFIX, VOCABULARY_FILE
 
 
 def affinity_to_dist(affinity_matrix: spmatrix) -> np.matrix:
@@ -54,72 +58,171 @@ def make_sparce_category_matrix(df: pd.DataFrame, n: int, ids_col: str = 'index'
     return category_matrix
 
 
+def make_incidence_matrix(df: pd.DataFrame, n: int, ids_col: str = 'index') -> csr_matrix:
+    """
+    Convert DataFrame with categories and ids to sparse incidence matrix
+    :param df: DataFrame with column with list of ids, which belong to each category
+    :param n: total amount of ids
+    :param ids_col: name of column with ids
+    :return: sparse matrix n X len(df) where value in cell (i, c) is 1 if article i belongs to c-th category of df
+    """
+    lengths = df[ids_col].apply(len).values
+    rows = np.fromiter(chain.from_iterable(df[ids_col]), dtype=np.int64, count=lengths.sum())
+    cols = np.repeat(np.arange(len(df)), lengths)
+    incidence = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n, len(df)))
+    incidence.data[:] = 1  # duplicated ids in one category are counted once
+    return incidence
+
+
+def drop_diagonal(matrix: spmatrix, max_val: Optional[int] = None, row_offset: int = 0) -> csr_matrix:
+    """Remove diagonal (article with itself) from block of rows starting from row_offset and cap values by max_val"""
+    matrix = matrix.tocsr()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    keep = rows + row_offset != matrix.indices
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[keep], minlength=matrix.shape[0]))])
+    data = matrix.data[keep]
+    if max_val is not None:
+        data = np.minimum(data, max_val)
+    return csr_matrix((data, matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+@timing(printed_args=['n'])
+def make_sparse_cooccurrence_matrix(df: pd.DataFrame, n: int, ids_col: str = 'index', max_val: Optional[int] = None,
+                                    max_nnz: Optional[int] = 50_000_000) -> csr_matrix:
+    """
+    Same as make_sparce_category_matrix, but computed as B * B.T, where B is sparse incidence matrix articles X
+    categories, so there are no python loops over pairs of articles. If product could have more than max_nnz
+    non-zero values, it is computed by blocks of rows, so that each block has no more than max_nnz values
+    :param df: DataFrame with column with categories (or infracategories) and column with list of ids, which belong to
+    each category
+    :param n: total amount of ids
+    :param ids_col: name of column with ids
+    :param max_val: set if you want not to count common categories if there are more than max_val of them
+    :param max_nnz: memory limit, maximum number of non-zero values in one block of product. None for no limit
+    :return: sparce matrix n X n where value in cell (i, j) is amount of common categories of article i and article j
+    """
+    return cooccurrence_from_incidence(make_incidence_matrix(df, n, ids_col), max_val, max_nnz)
+
+
+def cooccurrence_from_incidence(incidence: spmatrix, max_val: Optional[int] = None,
+                                max_nnz: Optional[int] = 50_000_000, workers: Optional[int] = None) -> csr_matrix:
+    """
+    Calculate matrix of common categories as B * B.T without diagonal, see make_sparse_cooccurrence_matrix
+    :param incidence: binary sparse matrix B articles X categories
+    :param max_val: set if you want not to count common categories if there are more than max_val of them
+    :param max_nnz: memory limit, maximum number of non-zero values in one block of product. None for no limit
+    :param workers: if set, rows are calculated in pool of this number of processes (see
+    parallel_cooccurrence.parallel_cooccurrence_from_incidence), max_nnz is then limit of each process
+    :return: sparce matrix n X n where value in cell (i, j) is amount of common categories of article i and article j
+    """
+    if workers:
+        from parallel_cooccurrence import parallel_cooccurrence_from_incidence  # it imports this module
+        return parallel_cooccurrence_from_incidence(incidence, workers, max_val, max_nnz)
+    incidence = csr_matrix(incidence)
+    n = incidence.shape[0]
+    lengths = np.diff(incidence.tocsc().indptr).astype(np.float64)
+    expected_nnz = (lengths ** 2).sum()
+    print(f'Adding {((lengths * (lengths - 1)) / 2).sum()} new edges')
+    if max_nnz is None or expected_nnz <= max_nnz:
+        return drop_diagonal(incidence @ incidence.T, max_val)
+    block_size = max(1, int(n * max_nnz / expected_nnz))
+    incidence_t = incidence.T.tocsr()
+    blocks = [drop_diagonal(incidence[start: start + block_size] @ incidence_t, max_val, start)
+              for start in range(0, n, block_size)]
+    return scipy.sparse.vstack(blocks, format='csr')
+
+
+def binary_csr(offsets: np.ndarray, values: np.ndarray, shape: tuple[int, int],
+                rows: Optional[np.ndarray] = None) -> csr_matrix:
+    """
+    Binary sparse matrix from CSR-like lists: row i has ones in columns values[offsets[i]:offsets[i + 1]]. If rows is
+    set, i-th list is put to row rows[i] instead
+    """
+    row_ids = np.arange(len(offsets) - 1) if rows is None else rows
+    matrix = csr_matrix((np.ones(len(values), dtype=np.int32), (np.repeat(row_ids, np.diff(offsets)), values)),
+                        shape=shape)
+    matrix.data[:] = 1
+    return matrix
+
+
+def kept_categories(level: csr_matrix, vocabulary: CategoryVocabulary,
+                     category_filter: CategoryFilter) -> np.ndarray:
+    """Ids of categories, which are present in level matrix (articles X categories) and are not filtered"""
+    present = np.unique(level.indices)
+    excluded = np.array([category_filter.is_excluded(PREFIX + name) for name in vocabulary.decode(present)],
+                        dtype=bool)
+    return present[~excluded]
+
+
 @timing(printed_args=[])
-def calculate_jaccard(matrix: Union[spmatrix, np.matrix], each_node_edges: np.array, parts: int=5000) -> spmatrix:
+def calculate_jaccard(matrix: Union[spmatrix, np.matrix], each_node_edges: np.array, parts: int = 5000,
+                      min_similarity: Optional[float] = None) -> csr_matrix:
     """
     Convert matrix of common categories to jaccard similarity matrix. Used weightened Jaccard as here
     https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.jaccard.html
     Also, gor Jaccard generalization read
     http://theory.stanford.edu/~sergei/papers/soda10-jaccard.pdf
+    Only stored (non-zero) values are calculated, so no dense n X n arrays are created
 
     :param matrix: affinity matrix (A(i,j) = # of similar categories
     :param each_node_edges: number of categories for each of articles (weighted with same weights as matrix)
-    :return: matrix with same size as input matrix
-    """
-    pairwise_sums = np.add.outer(each_node_edges, each_node_edges)
-    matrix = matrix / (pairwise_sums - matrix + 0.0001)
-    return csr_matrix(matrix)
-
-
-def filter_categories(df, cat_col='category'):
-    """Filter categories, which are too wide and doesn't in fact mark some real similarity"""
-    exclude = ['[Dd]isambiguation',
-               ' stubs$',
-               "(?:^|:)Living people",
-               '[0-9]+s? (?:births$|deaths)',
-               '(?:^|:)Deaths (?:by|due|from)',
-               '(?:Alcohol-related|Accidental|Road incident|Tuberculosis|Sports?) deaths',
-               '(?:century|animal|racehorse|BC) (?:births|deaths)',
-               '(?:^|:)Alumni',
-               'alumni$',
-               'People educated at',
-               '(?:^|:)People from',
-               "people of .+ descent",
-               '(?:^|:)[0-9]+(?:th|st)-century.+(?:women|people)$',
-               '(?:^|:)Burials at',
-               '(?:^|:)[0-9]+ (?:dis)?establishments in',
-               'century (?:dis)?establishments',
-               '(?:^|:)Years',
-               'by time',
-               'Main topic classifications',
-               '(?:^|:)Humans$',
-               'by decade',
-               'Individual apes',
-               ' beginnings$',
-               'by time',
-               'by country',
-               'by type and year$',
-               'by nationality',
-               'by year',
-               'Categories by',
-               'by continent',
-               'Works by',
-               '(?:^|:)[0-9][0-9][0-9][0-9]s?$',
-               'by century',
-               'by occupation',
-               'Populated places by',
-               '(?:p|P)eople by university',
-               'by religion'
-               ]
-    for token in exclude:
-        df = df[~df[cat_col].astype(str).str.contains(token)]
-    return df
+    :param parts: number of rows, processed at once
+    :param min_similarity: if set, similarities less than it are removed from result
+    :return: float32 sparse matrix with same size as input matrix
+    """
+    matrix = csr_matrix(matrix, dtype=np.float32, copy=True)
+    each_node_edges = np.asarray(each_node_edges, dtype=np.float32)
+    for start in range(0, matrix.shape[0], parts):
+        stop = min(start + parts, matrix.shape[0])
+        values = slice(matrix.indptr[start], matrix.indptr[stop])
+        rows = np.repeat(np.arange(start, stop), np.diff(matrix.indptr[start: stop + 1]))
+        common = matrix.data[values]
+        matrix.data[values] = common / (each_node_edges[rows] + each_node_edges[matrix.indices[values]] - common
+                                        + np.float32(0.0001))
+    if min_similarity is not None:
+        matrix.data[matrix.data < min_similarity] = 0
+        matrix.eliminate_zeros()
+    return matrix
+
+
+def filter_categories(df: pd.DataFrame, cat_col: str = 'category',
+                      category_filter: Optional[CategoryFilter] = None) -> pd.DataFrame:
+    """
+    Filter categories, which are too wide and doesn't in fact mark some real similarity
+    :param df: DataFrame with categories
+    :param cat_col: name of column with categories
+    :param category_filter: filter to use (with memoized verdicts), new English filter by default
+    :return: filtered DataFrame
+    """
+    if category_filter is None:
+        category_filter = CategoryFilter()
+    return category_filter.filter(df, cat_col)
+
+
+def integer_mults(mults: Optional[Sequence[float]], levels: int) -> np.ndarray:
+    """
+    Multiply weights of levels by some coefficient, so that they will be close to ints. It will not change results
+    because we use Jaccard measure (it is not changing if all weights are increased simultaneously)
+    this is done for memory optimisation
+    :param mults: weight of each level, if None - all weights =1
+    :param levels: number of levels
+    :return: array of weights
+    """
+    if mults is None:
+        return np.ones(levels)
+    mults = np.array(mults)
+    mults = mults / mults[mults != 0].min()
+    while np.abs((np.rint(mults) - mults)[mults != 0] / mults[mults != 0]).max() > 0.01:
+        mults = mults * 10
+    return np.rint(mults).astype(int)
 
 
 def leveled_jaccard_similarity(
         project: str, stages_num: Optional[int] = None, paths: Optional[list[str]] = None,
         col_names: Optional[list[str]] = None, mults: Optional[list[int]] = None,
-        data_folder_name='data') -> Optional[tuple[pd.DataFrame, spmatrix]]:
+        data_folder_name='data', min_similarity: Optional[float] = None, lang: str = 'en',
+        category_filter: Optional[CategoryFilter] = None,
+        save_matrix: bool = False, workers: Optional[int] = None) -> Optional[tuple[pd.DataFrame, spmatrix]]:
     """
     Calculate pairwise Jaccard similarities between articles, using weighted approach: different levels of hierarchy
     have different weights in resulting graph
@@ -130,6 +233,13 @@ def leveled_jaccard_similarity(
     :param paths: paths to specific files with DataFrames with column 'index' (with list of ids) and column with
     list of categories, each of article from 'index' column belongs to
     :param data_folder_name: name of folder with all projects
+    :param min_similarity: if set, similarities less than it are removed from result
+    :param lang: wikipedia language code, used to choose patterns of filtered categories
+    :param category_filter: filter of too wide categories. If None, filter saved with project is used (or new one for
+    lang), and it is saved to project folder with all verdicts after calculations
+    :param save_matrix: save matrix (with disambiguation pages) and dataframe to project folder, so they could be
+    opened by similarity_store.load_similarity without recalculation
+    :param workers: if set, co-occurrences of each level are calculated in pool of this number of processes
     :return: dataframe with articles and their 1-st-level categories, sparce matrix with Jaccard similarities
     """
     if paths is None:
@@ -147,47 +257,51 @@ def leveled_jaccard_similarity(
         if col_names is None:
             print('You should set col_names if you set specific paths to the files')
             return
-    if mults is None:
-        mults = np.ones(len(paths))
-    else:
-        #  multiply multipliers by some coefficient, so that they will be close to ints. It will not change results
-        #  because we use Jaccard measure (it is not changing if all weights are increased simultaneously)
-        #  this is done for memory optimisation
-        mults = np.array(mults)
-        mults = mults / mults[mults != 0].min()
-        while np.abs((np.rint(mults) - mults)[mults != 0] / mults[mults != 0]).max() > 0.01:
-            mults = mults * 10
-        mults = np.rint(mults).astype(int)
+    save_filter = category_filter is None
+    if category_filter is None:
+        category_filter = project_filter(project, lang, data_folder_name)
+    mults = integer_mults(mults, len(paths))
 
+    vocabulary = project_vocabulary(project, data_folder_name)
     print(f'Loading files {", ".join(paths)}')
-    df0 = pd.read_csv(paths[0]).reset_index()
+    df0 = read_stage_file(paths[0]).reset_index()
     df0 = convert_lists(df0, col_names[0])
     no_disambig_cond = ~df0.set_index('title').category.astype(str).str.contains('isambig')
     n = len(df0)
-    total_cats_per_article = df0.copy()
-    total_cats_per_article['cat_count_weighted'] = total_cats_per_article[col_names[0]].apply(len) * mults[0]
-    total_cats_per_article.drop(col_names[0], axis=1, inplace=True)
-    cats = filter_categories(regroup_categories(df0, col_names[0], 'index', lists=False), col_names[0])
-    matrix = make_sparce_category_matrix(cats, n) * mults[0]
-
-    for num, (path, col_name, mult) in enumerate(zip(paths[1:], col_names[1:], mults[1:])):
-        df_ = pd.read_csv(path)
+    # all levels are processed as sparse matrices articles X category ids, see vocabulary.CategoryVocabulary
+    offsets, values = vocabulary.encode_lists(df0[col_names[0]].tolist())
+    level = binary_csr(offsets, values, (n, len(vocabulary)), rows=df0['index'].values.astype(np.int64))
+    cat_count_weighted = np.diff(level.indptr) * mults[0]
+    kept = kept_categories(level, vocabulary, category_filter)
+    matrix = cooccurrence_from_incidence(level[:, kept], workers=workers) * mults[0]
+
+    for path, prev_col_name, col_name, mult in zip(paths[1:], col_names[:-1], col_names[1:], mults[1:]):
+        df_ = read_stage_file(path)
         df_ = convert_lists(df_, col_name)
         df_ = convert_lists(df_, 'index')
-        df_ = df_[df_[col_names[num]].isin(set(cats[col_names[num]]))]
-        total_cats_per_article['cat_count_weighted'] += regroup_categories(
-            df_, 'index', col_name, lists=True, add_word=None
-        ).set_index('index')[col_name].apply(len).reindex(df0.index).fillna(0) * mult
-        cats = regroup_categories(df_, col_name, 'index', lists=True)
-        cats = filter_categories(cats, col_name)
-        matrix += make_sparce_category_matrix(cats, n) * mult
+        df_ = df_[np.isin(vocabulary.encode(df_[prev_col_name].astype(str)), kept)]
+        offsets, values = flatten_lists(df_['index'].tolist())
+        members = binary_csr(offsets, values, (len(df_), n))
+        offsets, values = vocabulary.encode_lists(df_[col_name].tolist())
+        parents = binary_csr(offsets, values, (len(df_), len(vocabulary)))
+        level = members.T.tocsr() @ parents
+        level.data[:] = 1
+        cat_count_weighted += np.diff(level.indptr) * mult
+        kept = kept_categories(level, vocabulary, category_filter)
+        matrix += cooccurrence_from_incidence(level[:, kept], workers=workers) * mult
 
     matrix = matrix.astype(np.float32)
-    matrix = calculate_jaccard(matrix, total_cats_per_article['cat_count_weighted'].values.astype(np.float32))
-    df0 = filter_categories(df0.explode(col_names[0]), col_names[0]).groupby('title').agg(
+    matrix = calculate_jaccard(matrix, cat_count_weighted.astype(np.float32), min_similarity=min_similarity)
+    df0 = filter_categories(df0.explode(col_names[0]), col_names[0], category_filter).groupby('title').agg(
         {col_names[0]: pd.Series.tolist}
     ).reindex(df0['title'])
     df0[col_names[0]] = fillna_list(df0[col_names[0]], [])
     df0 = df0.loc[no_disambig_cond]
+    if save_matrix:
+        save_similarity(df0.reset_index(), matrix, project, data_folder_name, np.flatnonzero(no_disambig_cond))
     matrix = matrix[no_disambig_cond][:, no_disambig_cond]
+    if exists(f'{data_folder_name}/{project}'):
+        vocabulary.save(f'{data_folder_name}/{project}/{VOCABULARY_FILE}')
+        if save_filter:
+            category_filter.save(f'{data_folder_name}/{project}/{FILTER_FILE}')
     return df0.reset_index(), matrix
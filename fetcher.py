@@ -0,0 +1,265 @@
+import math
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from typing import Optional
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from category_cache import CategoryCache
+from instrumentation import context_map, count
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Thread-safe limiter, which spreads requests evenly, so that there are no more than requests_per_second"""
+    def __init__(self, requests_per_second: Optional[float] = None):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._next_slot = monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until next request is allowed"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class CategoryFetcher:
+    """
+    Concurrent replacement of get_category_mass. Batches of titles are sent by several threads at once, but with
+    politeness budget: no more than requests_per_second requests and max_in_flight simultaneous connections.
+    Responses with 429 and 5xx statuses and "maxlag" errors are retried with exponential backoff (or after
+    Retry-After, if server sent it). Continuation pages (clcontinue) are drained in loop, not recursively.
+    Instance is callable with the same arguments as get_category_mass, so it could be passed as f to
+    apply_with_interim_saving or as fetcher to get_articles_with_infracategories
+    """
+    def __init__(self, requests_per_second: Optional[float] = 10, max_in_flight: int = 4, max_retries: int = 5,
+                 backoff: float = 1., maxlag: Optional[int] = 5, timeout: float = 30., n: int = 50,
+                 api_url: str = 'https://{lang}.wikipedia.org/w/api.php', user_agent: Optional[str] = None):
+        """
+        :param requests_per_second: maximum rate of requests, None for unlimited
+        :param max_in_flight: maximum number of simultaneous requests
+        :param max_retries: how many times to retry request before raising error
+        :param backoff: delay before first retry in seconds, it is doubled after each retry
+        :param maxlag: maxlag parameter of API (https://www.mediawiki.org/wiki/Manual:Maxlag_parameter)
+        :param timeout: timeout of each request in seconds
+        :param n: number of titles per API query. For usual users 50 is maximum.
+        :param api_url: address of API, with {lang} placeholder for wikipedia language code
+        :param user_agent: User-Agent header, as Wikimedia asks to identify bots
+        """
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.maxlag = maxlag
+        self.timeout = timeout
+        self.n = n
+        self.api_url = api_url
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.session()
+        adapter = HTTPAdapter(pool_connections=max_in_flight, pool_maxsize=max_in_flight)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if user_agent is not None:
+            self.session.headers['User-Agent'] = user_agent
+
+    def __call__(self, titles: list[str], lang: str = 'en', session: Optional[requests.Session] = None,
+                 cache: Optional[CategoryCache] = None) -> dict[str, list[str]]:
+        """
+        Retrieve categories of articles by their captions using API. Only unhidden categories.
+        :param titles: list of titles of article, as it shown on page
+        :param lang: wikipedia language code, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
+        :param session: ignored, fetcher uses its own pool of connections. Kept for compatibility with
+        get_category_mass
+        :param cache: persistent cache of categories, only titles which are not in cache will be requested from API
+        :return: dict title: list of categories (without "Category:" prefix)
+        """
+        if cache is not None:
+            return cache.fetch(titles, lang, self)
+        batches = [titles[t: t + self.n] for t in range(0, len(titles), self.n)]
+        res = {}
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for batch_res in context_map(executor, lambda batch: self.fetch_batch(batch, lang), batches):
+                res.update(batch_res)
+        return res
+
+    def fetch_batch(self, titles: list[str], lang: str = 'en') -> dict[str, list[str]]:
+        """Retrieve categories of no more than n titles, following all continuation pages"""
+        params = {
+            "action": "query",
+            "format": "json",
+            "prop": "categories",
+            "titles": "|".join(titles),
+            "clshow": "!hidden",
+            "cllimit": 500
+        }
+        if self.maxlag is not None:
+            params['maxlag'] = self.maxlag
+        url = self.api_url.format(lang=lang)
+        categories = {}
+        original_titles = {}
+        while True:
+            data = self.get(url, params)
+            for normalized in data['query'].get('normalized', []):
+                original_titles[normalized['to']] = normalized['from']
+            for art in data['query']['pages'].values():
+                title = original_titles.get(art['title'], art['title'])
+                categories.setdefault(title, []).extend(
+                    cat['title'].replace('Category:', '') for cat in art.get('categories', []))
+            if 'continue' not in data:
+                break
+            params.update(data['continue'])
+        categories.update({i: [] for i in titles if i not in categories})
+        return categories
+
+    def get(self, url: str, params: dict) -> dict:
+        """Make one GET request to API with rate limiting and retries, return decoded json"""
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff * 2 ** attempt
+            self.rate_limiter.wait()
+            if attempt:
+                count('retries')
+            count('requests')
+            try:
+                response = self.session.get(url=url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                print(f'Request failed ({e}), retry in {delay} sec')
+                sleep(delay)
+                continue
+            count('bytes', len(response.content))
+            if response.status_code in RETRY_STATUSES:
+                delay = float(response.headers.get('Retry-After', delay))
+                print(f'Status {response.status_code}, retry in {delay} sec')
+                sleep(delay)
+                continue
+            response.raise_for_status()
+            data = response.json()
+            if data.get('error', {}).get('code') == 'maxlag':
+                delay = float(response.headers.get('Retry-After', delay))
+                print(f'Servers are lagged ({data["error"].get("info")}), retry in {delay} sec')
+                sleep(delay)
+                continue
+            return data
+        raise requests.exceptions.RetryError(f'Request to {url} failed after {self.max_retries} retries')
+
+
+class ExtractsFetcher(CategoryFetcher):
+    """
+    Batched and concurrent replacement of retrieve.get_article_text: plain text introductions of up to 20 articles
+    (maximum of API for intros) are requested at once, with the same pool of connections, rate limit and retries as
+    CategoryFetcher. Instance is callable with list of titles, so it could be passed as f to apply_with_interim_saving
+    """
+    def __init__(self, requests_per_second: Optional[float] = 10, max_in_flight: int = 4, n: int = 20,
+                 sentences: Optional[int] = None, **kwargs):
+        """
+        :param requests_per_second: maximum rate of requests, None for unlimited
+        :param max_in_flight: maximum number of simultaneous requests
+        :param n: number of titles per API query, 20 is maximum for extracts
+        :param sentences: if set, only this number of first sentences (up to 10) is returned instead of whole intro
+        :param kwargs: other arguments of CategoryFetcher (max_retries, backoff, maxlag, timeout, api_url, user_agent)
+        """
+        super().__init__(requests_per_second, max_in_flight, n=min(n, 20), **kwargs)
+        self.sentences = sentences
+
+    def __call__(self, titles: list[str], lang: str = 'en', **kwargs) -> dict[str, str]:
+        """
+        Retrieve introductions of articles
+        :param titles: list of titles of article, as it shown on page
+        :param lang: wikipedia language code, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
+        :param kwargs: ignored (session, cache), kept for compatibility with apply_with_interim_saving calls
+        :return: dict title: text ('' if article has no text)
+        """
+        return super().__call__(titles, lang)
+
+    def fetch_batch(self, titles: list[str], lang: str = 'en') -> dict[str, str]:
+        """Retrieve introductions of no more than n titles, following all continuation pages"""
+        params = {
+            "action": "query",
+            "format": "json",
+            "prop": "extracts",
+            "titles": "|".join(titles),
+            "exintro": 1,
+            "explaintext": 1,
+            "exlimit": "max"
+        }
+        if self.sentences is not None:
+            params['exsentences'] = min(self.sentences, 10)
+        if self.maxlag is not None:
+            params['maxlag'] = self.maxlag
+        url = self.api_url.format(lang=lang)
+        texts = {}
+        original_titles = {}
+        while True:
+            data = self.get(url, params)
+            for normalized in data['query'].get('normalized', []):
+                original_titles[normalized['to']] = normalized['from']
+            for art in data['query']['pages'].values():
+                if 'extract' in art:
+                    texts[original_titles.get(art['title'], art['title'])] = art['extract']
+            if 'continue' not in data:
+                break
+            params.update(data['continue'])
+        texts.update({i: '' for i in titles if i not in texts})
+        return texts
+
+
+class KnownEdgesFetcher:
+    """
+    Wrapper of fetcher (get_category_mass or CategoryFetcher), which keeps all retrieved edges category -> parents
+    of the crawl. Category graph has many categories, reachable on several levels (and cycles), so on each infra level
+    only new frontier categories are requested, and results for already visited ones are assembled from known edges.
+    Statistics of saved requests are collected for each level
+    """
+    def __init__(self, fetcher: Callable, n: Optional[int] = None):
+        """
+        :param fetcher: function with the same signature as get_category_mass
+        :param n: number of titles per API query, used to estimate number of saved requests (fetcher.n or 50)
+        """
+        self.fetcher = fetcher
+        self.n = n or getattr(fetcher, 'n', 50)
+        self.edges = {}
+        self.level = 0
+        self.level_stats = {}
+
+    def add_known(self, titles: Iterable[str], parents: Iterable[Optional[list[str]]]) -> None:
+        """Add edges retrieved earlier (for example, from stage files of interrupted crawl)"""
+        for title, title_parents in zip(titles, parents):
+            if isinstance(title_parents, list):
+                self.edges.setdefault(title, title_parents)
+
+    def set_level(self, level: int) -> None:
+        """Start collecting statistics for next level"""
+        self.level = level
+
+    def __call__(self, titles: list[str], lang: str = 'en', **kwargs) -> dict[str, list[str]]:
+        """
+        Retrieve categories of titles, which were not retrieved before, with fetcher
+        :param titles: list of titles
+        :param lang: wikipedia language code
+        :param kwargs: arguments, which will be passed to fetcher (session, cache)
+        :return: dict title: list of categories for all titles
+        """
+        unique = list(dict.fromkeys(titles))
+        new = [title for title in unique if title not in self.edges]
+        if new:
+            retrieved = self.fetcher(new, lang=lang, **kwargs)
+            self.edges.update((title, retrieved.get(title, [])) for title in new)
+        stats = self.level_stats.setdefault(self.level, {'titles': 0, 'known': 0, 'fetched': 0, 'saved_requests': 0})
+        stats['titles'] += len(unique)
+        stats['known'] += len(unique) - len(new)
+        stats['fetched'] += len(new)
+        stats['saved_requests'] += math.ceil(len(unique) / self.n) - math.ceil(len(new) / self.n)
+        return {title: self.edges[title] for title in unique}
+
+    def stats(self) -> pd.DataFrame:
+        """Statistics by levels: number of titles, already known ones, fetched ones and estimated saved requests"""
+        return pd.DataFrame.from_dict(self.level_stats, orient='index').rename_axis('level')
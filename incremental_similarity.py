@@ -0,0 +1,201 @@
+import json
+import os
+from os.path import exists
+from typing import Optional, Sequence
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csr_matrix, diags
+
+from category_filter import CategoryFilter, project_filter
+from category_graph import CategoryGraph, resize_sparse, project_graph
+from clusterisation import cooccurrence_from_incidence, calculate_jaccard, integer_mults
+from support_functions import data_path, generate_stages
+
+SIMILARITY_FOLDER = 'similarity'
+
+
+def filtered_level(level: csr_matrix, kept: np.ndarray) -> csr_matrix:
+    """Level of categories with columns of filtered out categories zeroed (column ids remain vocabulary ids)"""
+    mask = np.zeros(level.shape[1], dtype=level.dtype)
+    mask[kept] = 1
+    res = (level @ diags(mask)).tocsr()
+    res.eliminate_zeros()
+    return res
+
+
+def changed_rows(old: csr_matrix, new: csr_matrix) -> np.ndarray:
+    """Ids of rows of new matrix, which are new or differ from rows of old matrix"""
+    n_old = old.shape[0]
+    diff = (new[:n_old] - resize_sparse(old, (n_old, new.shape[1]))).tocsr()
+    diff.eliminate_zeros()
+    return np.concatenate([np.flatnonzero(np.diff(diff.indptr)), np.arange(n_old, new.shape[0])])
+
+
+def update_cooccurrence(cooccurrence: csr_matrix, incidence: csr_matrix, rows: np.ndarray) -> csr_matrix:
+    """
+    Recalculate rows and columns of co-occurrence matrix for changed articles only: co-occurrence of other pairs of
+    articles doesn't depend on them
+    :param cooccurrence: old co-occurrence matrix (could have fewer rows than incidence)
+    :param incidence: new binary matrix articles X categories
+    :param rows: ids of changed (or new) articles
+    :return: co-occurrence matrix for incidence, diagonal is zero
+    """
+    n = incidence.shape[0]
+    mask = np.zeros(n, dtype=bool)
+    mask[rows] = True
+    unchanged = diags((~mask).astype(cooccurrence.dtype))
+    res = unchanged @ resize_sparse(cooccurrence, (n, n)) @ unchanged
+    block = (incidence[rows] @ incidence.T).tocoo()
+    not_diagonal = rows[block.row] != block.col
+    block = csr_matrix((block.data[not_diagonal], (rows[block.row[not_diagonal]], block.col[not_diagonal])),
+                       shape=(n, n), dtype=cooccurrence.dtype)
+    inner = block @ diags(mask.astype(block.dtype))
+    res = (res + block + block.T - inner).tocsr()
+    res.eliminate_zeros()
+    return res
+
+
+class IncrementalSimilarity:
+    """
+    Cached per-level co-occurrence matrices and category counts of articles. When articles or levels are added to
+    project, only rows and columns of changed articles are recalculated, and similarity with any mults is a weighted
+    sum of cached matrices
+    """
+    def __init__(self, patterns: Sequence[str], levels: Optional[list[csr_matrix]] = None,
+                 cooccurrences: Optional[list[csr_matrix]] = None, counts: Optional[list[np.ndarray]] = None,
+                 stage_files: Optional[dict[str, list[int]]] = None):
+        """
+        :param patterns: patterns of category filter, which was used for levels
+        :param levels: binary matrices articles X category ids of each level (filtered out categories are removed)
+        :param cooccurrences: co-occurrence matrices of articles on each level
+        :param counts: number of categories of each article on each level (before filtering)
+        :param stage_files: modification times and sizes of stage files, from which levels were calculated
+        """
+        self.patterns = list(patterns)
+        self.levels = levels or []
+        self.cooccurrences = cooccurrences or []
+        self.counts = counts or []
+        self.stage_files = stage_files or {}
+
+    @property
+    def depth(self) -> int:
+        return len(self.levels)
+
+    def update(self, graph: CategoryGraph, depth: Optional[int] = None,
+               category_filter: Optional[CategoryFilter] = None) -> dict:
+        """
+        Update cache from new index of project: new levels are calculated completely, on old levels only new articles
+        and articles with changed categories are recalculated
+        :param graph: index of project (built from updated stage files)
+        :param depth: number of levels, current depth by default
+        :param category_filter: filter of too wide categories, filter with patterns of cache by default
+        :return: number of recalculated rows on each level
+        """
+        if category_filter is None:
+            category_filter = CategoryFilter(self.patterns)
+        elif category_filter.patterns != self.patterns:
+            raise ValueError('Filter patterns differ from cached ones, create new IncrementalSimilarity')
+        depth = depth or self.depth
+        stats = {}
+        for num, (level, kept) in enumerate(graph.levels(depth, category_filter)):
+            incidence = filtered_level(level, kept)
+            counts = np.diff(level.indptr).astype(np.int32)
+            if num < self.depth:
+                rows = changed_rows(self.levels[num], incidence)
+                old_counts = self.counts[num]
+                count_changed = np.flatnonzero(counts[:len(old_counts)] != old_counts)
+                cooccurrence = update_cooccurrence(self.cooccurrences[num], incidence, rows)
+                self.levels[num], self.cooccurrences[num], self.counts[num] = incidence, cooccurrence, counts
+                stats[num] = len(np.union1d(rows, count_changed))
+            else:
+                self.levels.append(incidence)
+                self.cooccurrences.append(cooccurrence_from_incidence(incidence))
+                self.counts.append(counts)
+                stats[num] = incidence.shape[0]
+        return stats
+
+    def similarity(self, mults: Optional[Sequence[float]] = None,
+                   min_similarity: Optional[float] = None) -> csr_matrix:
+        """
+        Weighted Jaccard similarity of articles from cached levels, same as CategoryGraph.similarity
+        :param mults: weight of each level, if None - all weights =1. Number of mults could be less than depth
+        :param min_similarity: if set, similarities less than it are removed from result
+        :return: sparse matrix with Jaccard similarities of articles
+        """
+        depth = len(mults) if mults is not None else self.depth
+        if depth > self.depth:
+            raise ValueError(f'Only {self.depth} levels are cached, update cache with bigger depth')
+        mults = integer_mults(mults, depth)
+        n = self.levels[0].shape[0]
+        matrix = csr_matrix((n, n), dtype=np.float32)
+        cat_count_weighted = np.zeros(n)
+        for cooccurrence, counts, mult in zip(self.cooccurrences, self.counts, mults):
+            cat_count_weighted += counts * mult
+            matrix += cooccurrence * mult
+        return calculate_jaccard(matrix, cat_count_weighted.astype(np.float32), min_similarity=min_similarity)
+
+    def save(self, folder: str) -> None:
+        """Save cached levels to folder"""
+        os.makedirs(folder, exist_ok=True)
+        for num in range(self.depth):
+            scipy.sparse.save_npz(f'{folder}/level_{num}.npz', self.levels[num])
+            scipy.sparse.save_npz(f'{folder}/cooccurrence_{num}.npz', self.cooccurrences[num])
+            np.save(f'{folder}/counts_{num}.npy', self.counts[num])
+        with open(f'{folder}/similarity.json', 'w') as f:
+            json.dump({'patterns': self.patterns, 'depth': self.depth, 'stage_files': self.stage_files}, f)
+
+    @classmethod
+    def load(cls, folder: str) -> 'IncrementalSimilarity':
+        """Load cache saved by save method"""
+        with open(f'{folder}/similarity.json') as f:
+            meta = json.load(f)
+        depth = range(meta['depth'])
+        return cls(meta['patterns'],
+                   [scipy.sparse.load_npz(f'{folder}/level_{num}.npz').tocsr() for num in depth],
+                   [scipy.sparse.load_npz(f'{folder}/cooccurrence_{num}.npz').tocsr() for num in depth],
+                   [np.load(f'{folder}/counts_{num}.npy') for num in depth], meta.get('stage_files'))
+
+    def is_actual(self, stage_files: dict[str, list[int]], depth: int) -> bool:
+        """Check that depth levels are cached and stage files were not changed since last update"""
+        return depth <= self.depth and all(self.stage_files.get(path) == stat for path, stat in stage_files.items())
+
+
+def stage_files_stats(project: str, stages_num: int, data_folder_name: str = 'data') -> dict[str, list[int]]:
+    """Modification times (in ns) and sizes of stage files, from which index of project is built"""
+    res = {}
+    for stage in generate_stages(stages_num - 1)[1:-1]:
+        path = data_path(stage, project, data_folder_name)
+        stat = os.stat(path)
+        res[path] = [stat.st_mtime_ns, stat.st_size]
+    return res
+
+
+def project_similarity(project: str, stages_num: int, mults: Optional[Sequence[float]] = None,
+                       data_folder_name: str = 'data', lang: str = 'en',
+                       min_similarity: Optional[float] = None) -> csr_matrix:
+    """
+    Similarity of articles of project with incremental update of cache in <data_folder_name>/<project>/similarity.
+    If stage files were changed since last call (or more levels are needed), index of project is rebuilt from them, so
+    added articles and levels are taken into account. Otherwise similarity is calculated from cache only
+    :param project: name of subfolder in data folder
+    :param stages_num: number of levels (1 for categories only, 2 for categories and infra1 etc.)
+    :param mults: weight of each level, if None - all weights =1
+    :param data_folder_name: name of data folder
+    :param lang: wikipedia language code, used to choose patterns of filtered categories
+    :param min_similarity: if set, similarities less than it are removed from result
+    :return: sparse matrix with Jaccard similarities of articles (ids are ids of articles in stage files)
+    """
+    category_filter = project_filter(project, lang, data_folder_name)
+    folder = f'{data_folder_name}/{project}/{SIMILARITY_FOLDER}'
+    cache = IncrementalSimilarity.load(folder) if exists(folder) else None
+    if cache is None or cache.patterns != category_filter.patterns:
+        cache = IncrementalSimilarity(category_filter.patterns)
+    stage_files = stage_files_stats(project, stages_num, data_folder_name)
+    if not cache.is_actual(stage_files, stages_num):
+        graph = project_graph(project, stages_num, data_folder_name, lang, rebuild=True)
+        stats = cache.update(graph, max(stages_num, cache.depth), category_filter)
+        print('Recalculated rows by level: ' + ', '.join(f'{num}: {rows}' for num, rows in stats.items()))
+        cache.stage_files = stage_files
+        cache.save(folder)
+    return cache.similarity(mults, min_similarity=min_similarity)
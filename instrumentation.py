@@ -0,0 +1,214 @@
+import contextvars
+import json
+import os
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter, process_time, time
+from typing import Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# counters, which are exported for every span even if they were not incremented
+COUNTERS = ('requests', 'retries', 'bytes')
+_current_span = ContextVar('current_span', default=None)
+# counters of spans, which are open in current context (current span and its parents)
+_open_counters = ContextVar('open_counters', default=())
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of process in MB (high-water mark since start of process), None if it is unknown"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+
+class Span:
+    """
+    Measurements of one block of code: wall and CPU time, peak RSS of process at the end, rows in and out (set by
+    the code inside span) and increments of counters (API requests, retries, downloaded bytes...) made inside span.
+    Counters are kept in context of the code, so spans of simultaneous threads (like crawls of different languages)
+    count only their own increments, and threads of fetcher, started by context_map, count in span of the caller
+    """
+    def __init__(self, name: str, parent: Optional[str] = None, rows_in: Optional[int] = None,
+                 attrs: Optional[dict] = None):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs or {}
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.start = time()
+        self.wall = None
+        self.cpu = None
+        self.peak_rss_mb = None
+        self.counters = {}
+
+    @property
+    def path(self) -> str:
+        return self.name if self.parent is None else f'{self.parent}/{self.name}'
+
+    def to_dict(self) -> dict:
+        """Fields of span, counters and attributes (attributes with names of fields get prefix "attr_")"""
+        res = {'name': self.name, 'parent': self.parent, 'start': self.start, 'wall': self.wall, 'cpu': self.cpu,
+               'peak_rss_mb': self.peak_rss_mb, 'rows_in': self.rows_in, 'rows_out': self.rows_out, **self.counters}
+        for key, value in self.attrs.items():
+            res[f'attr_{key}' if key in res else key] = value
+        return res
+
+
+class Recorder:
+    """
+    Collector of spans. Each closed span could be appended to JSON-lines file at once (so long crawls could be watched
+    while they are running and interrupted ones keep their measurements), totals by span names could be written to
+    text file in Prometheus exposition format (for node_exporter textfile collector). Overhead of span is a few
+    microseconds, so spans are kept on by default
+    """
+    def __init__(self, jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+                 max_spans: Optional[int] = 100_000, prefix: str = 'wikiplanarization', verbose: bool = False):
+        """
+        :param jsonl_path: file, to which each closed span is appended as json line
+        :param prometheus_path: file, which is rewritten with totals after each closed top-level span
+        :param max_spans: number of last spans kept in memory, None for all
+        :param prefix: prefix of names of Prometheus metrics
+        :param verbose: print time of each function with timing decorator
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.verbose = verbose
+        self.prefix = prefix
+        self.spans = deque(maxlen=max_spans)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1) -> None:
+        """Increment counter of recorder and of spans, open in current context (thread-safe)"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            for counters in _open_counters.get():
+                counters[name] = counters.get(name, 0) + value
+
+    @contextmanager
+    def span(self, name: str, rows_in: Optional[int] = None, attrs: Optional[dict] = None, **kwargs) -> Iterator[Span]:
+        """
+        Measure block of code:
+        with recorder.span('stage 1', rows_in=len(df)) as s:
+            ...
+            s.rows_out = len(res)
+        :param name: name of span, totals are aggregated by it
+        :param rows_in: number of processed rows
+        :param attrs: additional attributes of span, written to json lines (any names, like "name" or "rows_in")
+        :param kwargs: additional attributes of span, added to attrs
+        """
+        parent = _current_span.get()
+        s = Span(name, parent.path if parent is not None else None, rows_in, {**kwargs, **(attrs or {})})
+        token = _current_span.set(s)
+        counters = dict.fromkeys(COUNTERS, 0)
+        counters_token = _open_counters.set(_open_counters.get() + (counters, ))
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield s
+        finally:
+            s.wall = perf_counter() - wall
+            s.cpu = process_time() - cpu
+            s.peak_rss_mb = peak_rss_mb()
+            _open_counters.reset(counters_token)
+            _current_span.reset(token)
+            with self._lock:
+                s.counters = dict(counters)
+            self._add(s)
+
+    def _add(self, s: Span) -> None:
+        with self._lock:
+            self.spans.append(s)
+            total = self.totals.setdefault(s.name, {'count': 0, 'wall': 0., 'cpu': 0., 'rows_in': 0, 'rows_out': 0})
+            total['count'] += 1
+            total['wall'] += s.wall
+            total['cpu'] += s.cpu
+            total['rows_in'] += s.rows_in or 0
+            total['rows_out'] += s.rows_out or 0
+            for key, value in s.counters.items():
+                total[key] = total.get(key, 0) + value
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(s.to_dict(), default=str) + '\n')
+        if self.prometheus_path is not None and s.parent is None:
+            self.export_prometheus(self.prometheus_path)
+
+    def export_jsonl(self, path: str) -> None:
+        """Write spans kept in memory to JSON-lines file"""
+        with self._lock:
+            lines = [json.dumps(s.to_dict(), default=str) + '\n' for s in self.spans]
+        with open(path, 'w') as f:
+            f.writelines(lines)
+
+    def prometheus_text(self) -> str:
+        """Totals by span names in Prometheus text exposition format"""
+        with self._lock:
+            totals = {name: total.copy() for name, total in self.totals.items()}
+        units = {'count': 'spans_total', 'wall': 'wall_seconds_total', 'cpu': 'cpu_seconds_total'}
+        metrics = {}
+        for name, total in totals.items():
+            label = name.replace('\\', '\\\\').replace('"', '\\"')
+            for key, value in total.items():
+                metric = f'{self.prefix}_{units.get(key, key + "_total")}'
+                metrics.setdefault(metric, []).append(f'{metric}{{span="{label}"}} {value}')
+        lines = []
+        for metric, values in metrics.items():
+            lines.append(f'# TYPE {metric} counter')
+            lines.extend(values)
+        rss = peak_rss_mb()
+        if rss is not None:
+            lines.append(f'# TYPE {self.prefix}_peak_rss_bytes gauge')
+            lines.append(f'{self.prefix}_peak_rss_bytes {int(rss * 2 ** 20)}')
+        return '\n'.join(lines) + '\n'
+
+    def export_prometheus(self, path: str) -> None:
+        """Write totals to file atomically, so collector never reads half-written file"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+RECORDER = Recorder()
+
+
+def configure(jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+              verbose: bool = False) -> Recorder:
+    """
+    Set files, where measurements of pipeline are exported
+    :param jsonl_path: file, to which each closed span is appended as json line
+    :param prometheus_path: file with totals in Prometheus text format, rewritten after each top-level span
+    :param verbose: print time of each function with timing decorator
+    :return: global recorder
+    """
+    RECORDER.jsonl_path = jsonl_path
+    RECORDER.prometheus_path = prometheus_path
+    RECORDER.verbose = verbose
+    return RECORDER
+
+
+def span(name: str, rows_in: Optional[int] = None, attrs: Optional[dict] = None, **kwargs):
+    """Span of global recorder, see Recorder.span"""
+    return RECORDER.span(name, rows_in, attrs, **kwargs)
+
+
+def count(name: str, value: float = 1) -> None:
+    """Increment counter of global recorder"""
+    RECORDER.count(name, value)
+
+
+def context_map(executor: Executor, f: Callable, items: Iterable) -> Iterator:
+    """
+    Same as executor.map, but each call is run in copy of context of the caller, so increments of counters, made in
+    threads of executor, are counted in spans open in the caller
+    """
+    futures = [executor.submit(contextvars.copy_context().run, f, item) for item in items]
+    return (future.result() for future in futures)
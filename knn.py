@@ -0,0 +1,71 @@
+from typing import Optional, Sequence
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csr_matrix
+
+from clusterisation import drop_diagonal, integer_mults
+from parallel_cooccurrence import split_by_cost
+
+
+def top_k_per_row(matrix: csr_matrix, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Select k biggest values in each row of sparse matrix (ties are resolved by smaller column)
+    :param matrix: sparse matrix
+    :param k: number of values
+    :return: int32 array rows X k with columns of values (-1 if row has less than k values) and float32 array with
+    values (0 for missing ones), sorted by descending value
+    """
+    matrix = csr_matrix(matrix)
+    n = matrix.shape[0]
+    rows = np.repeat(np.arange(n), np.diff(matrix.indptr))
+    order = np.lexsort((matrix.indices, -matrix.data, rows))
+    rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+    order, rank = order[rank < k], rank[rank < k]
+    indices = np.full((n, k), -1, dtype=np.int32)
+    weights = np.zeros((n, k), dtype=np.float32)
+    indices[rows[order], rank] = matrix.indices[order]
+    weights[rows[order], rank] = matrix.data[order]
+    return indices, weights
+
+
+def knn_graph(incidences: Sequence[csr_matrix], counts: np.ndarray, k: int, mults: Optional[Sequence[float]] = None,
+              max_nnz: Optional[int] = 10_000_000) -> tuple[np.ndarray, np.ndarray]:
+    """
+    k nearest neighbours of each article by weighted Jaccard similarity (same as calculate_jaccard on weighted sum of
+    co-occurrence matrices of levels). Weighted co-occurrence is hstack(m_k * A_k) * hstack(A_k).T, it is calculated by
+    blocks of rows with no more than max_nnz non-zero values, and only top k values of each row are kept, so memory
+    is bounded by n * k plus one block, whatever sizes of categories are
+    :param incidences: binary matrices articles X categories of each level (only categories, which passed filter)
+    :param counts: weighted number of categories of each article (cat_count_weighted)
+    :param k: number of neighbours
+    :param mults: weight of each level, if None - all weights =1
+    :param max_nnz: maximum number of non-zero values in one block of product. None for no limit
+    :return: int32 array n X k with ids of neighbours (-1 if article has less than k neighbours) and float32 array
+    n X k with their similarities, sorted by descending similarity
+    """
+    mults = integer_mults(mults, len(incidences))
+    levels = [(csr_matrix(incidence), mult) for incidence, mult in zip(incidences, mults) if mult]
+    left = scipy.sparse.hstack([incidence * mult for incidence, mult in levels], format='csr')
+    right = scipy.sparse.hstack([incidence for incidence, _ in levels], format='csr')
+    right_t = right.T.tocsr()
+    counts = np.asarray(counts, dtype=np.float32)
+    n = right.shape[0]
+    bounds = split_by_cost(right @ np.diff(right_t.indptr).astype(np.float64), max_nnz)
+    indices = np.full((n, k), -1, dtype=np.int32)
+    weights = np.zeros((n, k), dtype=np.float32)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        block = drop_diagonal(left[start: stop] @ right_t, row_offset=start)
+        block.data = block.data.astype(np.float32)
+        rows = np.repeat(np.arange(start, stop), np.diff(block.indptr))
+        block.data /= counts[rows] + counts[block.indices] - block.data + np.float32(0.0001)
+        indices[start: stop], weights[start: stop] = top_k_per_row(block, k)
+    return indices, weights
+
+
+def knn_to_csr(indices: np.ndarray, weights: np.ndarray) -> csr_matrix:
+    """Convert kNN graph to sparse matrix n X n (not symmetric: row i has similarities of neighbours of i)"""
+    n, k = indices.shape
+    present = indices.ravel() >= 0
+    rows = np.repeat(np.arange(n), k)[present]
+    return csr_matrix((weights.ravel()[present], (rows, indices.ravel()[present])), shape=(n, n))
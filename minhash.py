@@ -0,0 +1,160 @@
+from typing import Optional, Sequence
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from clusterisation import integer_mults
+
+EXCLUDED_BIT = np.uint64(1 << 63)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """Finalizer of splitmix64 generator: fast good-quality hash of uint64 array"""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def leveled_elements(levels: Sequence[tuple[csr_matrix, np.ndarray]],
+                     mults: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Weighted sets of articles for MinHash: elements are pairs (level, category). Categories, which didn't pass filter,
+    are counted in number of categories of article, but never in common ones (see leveled_jaccard_similarity), so
+    they are turned to elements unique for each article
+    :param levels: list of tuples (binary matrix articles X category ids, ids of categories, which passed filter)
+    :param mults: integer weight of each level
+    :return: offsets of elements of each article (elements of article i are [offsets[i]:offsets[i + 1]]), uint64 keys
+    of elements and their weights
+    """
+    n = levels[0][0].shape[0]
+    rows, keys, weights = [], [], []
+    position = 0
+    for num, ((level, kept), mult) in enumerate(zip(levels, mults)):
+        if not mult:
+            continue
+        level = level.tocoo()
+        mask = np.zeros(level.shape[1], dtype=bool)
+        mask[kept] = True
+        level_keys = (np.uint64(num) << np.uint64(32)) | level.col.astype(np.uint64)
+        excluded = ~mask[level.col]
+        level_keys[excluded] = EXCLUDED_BIT | (np.flatnonzero(excluded) + position).astype(np.uint64)
+        position += level.nnz
+        rows.append(level.row)
+        keys.append(level_keys)
+        weights.append(np.full(level.nnz, mult, dtype=np.float64))
+    rows = np.concatenate(rows)
+    order = np.argsort(rows, kind='stable')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+    return offsets, np.concatenate(keys)[order], np.concatenate(weights)[order]
+
+
+def minhash_signatures(levels: Sequence[tuple[csr_matrix, np.ndarray]], mults: Optional[Sequence[float]] = None,
+                       num_perm: int = 128, seed: int = 0, max_values: int = 50_000_000) -> np.ndarray:
+    """
+    Weighted MinHash signatures of leveled category sets of articles. Element with integer weight w is the same as w
+    copies of element in set, and minimum of hashes of w copies is distributed as minimum of w exponential variables,
+    so instead of replicating elements, hash of element is turned to exponential variable with rate w
+    :param levels: list of tuples (binary matrix articles X category ids, ids of categories, which passed filter)
+    :param mults: weight of each level, if None - all weights =1
+    :param num_perm: length of signature
+    :param seed: random seed of hash functions
+    :param max_values: maximum number of hashes, calculated at once
+    :return: float32 array n X num_perm (inf for articles without categories)
+    """
+    mults = integer_mults(mults, len(levels))
+    offsets, keys, weights = leveled_elements(levels, mults)
+    n = len(offsets) - 1
+    signatures = np.full((num_perm, n), np.inf, dtype=np.float32)
+    not_empty = np.flatnonzero(np.diff(offsets))
+    if not len(keys):
+        return signatures.T.copy()
+    hash_seeds = splitmix64(np.arange(num_perm, dtype=np.uint64) + np.uint64(seed) * np.uint64(num_perm))
+    keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    keys, weights = splitmix64(keys), weights[first]
+    chunk = max(1, max_values // len(keys))
+    for start in range(0, num_perm, chunk):
+        hashes = splitmix64(hash_seeds[start: start + chunk, None] ^ keys[None, :])
+        uniform = ((hashes >> np.uint64(11)).astype(np.float64) + 0.5) / 2. ** 53
+        values = (-np.log(uniform) / weights[None, :]).astype(np.float32)
+        for num, perm_values in enumerate(values, start):
+            signatures[num, not_empty] = np.minimum.reduceat(perm_values[inverse], offsets[not_empty])
+    return signatures.T.copy()
+
+
+def _pairs_in_groups(order: np.ndarray, starts: np.ndarray, sizes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """All pairs of items inside each group: group g is order[starts[g]:starts[g] + sizes[g]]"""
+    positions = np.repeat(starts, sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    ends = np.repeat(starts + sizes, sizes)
+    later = ends - positions - 1
+    first = np.repeat(positions, later)
+    partner = np.arange(len(first)) - np.repeat(np.cumsum(later) - later, later) + first + 1
+    a, b = order[first], order[partner]
+    return np.minimum(a, b), np.maximum(a, b)
+
+
+def lsh_candidates(signatures: np.ndarray, bands: int, max_bucket_size: Optional[int] = 1000) -> np.ndarray:
+    """
+    Candidate pairs of articles by LSH banding: signature is split to bands, and articles with equal band are
+    candidates. Probability to become candidates is 1 - (1 - J^r)^bands, where r is rows in band
+    :param signatures: MinHash signatures n X num_perm
+    :param bands: number of bands, num_perm should be divisible by it
+    :param max_bucket_size: buckets with more articles are skipped (they are made by hubs and give quadratic number
+    of pairs). None for no limit
+    :return: unique pairs as int64 keys i * n + j, i < j
+    """
+    n, num_perm = signatures.shape
+    rows_in_band = num_perm // bands
+    if rows_in_band * bands != num_perm:
+        raise ValueError(f'Signature length {num_perm} is not divisible by number of bands {bands}')
+    not_empty = np.flatnonzero(np.isfinite(signatures[:, 0]))
+    bits = signatures[not_empty].view(np.uint32).astype(np.uint64)
+    candidates = []
+    for band in range(bands):
+        keys = np.zeros(len(not_empty), dtype=np.uint64)
+        for col in range(band * rows_in_band, (band + 1) * rows_in_band):
+            keys = splitmix64(keys ^ bits[:, col])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        sizes = np.diff(np.append(starts, len(keys)))
+        big = sizes > 1
+        if max_bucket_size is not None:
+            big &= sizes <= max_bucket_size
+        a, b = _pairs_in_groups(not_empty[order], starts[big], sizes[big])
+        candidates.append(np.unique(a.astype(np.int64) * n + b))
+    return np.unique(np.concatenate(candidates)) if candidates else np.zeros(0, dtype=np.int64)
+
+
+def minhash_similarity(levels: Sequence[tuple[csr_matrix, np.ndarray]], mults: Optional[Sequence[float]] = None,
+                       num_perm: int = 128, bands: int = 32, min_similarity: Optional[float] = None, seed: int = 0,
+                       max_bucket_size: Optional[int] = 1000, chunk: int = 1_000_000) -> csr_matrix:
+    """
+    Approximate weighted Jaccard similarity of articles (see leveled_jaccard_similarity): MinHash signatures of
+    leveled category sets, LSH candidate pairs, and for each candidate pair similarity is estimated as share of equal
+    values of signatures. Pairs which aren't candidates (mostly pairs with low similarity) are missing
+    :param levels: list of tuples (binary matrix articles X category ids, ids of categories, which passed filter)
+    :param mults: weight of each level, if None - all weights =1
+    :param num_perm: length of signature, error of estimate is ~ sqrt(J(1 - J) / num_perm)
+    :param bands: number of LSH bands: more bands - more candidates with low similarity
+    :param min_similarity: if set, similarities less than it are removed from result
+    :param seed: random seed of hash functions
+    :param max_bucket_size: LSH buckets with more articles are skipped
+    :param chunk: number of pairs, estimated at once
+    :return: symmetric float32 sparse matrix with estimated Jaccard similarities
+    """
+    signatures = minhash_signatures(levels, mults, num_perm, seed)
+    n = len(signatures)
+    pairs = lsh_candidates(signatures, bands, max_bucket_size)
+    rows, cols = pairs // n, pairs % n
+    values = np.empty(len(pairs), dtype=np.float32)
+    for start in range(0, len(pairs), chunk):
+        part = slice(start, start + chunk)
+        values[part] = (signatures[rows[part]] == signatures[cols[part]]).mean(axis=1)
+    if min_similarity is not None:
+        kept = values >= min_similarity
+        rows, cols, values = rows[kept], cols[kept], values[kept]
+    return csr_matrix((np.concatenate([values, values]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                      shape=(n, n))
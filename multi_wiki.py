@@ -0,0 +1,56 @@
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from category_cache import CategoryCache
+from fetcher import CategoryFetcher
+from instrumentation import context_map
+from retrieve import get_articles_with_infracategories
+
+
+def lang_folder(lang: str, data_folder_name: str = 'data') -> str:
+    """Data folder of language edition: projects of each language are kept in <data_folder_name>/<lang>"""
+    return f'{data_folder_name}/{lang}'
+
+
+def crawl_languages(langs: Sequence[str], articles_num: int, number_of_infracategories: int, project: str,
+                    data_folder_name: str = 'data', make_fetcher: Optional[Callable[[str], Callable]] = None,
+                    cache: Optional[CategoryCache] = None, max_parallel: Optional[int] = None,
+                    **kwargs) -> dict[str, Optional[Exception]]:
+    """
+    Run get_articles_with_infracategories for several language editions at once. Wikipedias of different languages
+    are separate servers, so each crawl gets its own fetcher (with its own pool of connections and its own rate
+    budget), and total throughput grows with number of languages. Crawls are run in threads, because they are waiting
+    for network most of time. Project of language lang is saved to <data_folder_name>/<lang>/<project>, so it could be
+    used by all project functions with data_folder_name=lang_folder(lang). Crawls are independent: if one of them
+    fails, others are continued, and failed one could be resumed by calling this function again
+    :param langs: wikipedia language codes, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
+    :param articles_num: how many articles do you want to have in each language
+    :param number_of_infracategories: 0 means that there will be only categories,
+    1 for categories and categories of categories etc.
+    :param project: name of project, the same for all languages
+    :param data_folder_name: name of data folder
+    :param make_fetcher: function, which creates fetcher for language code, CategoryFetcher() for each language by
+    default
+    :param cache: persistent cache of categories, it is keyed by language, so one cache could be shared by all crawls
+    :param max_parallel: maximum number of simultaneous crawls, all languages at once by default
+    :param kwargs: other arguments of get_articles_with_infracategories (final_stage, deduplicate)
+    :return: dict language: None if crawl is complete or exception, which stopped it
+    """
+    if make_fetcher is None:
+        make_fetcher = lambda lang: CategoryFetcher()
+
+    def crawl(lang: str) -> Optional[Exception]:
+        try:
+            get_articles_with_infracategories(articles_num, number_of_infracategories, project,
+                                              data_folder_name=lang_folder(lang, data_folder_name),
+                                              fetcher=make_fetcher(lang), cache=cache, lang=lang, **kwargs)
+        except Exception as e:
+            print(f'Crawl of {lang} failed: {e!r}')
+            return e
+        print(f'Crawl of {lang} complete')
+        return None
+
+    langs = list(dict.fromkeys(langs))
+    with ThreadPoolExecutor(max_workers=max_parallel or len(langs) or 1) as executor:
+        return dict(zip(langs, context_map(executor, crawl, langs)))
@@ -0,0 +1,121 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, spmatrix
+
+from clusterisation import make_incidence_matrix, drop_diagonal
+from storage import save_csr, load_csr
+from support_functions import timing
+
+
+def split_by_cost(costs: np.ndarray, max_cost: float, min_parts: int = 1) -> np.ndarray:
+    """
+    Split rows to consecutive ranges, so that total cost of each range is no more than max_cost (if possible) and there
+    are at least min_parts ranges
+    :param costs: cost of each row
+    :param max_cost: maximum cost of range
+    :param min_parts: minimum number of ranges
+    :return: bounds of ranges: range i is bounds[i]:bounds[i + 1]
+    """
+    cumulative = np.cumsum(costs, dtype=np.float64)
+    total = cumulative[-1] if len(cumulative) else 0.
+    parts = max(min_parts, int(np.ceil(total / max_cost)) if max_cost else 1)
+    bounds = np.searchsorted(cumulative, np.linspace(0, total, parts + 1)[1:-1], side='right')
+    return np.unique(np.concatenate([[0], bounds, [len(costs)]]))
+
+
+def _cooccurrence_shard(folder: str, shape: tuple[int, int], start: int, stop: int, max_val: Optional[int],
+                        max_nnz: Optional[int]) -> tuple[int, int]:
+    """
+    Worker: calculate rows start:stop of co-occurrence matrix from memory-mapped incidence matrix, by blocks of no
+    more than max_nnz values, and save them to folder
+    :return: start and number of non-zero values of shard
+    """
+    incidence = load_csr(folder, 'incidence', shape)
+    incidence_t = load_csr(folder, 'incidence_t', shape[::-1])
+    costs = np.load(f'{folder}/costs.npy', mmap_mode='r')[start: stop]
+    bounds = split_by_cost(costs, max_nnz) if max_nnz else np.array([0, stop - start])
+    blocks = [drop_diagonal(incidence[start + a: start + b] @ incidence_t, max_val, start + a)
+              for a, b in zip(bounds[:-1], bounds[1:])]
+    indptr = np.zeros(stop - start + 1, dtype=np.int64)
+    np.cumsum(np.concatenate([np.diff(block.indptr) for block in blocks]), out=indptr[1:])
+    np.save(f'{folder}/shard_{start}_indptr.npy', indptr)
+    np.save(f'{folder}/shard_{start}_indices.npy', np.concatenate([block.indices for block in blocks]))
+    np.save(f'{folder}/shard_{start}_data.npy', np.concatenate([block.data for block in blocks]))
+    return start, indptr[-1]
+
+
+def _merge_shards(folder: str, starts: list[int], n: int) -> csr_matrix:
+    """Concatenate row shards, saved by workers, to one CSR matrix (arrays are read from memory-mapped files)"""
+    shards = [load_csr(folder, f'shard_{start}', (stop - start, n))
+              for start, stop in zip(starts, starts[1:] + [n])]
+    nnz = sum(shard.nnz for shard in shards)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indices = np.empty(nnz, dtype=np.int32)
+    data = np.empty(nnz, dtype=shards[0].data.dtype if shards else np.int32)
+    position = 0
+    for start, shard in zip(starts, shards):
+        indptr[start + 1: start + shard.shape[0] + 1] = shard.indptr[1:] + position
+        indices[position: position + shard.nnz] = shard.indices
+        data[position: position + shard.nnz] = shard.data
+        position += shard.nnz
+    return csr_matrix((data, indices, indptr), shape=(n, n))
+
+
+def parallel_cooccurrence_from_incidence(incidence: spmatrix, workers: Optional[int] = None,
+                                         max_val: Optional[int] = None, max_nnz: Optional[int] = 10_000_000,
+                                         tmp_dir: Optional[str] = None) -> csr_matrix:
+    """
+    Same as clusterisation.cooccurrence_from_incidence, but rows of B * B.T are split to shards with equal expected
+    number of non-zero values, which are calculated in pool of processes. Incidence matrix and results of workers are
+    passed through memory-mapped .npy files in temporary folder, not pickled. Shards are disjoint ranges of rows, so
+    merge is concatenation of their arrays, without summing of overlapping partial matrices
+    :param incidence: binary sparse matrix B articles X categories
+    :param workers: number of processes, os.cpu_count() by default
+    :param max_val: set if you want not to count common categories if there are more than max_val of them
+    :param max_nnz: memory limit of each worker: maximum number of non-zero values in one block of product (each
+    value takes ~12 bytes in result and ~2-3 times more while product is calculated). None for no limit
+    :param tmp_dir: folder for temporary files (system temporary folder by default)
+    :return: sparce matrix n X n where value in cell (i, j) is amount of common categories of article i and article j
+    """
+    incidence = csr_matrix(incidence)
+    incidence.sort_indices()
+    n = incidence.shape[0]
+    workers = workers or os.cpu_count()
+    lengths = np.diff(incidence.tocsc().indptr).astype(np.float64)
+    costs = incidence @ lengths
+    print(f'Adding {((lengths * (lengths - 1)) / 2).sum()} new edges')
+    bounds = split_by_cost(costs, max_nnz * workers if max_nnz else None, min_parts=workers)
+    with TemporaryDirectory(dir=tmp_dir) as folder:
+        save_csr(incidence, folder, 'incidence')
+        save_csr(incidence.T.tocsr(), folder, 'incidence_t')
+        np.save(f'{folder}/costs.npy', costs)
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_cooccurrence_shard, folder, incidence.shape, start, stop, max_val, max_nnz)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            starts = [future.result()[0] for future in futures]
+        return _merge_shards(folder, starts, n)
+
+
+@timing(printed_args=['n', 'workers'])
+def parallel_cooccurrence_matrix(df: pd.DataFrame, n: int, ids_col: str = 'index', workers: Optional[int] = None,
+                                 max_val: Optional[int] = None, max_nnz: Optional[int] = 10_000_000,
+                                 tmp_dir: Optional[str] = None) -> csr_matrix:
+    """
+    Parallel version of clusterisation.make_sparse_cooccurrence_matrix, see parallel_cooccurrence_from_incidence
+    :param df: DataFrame with column with categories (or infracategories) and column with list of ids, which belong to
+    each category
+    :param n: total amount of ids
+    :param ids_col: name of column with ids
+    :param workers: number of processes, os.cpu_count() by default
+    :param max_val: set if you want not to count common categories if there are more than max_val of them
+    :param max_nnz: maximum number of non-zero values in one block of product in each worker. None for no limit
+    :param tmp_dir: folder for temporary files (system temporary folder by default)
+    :return: sparce matrix n X n where value in cell (i, j) is amount of common categories of article i and article j
+    """
+    return parallel_cooccurrence_from_incidence(make_incidence_matrix(df, n, ids_col), workers, max_val, max_nnz,
+                                                tmp_dir)
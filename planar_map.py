@@ -0,0 +1,314 @@
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, spmatrix, diags
+from scipy.sparse.linalg import eigsh
+from sklearn.cluster import MiniBatchKMeans
+
+from category_filter import CategoryFilter, project_filter
+from category_graph import CategoryGraph, project_graph
+from clusterisation import drop_diagonal
+from knn import top_k_per_row, knn_to_csr
+from storage import write_stage_file
+from support_functions import data_path, timing
+
+MAP_STAGE = ('map', )
+
+
+def sparsify(similarity: spmatrix, k: Optional[int] = 15) -> csr_matrix:
+    """
+    Symmetric graph of k nearest neighbours: edge (i, j) is kept if j is in top k of i or i is in top k of j
+    :param similarity: sparse similarity matrix (or kNN graph from knn.knn_to_csr)
+    :param k: number of neighbours, None to keep all edges
+    :return: symmetric sparse matrix without diagonal
+    """
+    similarity = csr_matrix(similarity, dtype=np.float32)
+    if k is not None:
+        similarity = knn_to_csr(*top_k_per_row(similarity, k))
+    return drop_diagonal(similarity.maximum(similarity.T))
+
+
+def _move_nodes(indptr: list, indices: list, data: list, strength: list, m2: float, resolution: float,
+                order: list, max_passes: int) -> list:
+    """Local moving phase of Louvain: move nodes to community of neighbours with the biggest gain of modularity"""
+    labels = list(range(len(strength)))
+    totals = list(strength)
+    for _ in range(max_passes):
+        moved = 0
+        for i in order:
+            weights = {}
+            for p in range(indptr[i], indptr[i + 1]):
+                j = indices[p]
+                if j != i:
+                    c = labels[j]
+                    weights[c] = weights.get(c, 0.) + data[p]
+            current = labels[i]
+            k_i = strength[i] * resolution / m2
+            totals[current] -= strength[i]
+            best, best_gain = current, weights.get(current, 0.) - k_i * totals[current]
+            for c, w in weights.items():
+                gain = w - k_i * totals[c]
+                if gain > best_gain + 1e-12:
+                    best, best_gain = c, gain
+            totals[best] += strength[i]
+            if best != current:
+                labels[i] = best
+                moved += 1
+        if not moved:
+            break
+    return labels
+
+
+def aggregate(adjacency: csr_matrix, labels: np.ndarray) -> csr_matrix:
+    """Graph of communities: weight of edge (a, b) is sum of weights of edges between them, loops are inner weights"""
+    membership = csr_matrix((np.ones(len(labels), dtype=np.float32), (np.arange(len(labels)), labels)))
+    return (membership.T @ adjacency @ membership).tocsr()
+
+
+@timing(printed_args=['resolution'])
+def louvain_hierarchy(adjacency: spmatrix, resolution: float = 1., seed: int = 0, max_levels: int = 20,
+                      max_passes: int = 10) -> list[np.ndarray]:
+    """
+    Louvain community detection on sparse weighted graph. On each level nodes are moved to communities of their
+    neighbours while modularity grows, then communities become nodes of next level
+    :param adjacency: symmetric sparse matrix with weights of edges (like sparsify(similarity))
+    :param resolution: bigger resolution - smaller communities
+    :param seed: random seed of order of nodes
+    :param max_levels: maximum number of levels
+    :param max_passes: maximum number of passes over nodes on each level
+    :return: list of arrays: i-th array is community (node of next level) of each node of i-th level, so labels of
+    articles on level l are hierarchy[l][...hierarchy[1][hierarchy[0]]]
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    m2 = adjacency.sum()
+    hierarchy = []
+    while len(hierarchy) < max_levels and m2 > 0:
+        n = adjacency.shape[0]
+        strength = np.asarray(adjacency.sum(axis=1)).ravel()
+        labels = _move_nodes(adjacency.indptr.tolist(), adjacency.indices.tolist(), adjacency.data.tolist(),
+                             strength.tolist(), m2, resolution, rng.permutation(n).tolist(), max_passes)
+        _, labels = np.unique(labels, return_inverse=True)
+        if labels.max() + 1 == n:
+            break
+        hierarchy.append(labels)
+        adjacency = aggregate(adjacency, labels)
+    return hierarchy
+
+
+def hierarchy_labels(hierarchy: Sequence[np.ndarray], n: int, level: int = -1) -> np.ndarray:
+    """Community of each article on level of hierarchy (-1 for top level, i.e. maximum of modularity)"""
+    labels = np.arange(n)
+    for level_labels in hierarchy[:len(hierarchy) + level + 1 if level < 0 else level + 1]:
+        labels = level_labels[labels]
+    return labels
+
+
+def spectral_embedding(adjacency: spmatrix, dim: int = 2, seed: int = 0) -> np.ndarray:
+    """
+    Coordinates of nodes by eigenvectors of normalized adjacency matrix D^-1/2 A D^-1/2 with the biggest eigenvalues
+    (first, trivial, one is dropped). Small graphs are solved densely, big ones with ARPACK
+    :param adjacency: symmetric sparse matrix with weights of edges
+    :param dim: number of coordinates
+    :param seed: random seed of initial vector of ARPACK
+    :return: array nodes X dim
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float64)
+    n = adjacency.shape[0]
+    if n <= dim + 1:
+        return np.random.default_rng(seed).normal(size=(n, dim))
+    strength = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = diags(1 / np.sqrt(np.maximum(strength, 1e-12)))
+    normalized = scale @ adjacency @ scale
+    if n <= 2000:
+        _, vectors = np.linalg.eigh(normalized.toarray())
+        vectors = vectors[:, ::-1]
+    else:
+        v0 = np.random.default_rng(seed).uniform(-1, 1, n)
+        values, vectors = eigsh(normalized, k=dim + 1, which='LA', v0=v0, tol=1e-4)
+        vectors = vectors[:, np.argsort(-values)]
+    return scale @ vectors[:, 1: dim + 1]
+
+
+def spectral_clusters(adjacency: spmatrix, n_clusters: int, dim: Optional[int] = None, seed: int = 0) -> np.ndarray:
+    """
+    Spectral clustering: k-means on normalized rows of spectral embedding
+    :param adjacency: symmetric sparse matrix with weights of edges
+    :param n_clusters: number of clusters
+    :param dim: dimension of embedding, min(n_clusters, 50) by default
+    :param seed: random seed
+    :return: cluster label of each node
+    """
+    embedding = spectral_embedding(adjacency, dim or min(n_clusters, 50), seed)
+    embedding /= np.maximum(np.linalg.norm(embedding, axis=1, keepdims=True), 1e-12)
+    return MiniBatchKMeans(n_clusters, random_state=seed, n_init=3).fit_predict(embedding)
+
+
+def force_layout(adjacency: spmatrix, init: Optional[np.ndarray] = None, epochs: int = 200, negative: int = 5,
+                 repulsion: float = 1., learning_rate: float = 1., seed: int = 0) -> np.ndarray:
+    """
+    Force-directed 2D layout with UMAP-like forces: each node is attracted by its neighbours (weighted by similarity)
+    and is repelled from random sample of other nodes (negative sampling), so each epoch takes O(edges + nodes)
+    :param adjacency: symmetric sparse matrix with weights of edges
+    :param init: initial coordinates nodes X 2, random by default
+    :param epochs: number of epochs (learning rate decreases linearly to 0)
+    :param negative: number of repelling nodes sampled for each node in each epoch
+    :param repulsion: weight of repulsion relatively to attraction
+    :param learning_rate: initial learning rate
+    :param seed: random seed
+    :return: coordinates nodes X 2
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float32)
+    n = adjacency.shape[0]
+    rng = np.random.default_rng(seed)
+    rows = np.repeat(np.arange(n), np.diff(adjacency.indptr))
+    off_diagonal = rows != adjacency.indices
+    rows, cols, weights = rows[off_diagonal], adjacency.indices[off_diagonal], adjacency.data[off_diagonal]
+    inv_strength = 1 / np.maximum(np.bincount(rows, weights, minlength=n), 1e-12).astype(np.float32)
+    positions = rng.normal(scale=np.sqrt(n), size=(n, 2)) if init is None else np.array(init, dtype=np.float64)
+    positions = positions.astype(np.float32)
+    negative_rows = np.repeat(np.arange(n), negative)
+    for epoch in range(epochs):
+        diff = positions[rows] - positions[cols]
+        force = diff * (-2 * weights / (1 + (diff ** 2).sum(axis=1)))[:, None]
+        gradient = np.stack([np.bincount(rows, force[:, 0], n), np.bincount(rows, force[:, 1], n)], axis=1)
+        gradient *= inv_strength[:, None]
+        diff = positions[negative_rows] - positions[rng.integers(0, n, len(negative_rows))]
+        d2 = (diff ** 2).sum(axis=1)
+        force = diff * (2 * repulsion / negative / ((0.001 + d2) * (1 + d2)))[:, None]
+        gradient[:, 0] += np.bincount(negative_rows, force[:, 0], n)
+        gradient[:, 1] += np.bincount(negative_rows, force[:, 1], n)
+        positions += (learning_rate * (1 - epoch / epochs) * np.clip(gradient, -4, 4)).astype(np.float32)
+    return positions
+
+
+@timing()
+def multilevel_layout(adjacency: spmatrix, hierarchy: Optional[Sequence[np.ndarray]] = None, epochs: int = 200,
+                      negative: int = 5, repulsion: float = 1., seed: int = 0) -> np.ndarray:
+    """
+    2D layout of big graph: graph is coarsened by levels of communities (nodes of coarser graph are communities), the
+    coarsest graph is placed by spectral embedding and force_layout, then each level is initialized by positions of
+    its communities (with small jitter) and refined by force_layout
+    :param adjacency: symmetric sparse matrix with weights of edges
+    :param hierarchy: result of louvain_hierarchy, it is calculated if None
+    :param epochs: number of epochs of force_layout on each level
+    :param negative: number of repelling nodes sampled for each node in each epoch
+    :param repulsion: weight of repulsion relatively to attraction
+    :param seed: random seed
+    :return: coordinates nodes X 2
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float32)
+    if hierarchy is None:
+        hierarchy = louvain_hierarchy(adjacency, seed=seed)
+    graphs = [adjacency]
+    for labels in hierarchy:
+        graphs.append(aggregate(graphs[-1], labels))
+    rng = np.random.default_rng(seed)
+    coarsest = graphs[-1]
+    positions = spectral_embedding(coarsest, 2, seed)
+    positions *= np.sqrt(coarsest.shape[0]) / max(np.abs(positions).max(), 1e-12)
+    positions = force_layout(coarsest, positions, epochs, negative, repulsion, seed=seed)
+    for graph, labels in zip(graphs[-2::-1], hierarchy[::-1]):
+        scale = np.sqrt(graph.shape[0] / (labels.max() + 1))
+        positions = positions[labels] * scale + rng.normal(scale=0.5, size=(graph.shape[0], 2))
+        positions = force_layout(graph, positions, epochs, negative, repulsion, seed=seed)
+    return positions
+
+
+def cluster_names(categories: spmatrix, labels: np.ndarray, names: Sequence[str], top: int = 3,
+                  separator: str = ', ') -> list[str]:
+    """
+    Name clusters by their dominant categories
+    :param categories: binary matrix articles X categories (like first level of CategoryGraph, with filtered columns
+    removed)
+    :param labels: cluster label of each article (0..k-1)
+    :param names: names of categories (columns of categories matrix)
+    :param top: number of categories in name
+    :param separator: separator of categories in name
+    :return: name of each cluster: its most common categories, from the most common one
+    """
+    membership = csr_matrix((np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))))
+    indices, _ = top_k_per_row(membership @ csr_matrix(categories, dtype=np.float32), top)
+    return [separator.join(names[i] for i in row if i >= 0) for row in indices]
+
+
+def make_map(adjacency: spmatrix, titles: Optional[Sequence[str]] = None, categories: Optional[spmatrix] = None,
+             category_names: Optional[Sequence[str]] = None, method: str = 'louvain', resolution: float = 1.,
+             level: int = -1, n_clusters: Optional[int] = None, epochs: int = 200, negative: int = 5,
+             repulsion: float = 1., top: int = 3, seed: int = 0) -> pd.DataFrame:
+    """
+    Map of articles: coordinates from multilevel_layout and clusters, named by their dominant categories
+    :param adjacency: symmetric sparse similarity graph (see sparsify)
+    :param titles: titles of articles
+    :param categories: binary matrix articles X categories used to name clusters
+    :param category_names: names of columns of categories
+    :param method: 'louvain' (communities of louvain_hierarchy) or 'spectral' (spectral_clusters)
+    :param resolution: resolution of Louvain
+    :param level: level of Louvain hierarchy used as clusters, -1 for top one (maximum of modularity). Lower levels
+    give more and smaller clusters
+    :param n_clusters: number of clusters for 'spectral' method (number of Louvain communities by default)
+    :param epochs: number of epochs of force_layout on each level
+    :param negative: number of repelling nodes sampled for each node in each epoch
+    :param repulsion: weight of repulsion relatively to attraction
+    :param top: number of categories in names of clusters
+    :param seed: random seed
+    :return: DataFrame with columns title, x, y, cluster, cluster_name
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float32)
+    n = adjacency.shape[0]
+    hierarchy = louvain_hierarchy(adjacency, resolution, seed)
+    if method == 'louvain':
+        labels = hierarchy_labels(hierarchy, n, level)
+    elif method == 'spectral':
+        labels = spectral_clusters(adjacency, n_clusters or int(hierarchy_labels(hierarchy, n, level).max()) + 1,
+                                   seed=seed)
+    else:
+        raise ValueError(f'Unknown method {method}, use "louvain" or "spectral"')
+    positions = multilevel_layout(adjacency, hierarchy, epochs, negative, repulsion, seed)
+    res = pd.DataFrame({'title': titles if titles is not None else np.arange(n), 'x': positions[:, 0],
+                        'y': positions[:, 1], 'cluster': labels})
+    if categories is not None:
+        res['cluster_name'] = np.asarray(cluster_names(categories, labels, category_names, top), dtype=object)[labels]
+    return res
+
+
+def graph_map(graph: CategoryGraph, k: int = 15, mults: Optional[Sequence[float]] = None,
+              depth: Optional[int] = None, category_filter: Optional[CategoryFilter] = None,
+              max_nnz: Optional[int] = 10_000_000, **kwargs) -> pd.DataFrame:
+    """
+    Map of articles of CategoryGraph. Only k nearest neighbours of each article are calculated (CategoryGraph.knn), so
+    full similarity matrix is never built, and clusters are named by first-level categories, which passed filter
+    :param graph: index of project
+    :param k: number of neighbours of each article in similarity graph
+    :param mults: weight of each level, if None - all weights =1
+    :param depth: number of levels, len(mults) by default
+    :param category_filter: filter of too wide categories, English filter by default
+    :param max_nnz: maximum number of non-zero values in one block of rows of kNN calculation
+    :param kwargs: arguments of make_map (method, resolution, level, epochs, seed...)
+    :return: DataFrame with columns title, x, y, cluster, cluster_name
+    """
+    adjacency = sparsify(knn_to_csr(*graph.knn(k, mults, depth, category_filter, max_nnz)), None)
+    first_level, kept = graph.levels(1, category_filter)[0]
+    return make_map(adjacency, graph.titles, first_level[:, kept], graph.vocabulary.decode(kept), **kwargs)
+
+
+def project_map(project: str, stages_num: int, k: int = 15, mults: Optional[Sequence[float]] = None,
+                data_folder_name: str = 'data', lang: str = 'en', **kwargs) -> pd.DataFrame:
+    """
+    Map of project (see graph_map), saved as stage file <data_folder_name>/<project>/map
+    :param project: name of subfolder in data folder
+    :param stages_num: number of levels (1 for categories only, 2 for categories and infra1 etc.)
+    :param k: number of neighbours of each article in similarity graph
+    :param mults: weight of each level, if None - all weights =1
+    :param data_folder_name: name of data folder
+    :param lang: wikipedia language code, used to choose patterns of filtered categories
+    :param kwargs: arguments of make_map (method, resolution, level, epochs, seed...)
+    :return: DataFrame with columns title, x, y, cluster, cluster_name
+    """
+    graph = project_graph(project, stages_num, data_folder_name, lang)
+    res = graph_map(graph, k, mults, stages_num if mults is None else None,
+                    project_filter(project, lang, data_folder_name), **kwargs)
+    write_stage_file(res, data_path(MAP_STAGE, project, data_folder_name))
+    return res
@@ -1,42 +1,52 @@
-import json
 from typing import Optional
+from collections.abc import Callable
 import os
 from os.path import exists
 
 import requests
 import pandas as pd
 
+from category_cache import CategoryCache
+from fetcher import CategoryFetcher, KnownEdgesFetcher
+from instrumentation import span, count
+from sampler import sample_api
+from storage import read_stage_file, write_stage_file
+from vocabulary import update_project_vocabulary
 from support_functions import generate_stages, data_path, convert_lists, apply_with_interim_saving, regroup_categories
 
 
-def get_random_articles_titles(n: int, lang: str = 'en', id_: bool = False) -> pd.DataFrame:
+def get_random_articles_titles(n: int, lang: str = 'en', id_: bool = False, fetcher: Optional[CategoryFetcher] = None,
+                               path: Optional[str] = None) -> pd.DataFrame:
     """
-    Retrieve sample of n article titles from Wikipedia, using API
+    Retrieve sample of n article titles from Wikipedia, using API. Titles are collected to set, so duplicates are
+    removed in O(1) per title (see sampler.sample_api)
     :param n: number of articles
     :param lang: wikipedia language code, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
     :param id_: add column with internal wikipedia id
+    :param fetcher: CategoryFetcher, which is used for requests, CategoryFetcher() if None
+    :param path: file, to which titles are streamed while sampling, so interrupted sampling is continued
     :return: DataFrame with columns "title" and "id" (if id_ is True)
     """
-    session = requests.session()
-    api_address = f'https://{lang}.wikipedia.org/w/api.php?action=query&list=random&format=json&rnnamespace=0&rnlimit='
-    cols = ['id', 'title'] if id_ else ['title']
-    articles = pd.DataFrame(columns=cols)
-    while len(articles) < n:
-        response = session.get(api_address+str(min(500, n - len(articles))))  # maximum 500 article per request
-        batch = json.loads(response.content)['query']['random']
-        articles = pd.concat(
-            [articles, pd.DataFrame(batch)[cols]]).drop_duplicates().reset_index(drop=True)
-    return articles
-
-
-def get_category(title: str, lang: str = 'en', session: Optional[requests.Session] = None) -> list[str]:
+    return sample_api(n, lang, id_, path, fetcher)
+
+
+def get_category(title: str, lang: str = 'en', session: Optional[requests.Session] = None,
+                 cache: Optional[CategoryCache] = None) -> list[str]:
     """
     Retrieve categories of article by its caption using API. Only unhidden categories.
     :param title: title of article, as it shown on page
     :param lang: wikipedia language code, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
     :param session: use requests.Session() for massive retrieving
+    :param cache: persistent cache of categories, only titles which are not in cache will be requested from API
     :return: list of categories (without "Category:" prefix)
     """
+    if cache is not None:
+        cached = cache.get_many([title], lang)
+        if title in cached:
+            return cached[title]
+        categories = get_category(title, lang, session)
+        cache.set_many({title: categories}, lang)
+        return categories
     url = f"https://{lang}.wikipedia.org/w/api.php"
     params = {
         "action": "query",
@@ -49,7 +59,10 @@ def get_category(title: str, lang: str = 'en', session: Optional[requests.Sessio
     if session is None:
         session = requests.session()
 
-    data = session.get(url=url, params=params).json()["query"]["pages"]
+    response = session.get(url=url, params=params)
+    count('requests')
+    count('bytes', len(response.content))
+    data = response.json()["query"]["pages"]
     items_len = len(data.items())
     try:
         categories = [cat['title'].replace('Category:', '') for k, v in data.items() for cat in v['categories']]
@@ -62,7 +75,8 @@ def get_category(title: str, lang: str = 'en', session: Optional[requests.Sessio
 
 
 def get_category_mass(titles: list[str], lang: str = 'en', session: Optional[requests.Session] = None,
-                      n: int = 50, clcontinue: Optional[str] = None) -> dict[str, list[str]]:
+                      n: int = 50, clcontinue: Optional[str] = None,
+                      cache: Optional[CategoryCache] = None) -> dict[str, list[str]]:
     """
     Retrieve categories of article by its caption using API. Only unhidden categories.
     :param titles: list of titles of article, as it shown on page
@@ -70,8 +84,11 @@ def get_category_mass(titles: list[str], lang: str = 'en', session: Optional[req
     :param session: use requests.Session() for massive retrieving
     :param n: number of categories, retrieved per API query. For usual users 50 is maximum.
     :param clcontinue: if amount of categories is too big for one query, you should continue retrieving from this point
+    :param cache: persistent cache of categories, only titles which are not in cache will be requested from API
     :return: list of categories (without "Category:" prefix)
     """
+    if cache is not None and clcontinue is None:
+        return cache.fetch(titles, lang, get_category_mass, session=session, n=n)
     url = f"https://{lang}.wikipedia.org/w/api.php"
     params = {
         "action": "query",
@@ -92,7 +109,10 @@ def get_category_mass(titles: list[str], lang: str = 'en', session: Optional[req
             res.update(d)
         return res
 
-    data = session.get(url=url, params=params).json()
+    response = session.get(url=url, params=params)
+    count('requests')
+    count('bytes', len(response.content))
+    data = response.json()
     if 'continue' in data:
         clcontinue = data['continue']['clcontinue']
         second_batch = get_category_mass(titles, lang, session, n, clcontinue=clcontinue)
@@ -111,7 +131,10 @@ def get_category_mass(titles: list[str], lang: str = 'en', session: Optional[req
 
 
 def get_articles_with_infracategories(articles_num, number_of_infracategories, project,
-                                      data_folder_name='data', final_stage='final') -> None:
+                                      data_folder_name='data', final_stage='final',
+                                      fetcher: Optional[Callable] = None,
+                                      cache: Optional[CategoryCache] = None,
+                                      deduplicate: bool = True, lang: str = 'en') -> None:
     """
     Get articles title, categories for each title, categories of their categories (infracategories) and so on.
     Data will be saved in folder <data_folder_name>/<project> in multiple csv files with next structure
@@ -127,62 +150,74 @@ def get_articles_with_infracategories(articles_num, number_of_infracategories, p
     :param project: name of subfolder in data folder, where all files will be saved
     :param data_folder_name: name of data folder (just "data" by default)
     :param final_stage: name of final stage and it (plus .csv) will be the name of resulting file
+    :param fetcher: function with the same signature as get_category_mass, which is used for retrieving, for example
+    fetcher.CategoryFetcher() for concurrent retrieving. get_category_mass by default
+    :param cache: persistent cache of categories, shared by all projects, for example
+    CategoryCache(f'{data_folder_name}/category_cache.sqlite')
+    :param deduplicate: on infra levels request only categories, which were not requested on previous levels (see
+    fetcher.KnownEdgesFetcher)
+    :param lang: wikipedia language code, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
     :return: None
     """
+    if fetcher is None:
+        fetcher = get_category_mass
+    infra_fetcher = KnownEdgesFetcher(fetcher) if deduplicate else fetcher
     stages = generate_stages(number_of_infracategories, final_stage)
-    if not exists(data_folder_name):
-        os.mkdir(data_folder_name)
-    if not exists(f'{data_folder_name}/{project}'):
-        os.mkdir(f'{data_folder_name}/{project}')
+    os.makedirs(f'{data_folder_name}/{project}', exist_ok=True)
+    session = requests.session()  # one pool of connections for all stages (CategoryFetcher uses its own)
     prev_stage = None
     for stage_num, stage in enumerate(stages):
-        path = data_path(stage, project)
+        path = data_path(stage, project, data_folder_name)
         if not exists(path):
-            if stage_num == 0:
-                print('Starting stage 0...')
-                df = get_random_articles_titles(articles_num)
-                df.to_csv(path, index=False)
-            elif stage_num == 1:
-                try:
-                    print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
-                except NameError:
-                    df = pd.read_csv(data_path(prev_stage, project), dtype=str)
-                    print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
-                df = df.reset_index()
-                df = df[['title', 'index']]
-                df = apply_with_interim_saving(df, f=get_category_mass, col_to_apply=stage[0], new_col=stage[1],
-                                               csv_name=data_path(stage, project), session=requests.session(),
-                                               one_by_one=False)
+            with span(f'stage {stage_num}', stage='_with_'.join(stage), project=project, lang=lang):
+                if stage_num == 0:
+                    print('Starting stage 0...')
+                    df = get_random_articles_titles(articles_num, lang, path=f'{path}.part',
+                                                    fetcher=fetcher if isinstance(fetcher, CategoryFetcher) else None)
+                    write_stage_file(df, path)
+                    if exists(f'{path}.part'):
+                        os.remove(f'{path}.part')
+                elif stage_num == 1:
+                    try:
+                        print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
+                    except NameError:
+                        df = read_stage_file(data_path(prev_stage, project, data_folder_name), dtype=str)
+                        print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
+                    df = df.reset_index()
+                    df = df[['title', 'index']]
+                    df = apply_with_interim_saving(df, f=fetcher, col_to_apply=stage[0], new_col=stage[1],
+                                                   csv_name=path, session=session, cache=cache,
+                                                   one_by_one=False, lang=lang)
+                    update_project_vocabulary(df, [stage[1]], project, data_folder_name)
 
-            else:
-                try:
-                    print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
-                except NameError:
-                    print(f'Loading data from {data_path(prev_stage, project)}')
-                    df = pd.read_csv(data_path(prev_stage, project), dtype=str)
-                    df = convert_lists(df, prev_stage[1])
-                    df = apply_with_interim_saving(
-                        df, f=get_category_mass, col_to_apply=prev_stage[0], new_col=prev_stage[1],
-                        csv_name=data_path(prev_stage, project), session=requests.session(), one_by_one=False
-                    )
-                    print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
-                df = regroup_categories(df, cat_col=prev_stage[1], id_col='index', lists=stage_num != 2)
-                if stage_num == len(stages) - 1:
-                    res = []
-                    for stage_ in stages[1:-1]:
-                        df_ = pd.read_csv(data_path(stage_, project), dtype=str)
-                        df_ = convert_lists(df_, stage_[1])
-                        df_ = regroup_categories(df_.reset_index(), cat_col=stage_[1], id_col='index',
-                                                 lists=stage_ != stages[1])
-                        df_.columns = ['obj', 'ids']
-                        df_['obj_name'] = stage_[1]
-                        res.append(df_)
-                    pd.concat(res).to_csv(path, index=False)
-                    print('Final stage complete')
-                    break
-                df = apply_with_interim_saving(df, f=get_category_mass, col_to_apply=stage[0], new_col=stage[1],
-                                               csv_name=data_path(stage, project), session=requests.session(),
-                                               one_by_one=False)
+                else:
+                    try:
+                        print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
+                    except NameError:
+                        prev_path = data_path(prev_stage, project, data_folder_name)
+                        print(f'Loading data from {prev_path}')
+                        df = read_stage_file(prev_path, dtype=str)
+                        df = convert_lists(df, prev_stage[1])
+                        if deduplicate:
+                            infra_fetcher.set_level(stage_num - 1)
+                        df = apply_with_interim_saving(
+                            df, f=fetcher if stage_num == 2 else infra_fetcher, col_to_apply=prev_stage[0],
+                            new_col=prev_stage[1], csv_name=prev_path, session=session, cache=cache,
+                            one_by_one=False, lang=lang
+                        )
+                        update_project_vocabulary(df, [prev_stage[1]], project, data_folder_name)
+                        print(f'Starting stage {stage_num}. Process {len(df)} rows({stage[0]})...')
+                    df = regroup_categories(df, cat_col=prev_stage[1], id_col='index', lists=stage_num != 2)
+                    if stage_num == len(stages) - 1:
+                        make_final_stage(stages, project, data_folder_name)
+                        print('Final stage complete')
+                        break
+                    if deduplicate:
+                        infra_fetcher.set_level(stage_num)
+                    df = apply_with_interim_saving(df, f=infra_fetcher, col_to_apply=stage[0], new_col=stage[1],
+                                                   csv_name=path, session=session, cache=cache,
+                                                   one_by_one=False, lang=lang)
+                    update_project_vocabulary(df, [stage[1]], project, data_folder_name)
         else:
             if stage_num > 1:
                 print('Stage complete')
@@ -193,7 +228,35 @@ def get_articles_with_infracategories(articles_num, number_of_infracategories, p
             else:
                 print(f'Stage {stage_num} (get {stage[1]} for {stage[0]}) already start processed,',
                       f'check file completeness')
+                if deduplicate and stage_num > 1:
+                    df_ = convert_lists(read_stage_file(path, dtype=str), stage[1])
+                    infra_fetcher.add_known(df_[stage[0]], df_[stage[1]])
         prev_stage = stage
+    if cache is not None:
+        print(f'Category cache: {cache.stats()}')
+    if deduplicate and infra_fetcher.level_stats:
+        print(f'Requests saved by deduplication of categories:\n{infra_fetcher.stats().to_string()}')
+
+
+def make_final_stage(stages: list[tuple[str, ...]], project: str, data_folder_name: str = 'data') -> None:
+    """
+    Group all stage files of the project into one final file with columns "obj"|"ids"|"obj_name", where "obj" is
+    category (or infracategory), "ids" is list of ids of articles, which belong to it, and "obj_name" is level
+    :param stages: list of stages, as returned by generate_stages
+    :param project: name of subfolder in data folder, where all files are saved
+    :param data_folder_name: name of data folder (just "data" by default)
+    :return: None
+    """
+    res = []
+    for stage_ in stages[1:-1]:
+        df_ = read_stage_file(data_path(stage_, project, data_folder_name), dtype=str)
+        df_ = convert_lists(df_, stage_[1])
+        df_ = regroup_categories(df_.reset_index(), cat_col=stage_[1], id_col='index',
+                                 lists=stage_ != stages[1])
+        df_.columns = ['obj', 'ids']
+        df_['obj_name'] = stage_[1]
+        res.append(df_)
+    write_stage_file(pd.concat(res), data_path(stages[-1], project, data_folder_name))
 
 
 def get_article_text(title: str, lang: str = 'en', sentences: int = 10,
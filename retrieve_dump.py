@@ -0,0 +1,291 @@
+import gzip
+import os
+import random
+import re
+from collections.abc import Hashable, Iterator, Sequence
+from os.path import exists
+from typing import Optional, Union
+
+import pandas as pd
+
+from support_functions import generate_stages, data_path, convert_lists, regroup_categories
+from retrieve import make_final_stage
+from sampler import Reservoir, allocate
+from storage import read_stage_file, write_stage_file
+from vocabulary import update_project_vocabulary
+
+_COLUMN = re.compile(r'\s+`(\w+)`')
+_INSERT = re.compile(r'INSERT INTO `(\w+)` VALUES ')
+_TOKEN = re.compile(r"\(|\)|'(?:[^'\\]|\\.)*'|[^,()']+", re.DOTALL)
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+
+
+def _open_dump(path: str):
+    """Open .sql or .sql.gz dump as text stream"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def _convert_token(token: str):
+    """Convert one SQL literal to python value"""
+    if token[0] == "'":
+        value = token[1:-1]
+        if '\\' in value:
+            value = _ESCAPE.sub(lambda m: _ESCAPES.get(m.group(1), m.group(1)), value)
+        return value
+    if token == 'NULL':
+        return None
+    try:
+        return int(token)
+    except ValueError:
+        return float(token)
+
+
+def iter_dump_rows(path: str, columns: Sequence[str]) -> Iterator[tuple]:
+    """
+    Stream rows of MediaWiki SQL dump (like enwiki-latest-categorylinks.sql.gz) one by one, without loading the
+    dump in memory. Positions of columns are taken from CREATE TABLE statement of the dump, so it doesn't depend on
+    order of columns in specific dump version
+    :param path: path to .sql or .sql.gz dump file
+    :param columns: names of columns to return, like ['cl_from', 'cl_to']
+    :return: iterator of tuples with values of requested columns
+    """
+    table_columns = []
+    positions = None
+    with _open_dump(path) as f:
+        for line in f:
+            if line.startswith('CREATE TABLE'):
+                table_columns = []
+                for column_line in f:
+                    if column_line.startswith(')'):
+                        break
+                    match = _COLUMN.match(column_line)
+                    if match:
+                        table_columns.append(match.group(1))
+                continue
+            if not line.startswith('INSERT INTO'):
+                continue
+            if positions is None:
+                missing = [col for col in columns if col not in table_columns]
+                if missing:
+                    raise ValueError(f'Columns {missing} not found in dump {path} (found {table_columns})')
+                positions = [table_columns.index(col) for col in columns]
+            row = None
+            for token in _TOKEN.findall(line, _INSERT.match(line).end()):
+                if token == '(':
+                    row = []
+                elif token == ')':
+                    yield tuple(row[pos] for pos in positions)
+                    row = None
+                elif row is not None:
+                    row.append(_convert_token(token))
+
+
+def _normalize_title(title: str) -> str:
+    """Dumps store titles with underscores, API returns them with spaces"""
+    return title.replace('_', ' ')
+
+
+def read_hidden_category_ids(page_props_dump: str) -> set[int]:
+    """
+    Get page ids of hidden categories (which have "hiddencat" page property)
+    :param page_props_dump: path to page_props dump (like enwiki-latest-page_props.sql.gz)
+    :return: set of page ids of hidden categories
+    """
+    return {page for page, prop in iter_dump_rows(page_props_dump, ['pp_page', 'pp_propname']) if prop == 'hiddencat'}
+
+
+def read_pages(page_dump: str, articles_num: Optional[int] = None, titles: Optional[set[str]] = None,
+               hidden_ids: Optional[set[int]] = None,
+               seed: Optional[int] = None) -> tuple[dict[int, str], dict[str, int], set[str]]:
+    """
+    Read page dump in one pass: sample articles (namespace 0, without redirects), collect ids of all category pages
+    and titles of hidden categories
+    :param page_dump: path to page dump (like enwiki-latest-page.sql.gz)
+    :param articles_num: size of random sample of articles (reservoir sampling), None for all articles
+    :param titles: if set, take articles with these titles instead of random sample
+    :param hidden_ids: page ids of hidden categories, see read_hidden_category_ids
+    :param seed: random seed for sample of articles
+    :return: dict of article ids and titles, dict of category titles (without "Category:" prefix) and their page ids,
+    set of hidden category titles
+    """
+    rng = random.Random(seed)
+    hidden_ids = hidden_ids or set()
+    articles, category_ids, hidden = {}, {}, set()
+    reservoir = Reservoir(articles_num, rng) if articles_num is not None else None
+    for page_id, namespace, title, is_redirect in iter_dump_rows(
+            page_dump, ['page_id', 'page_namespace', 'page_title', 'page_is_redirect']):
+        if namespace == 14:
+            title = _normalize_title(title)
+            category_ids[title] = page_id
+            if page_id in hidden_ids:
+                hidden.add(title)
+        elif namespace == 0 and not is_redirect:
+            if titles is not None:
+                title = _normalize_title(title)
+                if title in titles:
+                    articles[page_id] = title
+            elif articles_num is None:
+                articles[page_id] = _normalize_title(title)
+            else:
+                reservoir.offer((page_id, title))
+    if reservoir is not None:
+        articles.update({page_id: _normalize_title(title) for page_id, title in reservoir.items})
+    return articles, category_ids, hidden
+
+
+def page_strata(categorylinks_dump: str, category_strata: dict[str, Hashable]) -> dict[int, Hashable]:
+    """
+    Strata of pages by their categories, for stratified sampling (see sample_dump). Page gets stratum of the first of
+    its categories (in order of dump), which is in category_strata. To stratify by top-level categories, map each
+    top-level category and its subcategories (for example, from CategoryGraph of previous crawl) to its stratum
+    :param categorylinks_dump: path to categorylinks dump (like enwiki-latest-categorylinks.sql.gz)
+    :param category_strata: dict category title (without "Category:" prefix): stratum
+    :return: dict page id: stratum, pages without such categories are absent
+    """
+    category_strata = {title.replace(' ', '_'): stratum for title, stratum in category_strata.items()}
+    strata = {}
+    for page_id, category in iter_dump_rows(categorylinks_dump, ['cl_from', 'cl_to']):
+        if page_id not in strata and category in category_strata:
+            strata[page_id] = category_strata[category]
+    return strata
+
+
+def sample_dump(page_dump: str, n: int, seed: Optional[int] = None, namespaces: Sequence[int] = (0, ),
+                strata: Optional[Union[str, dict[int, Hashable]]] = None, sizes: Optional[dict[Hashable, int]] = None,
+                redirects: bool = False) -> pd.DataFrame:
+    """
+    Random sample of pages from page dump in one pass (reservoir sampling, see sampler.Reservoir), memory is O(n)
+    whatever size of dump is, and the same seed gives the same sample of the same dump. Sample could be stratified by
+    namespace or by any page strata (like top-level categories, see page_strata). Stage file of titles could be
+    created from it, then get_articles_with_infracategories retrieves categories of these articles
+    :param page_dump: path to page dump (like enwiki-latest-page.sql.gz)
+    :param n: size of sample
+    :param seed: random seed
+    :param namespaces: namespaces of pages (0 - articles, 14 - categories)
+    :param strata: None for simple sample, "namespace" for stratification by namespace or dict page id: stratum, pages
+    absent in dict are stratum None
+    :param sizes: size of sample of each stratum, strata absent in sizes are skipped. If None, n is allocated to strata
+    proportionally to their sizes (each stratum keeps reservoir of n pages till the end of dump)
+    :param redirects: sample redirects too
+    :return: DataFrame with columns id, namespace, title (and stratum, if strata is dict), sorted by id
+    """
+    rng = random.Random(seed)
+    namespaces = set(namespaces)
+    reservoirs = {}
+    for page_id, namespace, title, is_redirect in iter_dump_rows(
+            page_dump, ['page_id', 'page_namespace', 'page_title', 'page_is_redirect']):
+        if namespace not in namespaces or (is_redirect and not redirects):
+            continue
+        if strata is None:
+            key = None
+        elif strata == 'namespace':
+            key = namespace
+        else:
+            key = strata.get(page_id)
+        reservoir = reservoirs.get(key)
+        if reservoir is None:
+            if sizes is not None and key not in sizes:
+                continue
+            reservoir = reservoirs[key] = Reservoir(n if sizes is None else sizes[key], rng)
+        reservoir.offer((page_id, namespace, title))
+    if strata is not None and sizes is None:
+        quotas = allocate({key: reservoir.seen for key, reservoir in reservoirs.items()}, n)
+        samples = {key: rng.sample(reservoir.items, quotas[key]) for key, reservoir in reservoirs.items()}
+    else:
+        samples = {key: reservoir.items for key, reservoir in reservoirs.items()}
+    df = pd.DataFrame([(*page, key) for key, pages in samples.items() for page in pages],
+                      columns=['id', 'namespace', 'title', 'stratum'])
+    df['title'] = df['title'].map(_normalize_title)
+    df = df.sort_values('id', ignore_index=True)
+    return df if isinstance(strata, dict) else df.drop(columns='stratum')
+
+
+def read_category_links(categorylinks_dump: str, pages: dict[int, str],
+                        hidden: Optional[set[str]] = None) -> dict[str, list[str]]:
+    """
+    Get unhidden categories of given pages from categorylinks dump, in the same form as get_category_mass returns
+    :param categorylinks_dump: path to categorylinks dump (like enwiki-latest-categorylinks.sql.gz)
+    :param pages: dict of page ids and titles, which will be keys of resulting dict
+    :param hidden: set of hidden category titles, see read_pages
+    :return: dict title: list of categories (without "Category:" prefix)
+    """
+    hidden = hidden or set()
+    categories = {title: [] for title in pages.values()}
+    for page_id, category in iter_dump_rows(categorylinks_dump, ['cl_from', 'cl_to']):
+        if page_id in pages:
+            category = _normalize_title(category)
+            if category not in hidden:
+                categories[pages[page_id]].append(category)
+    return {title: sorted(cats) for title, cats in categories.items()}
+
+
+def get_articles_with_infracategories_from_dump(articles_num: Optional[int], number_of_infracategories: int,
+                                                project: str, page_dump: str, categorylinks_dump: str,
+                                                page_props_dump: str, data_folder_name: str = 'data',
+                                                final_stage: str = 'final', seed: Optional[int] = None) -> None:
+    """
+    Same as retrieve.get_articles_with_infracategories, but all data is read from Wikipedia SQL dumps instead of API.
+    Dumps are streamed row by row, so they are never loaded in memory. Each level of infracategories takes one pass
+    over categorylinks dump. Stage files have the same structure as API ones, so all other functions could use them
+    Dumps could be downloaded from https://dumps.wikimedia.org/enwiki/latest/
+    :param articles_num: how many articles do you want to have, None for all articles of Wikipedia
+    :param number_of_infracategories: 0 means that there will be only categories,
+    1 for categories and categories of categories etc.
+    :param project: name of subfolder in data folder, where all files will be saved
+    :param page_dump: path to page dump (enwiki-latest-page.sql.gz)
+    :param categorylinks_dump: path to categorylinks dump (enwiki-latest-categorylinks.sql.gz)
+    :param page_props_dump: path to page_props dump (enwiki-latest-page_props.sql.gz), used to find hidden categories
+    :param data_folder_name: name of data folder (just "data" by default)
+    :param final_stage: name of final stage and it (plus .csv) will be the name of resulting file
+    :param seed: random seed for sample of articles
+    :return: None
+    """
+    stages = generate_stages(number_of_infracategories, final_stage)
+    os.makedirs(f'{data_folder_name}/{project}', exist_ok=True)
+    titles_path = data_path(stages[0], project, data_folder_name)
+    titles = set(read_stage_file(titles_path, dtype=str)['title']) if exists(titles_path) else None
+
+    print('Reading hidden categories...')
+    hidden_ids = read_hidden_category_ids(page_props_dump)
+    print(f'{len(hidden_ids)} hidden categories found. Reading pages...')
+    articles, category_ids, hidden = read_pages(page_dump, articles_num, titles, hidden_ids, seed)
+    print(f'{len(articles)} articles and {len(category_ids)} categories found')
+
+    prev_stage = None
+    df = None
+    for stage_num, stage in enumerate(stages[:-1]):
+        path = data_path(stage, project, data_folder_name)
+        if exists(path):
+            print(f'Stage {stage_num} already processed, loading {path}')
+            df = read_stage_file(path, dtype=str)
+            if stage_num > 0:
+                df = convert_lists(df, stage[1])
+            prev_stage = stage
+            continue
+        print(f'Starting stage {stage_num}...')
+        if stage_num == 0:
+            df = pd.DataFrame({'title': list(articles.values())})
+        elif stage_num == 1:
+            df = df.reset_index()[['title', 'index']]
+            article_ids = {title: page_id for page_id, title in articles.items()}
+            pages = {article_ids[title]: title for title in df['title'] if title in article_ids}
+            df[stage[1]] = df['title'].map(read_category_links(categorylinks_dump, pages, hidden))
+            df[stage[1]] = df[stage[1]].apply(lambda x: x if isinstance(x, list) else [])
+        else:
+            df = regroup_categories(df, cat_col=prev_stage[1], id_col='index', lists=stage_num != 2)
+            pages = {}
+            for category in df[stage[0]]:
+                title = category.replace('Category:', '', 1)
+                if title in category_ids:
+                    pages[category_ids[title]] = category
+            parents = read_category_links(categorylinks_dump, pages, hidden)
+            df[stage[1]] = df[stage[0]].apply(lambda x: parents.get(x, []))
+        write_stage_file(df, path)
+        if stage_num > 0:
+            update_project_vocabulary(df, [stage[1]], project, data_folder_name)
+        prev_stage = stage
+    make_final_stage(stages, project, data_folder_name)
+    print('Final stage complete')
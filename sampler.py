@@ -0,0 +1,162 @@
+import math
+import os
+import random
+from collections.abc import Hashable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists
+from typing import Optional
+
+import pandas as pd
+
+from fetcher import CategoryFetcher
+from instrumentation import context_map
+
+
+class Reservoir:
+    """
+    Uniform random sample of k items from stream of unknown length (reservoir sampling, algorithm L): after reservoir
+    is filled, number of items to skip is drawn at once, so random numbers are generated only O(k log(N / k)) times
+    """
+    def __init__(self, k: int, rng: random.Random):
+        """
+        :param k: size of sample
+        :param rng: random generator (the same seed and stream give the same sample)
+        """
+        self.k = k
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+        self._w = 1.
+        self._next = None
+
+    def _skip(self) -> None:
+        self._w *= math.exp(math.log(1 - self.rng.random()) / self.k)
+        self._next += math.floor(math.log(1 - self.rng.random()) / math.log1p(-self._w)) + 1 if self._w < 1 else 1
+
+    def offer(self, item) -> None:
+        """Add next item of stream"""
+        self.seen += 1
+        if len(self.items) < self.k:
+            self.items.append(item)
+            if len(self.items) == self.k:
+                self._next = self.seen
+                self._skip()
+        elif self.seen == self._next:
+            self.items[self.rng.randrange(self.k)] = item
+            self._skip()
+
+
+def allocate(sizes: dict[Hashable, int], n: int) -> dict[Hashable, int]:
+    """
+    Proportional allocation of sample of n items to strata (largest remainder method, equal remainders are given to
+    strata in order of sizes)
+    :param sizes: number of items in each stratum
+    :param n: size of sample
+    :return: size of sample of each stratum
+    """
+    total = sum(sizes.values())
+    if total <= n:
+        return dict(sizes)
+    quotas = {key: n * size / total for key, size in sizes.items()}
+    res = {key: int(quota) for key, quota in quotas.items()}
+    for key in sorted(quotas, key=lambda key: res[key] - quotas[key])[:n - sum(res.values())]:
+        res[key] += 1
+    return res
+
+
+class TitleSink:
+    """
+    Set of sampled titles, which is streamed to text file (line "<page id>\\t<title>" for each title, in order of
+    adding), so sample of millions of titles is accumulated in O(n) and interrupted sampling is continued from the
+    file. Torn last line (if process was killed while writing) is removed on opening
+    """
+    def __init__(self, path: Optional[str] = None, overwrite: bool = False):
+        """
+        :param path: path of file, if None titles are kept only in memory
+        :param overwrite: start new sample instead of continuing of saved one
+        """
+        self.path = path
+        self.titles = {}
+        self._file = None
+        if path is None:
+            return
+        if exists(path) and not overwrite:
+            with open(path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    f.truncate(end)
+            for line in data[:end].decode('utf-8').splitlines():
+                page_id, title = line.split('\t', 1)
+                self.titles.setdefault(title, int(page_id) if page_id else None)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'w' if overwrite else 'a', encoding='utf-8')
+
+    def add(self, pages: Iterable[tuple[Optional[int], str]]) -> int:
+        """
+        Add pages, which were not added before
+        :param pages: pairs (page id or None, title)
+        :return: number of new titles
+        """
+        lines = []
+        for page_id, title in pages:
+            if title not in self.titles:
+                self.titles[title] = page_id
+                lines.append(f'{"" if page_id is None else page_id}\t{title}\n')
+        if self._file is not None and lines:
+            self._file.write(''.join(lines))
+            self._file.flush()
+        return len(lines)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def to_frame(self, id_: bool = False, n: Optional[int] = None) -> pd.DataFrame:
+        """DataFrame with columns "title" and "id" (if id_ is True) with first n titles (all by default)"""
+        titles = list(self.titles)[:n]
+        if not id_:
+            return pd.DataFrame({'title': titles})
+        return pd.DataFrame({'id': [self.titles[title] for title in titles], 'title': titles})
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def sample_api(n: int, lang: str = 'en', id_: bool = False, path: Optional[str] = None,
+               fetcher: Optional[CategoryFetcher] = None, namespace: int = 0, max_stale: int = 20) -> pd.DataFrame:
+    """
+    Random sample of titles from API (list=random). Batches of 500 titles are requested concurrently by fetcher (with
+    its rate limit and retries) and collected to TitleSink, so duplicates are removed in O(1) per title. Wikipedia
+    chooses random pages on server side, so sample can't be reproduced by seed (use retrieve_dump.sample_dump for it),
+    but with path it is saved and interrupted sampling is continued
+    :param n: number of titles
+    :param lang: wikipedia language code, from https://meta.wikimedia.org/wiki/Table_of_Wikimedia_projects
+    :param id_: add column with internal wikipedia id
+    :param path: file, to which titles are streamed (see TitleSink)
+    :param fetcher: CategoryFetcher, which is used for requests (its api_url, pool of connections and rate limit)
+    :param namespace: namespace of pages (0 - articles)
+    :param max_stale: stop, if this number of requests in a row gave no new titles (sample is bigger than wiki)
+    :return: DataFrame with columns "title" and "id" (if id_ is True)
+    """
+    fetcher = fetcher or CategoryFetcher()
+    url = fetcher.api_url.format(lang=lang)
+    sink = TitleSink(path)
+
+    def request(limit: int) -> list[tuple[int, str]]:
+        params = {'action': 'query', 'format': 'json', 'list': 'random', 'rnnamespace': namespace, 'rnlimit': limit}
+        return [(page['id'], page['title']) for page in fetcher.get(url, params)['query']['random']]
+
+    stale = 0
+    with ThreadPoolExecutor(max_workers=fetcher.max_in_flight) as executor:
+        while len(sink) < n and stale < max_stale:
+            missing = n - len(sink)
+            limits = [min(500, missing - start) for start in range(0, missing, 500)][:fetcher.max_in_flight]
+            for pages in context_map(executor, request, limits):
+                stale = 0 if sink.add(pages) else stale + 1
+    sink.close()
+    if len(sink) < n:
+        print(f'Only {len(sink)} titles were found, no new titles in {max_stale} requests')
+    return sink.to_frame(id_, n)
@@ -0,0 +1,142 @@
+import json
+import os
+from os.path import exists
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from storage import save_csr, read_stage_file, write_stage_file
+
+STORE_FOLDER = 'jaccard'
+_MATRIX = 'matrix'
+_ARTICLES = 'articles.npz'
+
+
+def _gather_rows(indptr: np.ndarray, indices: np.ndarray, data: np.ndarray,
+                 rows: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Arrays of CSR matrix with selected rows. Only parts of indices and data of these rows are read"""
+    starts, ends = indptr[rows], indptr[rows + 1]
+    lengths = ends - starts
+    new_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_indptr[1:])
+    if len(rows) and (np.diff(rows) == 1).all():  # consecutive rows are one contiguous part of arrays
+        return np.asarray(indices[starts[0]: ends[-1]]), np.asarray(data[starts[0]: ends[-1]]), new_indptr
+    positions = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return indices[positions], data[positions], new_indptr
+
+
+class MemmapCSR:
+    """
+    Read-only sparse matrix, which arrays (indptr, indices, data) are memory-mapped .npy files. Rows are read only
+    when they are requested, so several processes could use one matrix through page cache. Submatrix (selection of
+    rows and columns) is lazy too: it is applied to each requested block of rows
+    """
+    def __init__(self, folder: str, rows: Optional[np.ndarray] = None, cols: Optional[np.ndarray] = None):
+        """
+        :param folder: folder with matrix saved by save
+        :param rows: ids of rows of saved matrix, which are rows of this matrix (all by default)
+        :param cols: ids of columns of saved matrix, which are columns of this matrix (all by default)
+        """
+        self.folder = folder
+        with open(f'{folder}/{_MATRIX}.json') as f:
+            self.base_shape = tuple(json.load(f)['shape'])
+        self.indptr = np.load(f'{folder}/{_MATRIX}_indptr.npy', mmap_mode='r')
+        self.indices = np.load(f'{folder}/{_MATRIX}_indices.npy', mmap_mode='r')
+        self.data = np.load(f'{folder}/{_MATRIX}_data.npy', mmap_mode='r')
+        self.rows = np.arange(self.base_shape[0]) if rows is None else np.asarray(rows)
+        self.cols = cols if cols is None else np.asarray(cols)
+        if self.cols is not None:
+            self._col_map = np.full(self.base_shape[1], -1, dtype=np.int64)
+            self._col_map[self.cols] = np.arange(len(self.cols))
+
+    @staticmethod
+    def save(matrix: csr_matrix, folder: str) -> None:
+        """Save sparse matrix as .npy files, description is written last, so half-saved matrix isn't opened"""
+        matrix = csr_matrix(matrix)
+        matrix.sort_indices()
+        os.makedirs(folder, exist_ok=True)
+        if exists(f'{folder}/{_MATRIX}.json'):
+            os.remove(f'{folder}/{_MATRIX}.json')
+        save_csr(matrix, folder, _MATRIX)
+        with open(f'{folder}/{_MATRIX}.json', 'w') as f:
+            json.dump({'shape': matrix.shape, 'nnz': int(matrix.nnz)}, f)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.rows), self.base_shape[1] if self.cols is None else len(self.cols)
+
+    def select(self, rows: Union[np.ndarray, pd.Series], cols: Optional[Union[np.ndarray, pd.Series]] = None,
+               square: bool = True) -> 'MemmapCSR':
+        """
+        Lazy submatrix, like matrix[rows][:, cols]
+        :param rows: boolean mask or ids of rows
+        :param cols: boolean mask or ids of columns, if None - same as rows for square matrix, or all columns
+        :param square: if cols is None, select same columns as rows (as for matrix of similarity of articles)
+        :return: MemmapCSR
+        """
+        rows = self._ids(rows, len(self.rows))
+        if cols is not None:
+            cols = self._ids(cols, self.shape[1])
+        elif square:
+            cols = rows
+        if cols is not None and self.cols is not None:
+            cols = self.cols[cols]
+        elif cols is None:
+            cols = self.cols
+        return MemmapCSR(self.folder, self.rows[rows], cols)
+
+    @staticmethod
+    def _ids(selection: Union[np.ndarray, pd.Series, slice, int], size: int) -> np.ndarray:
+        if isinstance(selection, slice):
+            return np.arange(size)[selection]
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            return np.flatnonzero(selection)
+        return np.atleast_1d(selection).astype(np.int64)
+
+    def __getitem__(self, rows: Union[np.ndarray, pd.Series, slice, int]) -> csr_matrix:
+        """Load selected rows (slice, ids or boolean mask) as csr_matrix"""
+        rows = self._ids(rows, len(self.rows))
+        indices, data, indptr = _gather_rows(self.indptr, self.indices, self.data, self.rows[rows])
+        if self.cols is not None:
+            new_cols = self._col_map[indices]
+            kept = new_cols >= 0
+            row_ids = np.repeat(np.arange(len(rows)), np.diff(indptr))[kept]
+            indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(row_ids, minlength=len(rows)), out=indptr[1:])
+            indices, data = new_cols[kept], data[kept]
+        return csr_matrix((data, indices, indptr), shape=(len(rows), self.shape[1]))
+
+    def tocsr(self) -> csr_matrix:
+        """Load whole matrix (or submatrix) to memory"""
+        return self[:]
+
+
+def save_similarity(df: pd.DataFrame, matrix: csr_matrix, project: str, data_folder_name: str = 'data',
+                    rows: Optional[np.ndarray] = None) -> None:
+    """
+    Save result of leveled_jaccard_similarity to <data_folder_name>/<project>/jaccard
+    :param df: DataFrame with articles (rows of matrix after selection)
+    :param matrix: sparse matrix with Jaccard similarities
+    :param project: name of subfolder in data folder
+    :param data_folder_name: name of data folder
+    :param rows: if set, df describes only these rows (and columns) of matrix, for example articles, which are not
+    disambiguation pages
+    """
+    folder = f'{data_folder_name}/{project}/{STORE_FOLDER}'
+    MemmapCSR.save(matrix, folder)
+    np.save(f'{folder}/rows.npy', np.arange(matrix.shape[0]) if rows is None else np.asarray(rows))
+    write_stage_file(df, f'{folder}/{_ARTICLES}')
+
+
+def load_similarity(project: str, data_folder_name: str = 'data') -> tuple[pd.DataFrame, MemmapCSR]:
+    """
+    Open similarity matrix saved by save_similarity
+    :param project: name of subfolder in data folder
+    :param data_folder_name: name of data folder
+    :return: DataFrame with articles and lazy memory-mapped matrix with their similarities
+    """
+    folder = f'{data_folder_name}/{project}/{STORE_FOLDER}'
+    return read_stage_file(f'{folder}/{_ARTICLES}'), MemmapCSR(folder).select(np.load(f'{folder}/rows.npy'))
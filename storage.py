@@ -0,0 +1,287 @@
+import ast
+import json
+import os
+from os.path import exists
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+STAGE_FORMATS = ('csv', 'npz')
+PROJECT_CONFIG = 'project.json'
+_SEPARATOR = '\n'  # separator of strings in .npz files written before byte offsets were saved
+
+
+def project_format(project: str, data_folder_name: str = 'data') -> str:
+    """Format of stage files of the project ('csv' by default), as it was set by set_project_format"""
+    path = f'{data_folder_name}/{project}/{PROJECT_CONFIG}'
+    if not exists(path):
+        return 'csv'
+    with open(path) as f:
+        return json.load(f).get('format', 'csv')
+
+
+def set_project_format(project: str, fmt: str, data_folder_name: str = 'data') -> None:
+    """
+    Set format of stage files for the project. All new stage files will be saved in this format
+    :param project: name of subfolder in data folder
+    :param fmt: 'csv' (lists are saved as python reprs) or 'npz' (lists are saved as flat arrays with offsets)
+    :param data_folder_name: name of data folder
+    """
+    if fmt not in STAGE_FORMATS:
+        raise ValueError(f'Unknown format {fmt}, use one of {STAGE_FORMATS}')
+    os.makedirs(f'{data_folder_name}/{project}', exist_ok=True)
+    path = f'{data_folder_name}/{project}/{PROJECT_CONFIG}'
+    config = {}
+    if exists(path):
+        with open(path) as f:
+            config = json.load(f)
+    config['format'] = fmt
+    with open(path, 'w') as f:
+        json.dump(config, f)
+
+
+def _encode_strings(values: list) -> tuple[np.ndarray, np.ndarray]:
+    """Encode strings to utf-8 blob and int64 byte offsets of each string in it (strings may contain any characters)"""
+    encoded = [str(value).encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(arrays: dict[str, np.ndarray], count: int) -> list[str]:
+    """Inverse of _encode_strings, raise ValueError if number of strings is not equal to count"""
+    data = arrays['values'].tobytes()
+    if 'str_offsets' in arrays:
+        offsets = arrays['str_offsets'].tolist()
+        values = [data[start:stop].decode('utf-8') for start, stop in zip(offsets[:-1], offsets[1:])]
+    else:
+        values = data.decode('utf-8').split(_SEPARATOR) if count else []
+    if len(values) != count:
+        raise ValueError(f'{len(values)} strings are decoded instead of {count}, file is corrupted')
+    return values
+
+
+def _split(values: list, offsets: np.ndarray) -> list[list]:
+    offsets = offsets.tolist()
+    return [values[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def _encode_column(col: pd.Series) -> tuple[dict, dict[str, np.ndarray]]:
+    """Encode one column to numpy arrays. Return description of column and dict of arrays"""
+    if pd.api.types.is_numeric_dtype(col) or pd.api.types.is_bool_dtype(col):
+        return {'kind': 'scalar'}, {'values': col.values}
+    mask = col.isna().values
+    non_null = col[~mask]
+    if len(non_null) == 0:
+        return {'kind': 'null'}, {'mask': mask}
+    if isinstance(non_null.iloc[0], (list, tuple, set)):
+        lengths = np.zeros(len(col), dtype=np.int64)
+        lengths[~mask] = non_null.apply(len).values
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        flat = [i for x in non_null for i in x]
+        if all(isinstance(i, (int, np.integer)) for i in flat):
+            return {'kind': 'int_list'}, {'values': np.array(flat, dtype=np.int64), 'offsets': offsets,
+                                          'mask': mask}
+        missing = np.array([not isinstance(i, str) and pd.isna(i) for i in flat], dtype=bool)
+        values, str_offsets = _encode_strings(flat)
+        return {'kind': 'str_list', 'count': len(flat)}, {'values': values, 'str_offsets': str_offsets,
+                                                           'offsets': offsets, 'mask': mask, 'missing': missing}
+    values, str_offsets = _encode_strings(non_null.tolist())
+    return {'kind': 'str', 'count': len(non_null)}, {'values': values, 'str_offsets': str_offsets, 'mask': mask}
+
+
+def _decode_column(description: dict, arrays: dict[str, np.ndarray], length: int) -> list:
+    """Inverse of _encode_column"""
+    kind = description['kind']
+    if kind == 'scalar':
+        return arrays['values']
+    mask = arrays['mask']
+    if kind == 'null':
+        return [None] * length
+    if kind == 'str':
+        if description['count'] != len(mask) - mask.sum():
+            raise ValueError(f'{description["count"]} strings for {len(mask) - mask.sum()} not-null values')
+        values = iter(_decode_strings(arrays, description['count']))
+        return [None if m else next(values) for m in mask]
+    if kind == 'int_list':
+        values = _split(arrays['values'].tolist(), arrays['offsets'])
+    else:
+        flat = _decode_strings(arrays, description['count'])
+        for i in np.flatnonzero(arrays.get('missing', [])):  # missing values inside lists
+            flat[i] = None
+        values = _split(flat, arrays['offsets'])
+    if mask.any():
+        values = [None if m else v for v, m in zip(values, mask)]
+    return values
+
+
+def write_stage_file(df: pd.DataFrame, path: str) -> None:
+    """
+    Save stage DataFrame (without index), format is chosen by extension of path. In .npz files columns with lists are
+    saved as flat arrays of values plus array of offsets, so they could be loaded without parsing python reprs
+    :param df: DataFrame to save
+    :param path: path to .csv or .npz file
+    """
+    if not path.endswith('.npz'):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            df.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return
+    arrays = {}
+    descriptions = []
+    for i, col in enumerate(df.columns):
+        description, col_arrays = _encode_column(df[col])
+        description['name'] = col
+        descriptions.append(description)
+        arrays.update({f'{i}.{key}': value for key, value in col_arrays.items()})
+    arrays['meta'] = np.frombuffer(json.dumps({'columns': descriptions, 'length': len(df)}).encode(), dtype=np.uint8)
+    tmp_path = path[:-len('.npz')] + '.tmp.npz'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_stage_file(path: str, dtype: Optional[type] = None) -> pd.DataFrame:
+    """
+    Load stage DataFrame saved by write_stage_file. Lists from .npz files are already python lists, and lists from
+    .csv files are strings, which could be converted by support_functions.convert_lists
+    :param path: path to .csv or .npz file
+    :param dtype: dtype for .csv files, as in pd.read_csv
+    :return: DataFrame
+    """
+    if not path.endswith('.npz'):
+        return pd.read_csv(path, dtype=dtype)
+    with np.load(path) as data:
+        meta = json.loads(data['meta'].tobytes().decode())
+        columns = {}
+        for i, description in enumerate(meta['columns']):
+            arrays = {key.split('.', 1)[1]: data[key] for key in data.files if key.startswith(f'{i}.')}
+            columns[description['name']] = _decode_column(description, arrays, meta['length'])
+    return pd.DataFrame(columns, index=range(meta['length']))
+
+
+def save_csr(matrix: csr_matrix, folder: str, name: str) -> None:
+    """Save arrays of CSR matrix as .npy files (they could be memory-mapped by other processes)"""
+    np.save(f'{folder}/{name}_indptr.npy', matrix.indptr)
+    np.save(f'{folder}/{name}_indices.npy', matrix.indices)
+    np.save(f'{folder}/{name}_data.npy', matrix.data)
+
+
+def load_csr(folder: str, name: str, shape: tuple[int, int], mmap_mode: Optional[str] = 'r') -> csr_matrix:
+    """Load CSR matrix saved by save_csr, arrays are memory-mapped by default"""
+    return csr_matrix((np.load(f'{folder}/{name}_data.npy', mmap_mode=mmap_mode),
+                       np.load(f'{folder}/{name}_indices.npy', mmap_mode=mmap_mode),
+                       np.load(f'{folder}/{name}_indptr.npy', mmap_mode=mmap_mode)), shape=shape, copy=False)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _write_atomic(path: str, text: str) -> None:
+    """Write small text file with write-then-rename, so reader sees either old or new content"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointLog:
+    """
+    Append-only log of results of completed batches of stage (one json line per batch), written next to stage file.
+    After each record is appended and synced to disk, progress marker (number of completed rows and size of valid part
+    of log) is replaced atomically, so resume doesn't need to look through results, and half-written record after
+    crash is ignored. When stage file is compacted, log is removed, and marker remains to show that stage is complete
+    """
+    def __init__(self, path: str):
+        """
+        :param path: path to stage file
+        """
+        self.log_path = path + '.log'
+        self.progress_path = path + '.progress'
+
+    def progress(self) -> dict:
+        """Progress marker: number of completed rows, size of valid part of log and total number of rows"""
+        if not exists(self.progress_path):
+            return {'rows': 0, 'offset': 0, 'total': None}
+        with open(self.progress_path) as f:
+            return json.load(f)
+
+    def records(self):
+        """Iterate over completed batches: tuples (first row, list of results)"""
+        offset = self.progress()['offset']
+        if not offset:
+            return
+        with open(self.log_path, 'rb') as f:
+            for line in f.read(offset).splitlines():
+                record = json.loads(line)
+                yield record['start'], record['values']
+
+    def append(self, start: int, values: list, total: int) -> None:
+        """Add results of batch of rows starting from start, total is number of rows of stage"""
+        offset = self.progress()['offset']
+        with open(self.log_path, 'ab') as f:
+            f.truncate(offset)
+            f.write((json.dumps({'start': start, 'values': values}, default=_json_default) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        _write_atomic(self.progress_path, json.dumps({'rows': start + len(values), 'offset': offset, 'total': total}))
+
+    def complete(self, total: int) -> None:
+        """Mark all rows as completed and remove log (after stage file is compacted)"""
+        _write_atomic(self.progress_path, json.dumps({'rows': total, 'offset': 0, 'total': total}))
+        if exists(self.log_path):
+            os.remove(self.log_path)
+
+
+def _parse_list_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse columns of DataFrame read from csv, where all not-null values are python reprs of lists"""
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        non_null = df[col].dropna()
+        if len(non_null) and non_null.str.startswith('[').all() and non_null.str.endswith(']').all():
+            df[col] = df[col].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+    return df
+
+
+def convert_project(project: str, fmt: str = 'npz', data_folder_name: str = 'data',
+                    remove_old: bool = False) -> None:
+    """
+    One-time conversion of all stage files of existing project to other format. After conversion, project format is
+    changed, so all functions will use new files
+    :param project: name of subfolder in data folder
+    :param fmt: new format, 'csv' or 'npz'
+    :param data_folder_name: name of data folder
+    :param remove_old: remove files in old format after conversion
+    """
+    old_fmt = project_format(project, data_folder_name)
+    if old_fmt == fmt:
+        print(f'Project {project} already has format {fmt}')
+        return
+    folder = f'{data_folder_name}/{project}'
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(f'.{old_fmt}'):
+            continue
+        path = f'{folder}/{name}'
+        new_path = path[:-len(old_fmt)] + fmt
+        print(f'Converting {path} to {new_path}')
+        df = read_stage_file(path)
+        if old_fmt == 'csv':
+            df = _parse_list_columns(df)
+        write_stage_file(df, new_path)
+        if remove_old:
+            os.remove(path)
+    set_project_format(project, fmt, data_folder_name)
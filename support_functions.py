@@ -1,24 +1,32 @@
 import typing
 from datetime import datetime
 from functools import wraps
-from time import time
+from os.path import exists
 import ast
+import inspect
+from itertools import chain
+import numpy as np
 import pandas as pd
 from typing import Optional, Union
 from collections.abc import Callable, Sequence
 
+from instrumentation import RECORDER, span
+from storage import project_format, write_stage_file, CheckpointLog
+
 
 def apply_with_interim_saving(df: pd.DataFrame, f: Callable, col_to_apply: str, new_col: str, csv_name: str,
                               n: int = 1000, verbose: bool = True, one_by_one: bool = True, **kwargs) -> pd.DataFrame:
     """
     Retrieving categories is done one-by-one, and it could take a lot of time. If some connection errors or
     other problems take place, all data could be lost. To prevent this dataframes updating by chunks of 1000 rows,
-    and results are saved to csv file after each chunk processing
+    and results of each chunk are appended to checkpoint log next to csv_name (see storage.CheckpointLog). After
+    restart calculations are continued from the first unfinished row, and the stage file is written once, when all
+    rows are processed
     :param df: DataFrame (with name of articles)
     :param f: function to apply (get_category)
     :param col_to_apply: self-explaining (column with name of article)
     :param new_col: name of new col, where result of function f will be stored
-    :param csv_name: name of backup csv file where results will be saved
+    :param csv_name: name of file where results will be saved (.csv or .npz, see storage.write_stage_file)
     :param n: size of chunk
     :param verbose: get some printed notifications about dataframe processing
     :param one_by_one: if True, use function with apply, if False: give it list of arguments
@@ -35,28 +43,85 @@ def apply_with_interim_saving(df: pd.DataFrame, f: Callable, col_to_apply: str,
             df[old_index_col] = df.index.copy()
             print(f'Old index moved to {old_index_col}')
     df.reset_index(drop=True, inplace=True)
-    if len(df[df[new_col].isna()]) > 0:
-        if df[df[new_col].isna()].index.min() > 0:
-            print(f'Finish uncompleted calculations...({df.index.max() - df[df[new_col].isna()].index.min()} rows)')
-        for pos in range(df[df[new_col].isna()].index.min(), df.index.max(), n):
-            if one_by_one:
-                df.loc[pos:pos + n, new_col] = df.loc[pos:pos + n, col_to_apply].apply(
-                    lambda x: f(x, **kwargs))
-            else:
-                args_list = df.loc[pos:pos + n, col_to_apply].tolist()
-                df.loc[pos:pos + n, new_col] = pd.Series(f(args_list, **kwargs)).reindex(args_list).set_axis(
-                    df.loc[pos:pos + n].index)
-            df.to_csv(csv_name, index=False)
+    log = CheckpointLog(csv_name)
+    progress = log.progress()
+    if progress['rows'] == progress['total'] and not progress['offset'] and not exists(csv_name):
+        progress = {'rows': 0, 'offset': 0, 'total': None}  # stage file was removed after completion
+    column = df[new_col].tolist()
+    if progress['total'] is not None:
+        if progress['total'] != len(df):
+            raise ValueError(f'Checkpoint of {csv_name} was made for {progress["total"]} rows, but there are '
+                             f'{len(df)} rows. Remove {log.log_path} and {log.progress_path} to start from scratch')
+        for start, values in log.records():
+            column[start: start + len(values)] = values
+        start_pos = progress['rows']
+    else:
+        missing = df.index[df[new_col].isna()]  # file saved without checkpoint log
+        start_pos = missing[0] if len(missing) else len(df)
+    if start_pos < len(df):
+        if start_pos > 0:
+            print(f'Finish uncompleted calculations...({len(df) - start_pos} rows)')
+        for pos in range(start_pos, len(df), n):
+            args = df[col_to_apply].iloc[pos: pos + n]
+            with span('apply_with_interim_saving', rows_in=len(args), column=new_col) as s:
+                if one_by_one:
+                    values = [f(x, **kwargs) for x in args]
+                else:
+                    args_list = args.tolist()
+                    values = pd.Series(f(args_list, **kwargs)).reindex(args_list).tolist()
+                s.rows_out = int(pd.Series(values, dtype=object).notna().sum())
+            column[pos: pos + len(values)] = values
+            log.append(pos, values, len(df))
             if verbose:
                 print(pos, datetime.now())
     else:
         print('Calculations complete')
+    if progress['offset'] or start_pos < len(df):
+        df[new_col] = pd.Series(column, index=df.index, dtype=object)
+        write_stage_file(df, csv_name)
+        log.complete(len(df))
     if old_index_col in df.columns:
         df.index = df[old_index_col].copy()
         df.drop(old_index_col, axis=1, inplace=True)
     return df
 
 
+def regroup_edges(groups: np.ndarray, items: np.ndarray,
+                  n_groups: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Group edges (group, item) to CSR form, duplicated edges are removed by sort of int64 keys group * n_items + item
+    :param groups: non-negative int codes of groups
+    :param items: non-negative int codes of items
+    :param n_groups: number of groups (max code + 1 by default), groups without edges have no items
+    :return: indptr and items: sorted unique items of group g are items[indptr[g]:indptr[g + 1]]
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    if len(groups) and (groups.min() < 0 or items.min() < 0):
+        raise ValueError('Codes of groups and items should be non-negative')
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+    n_items = int(items.max()) + 1 if len(items) else 1
+    if n_groups * n_items < 2 ** 63:
+        groups, items = np.divmod(np.unique(groups * n_items + items), n_items)
+    else:
+        order = np.lexsort((items, groups))
+        groups, items = groups[order], items[order]
+        first = np.ones(len(groups), dtype=bool)
+        first[1:] = (np.diff(groups) != 0) | (np.diff(items) != 0)
+        groups, items = groups[first], items[first]
+    indptr = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=n_groups), out=indptr[1:])
+    return indptr, items
+
+
+def _flat(lists: list[list]) -> tuple[np.ndarray, list]:
+    """Offsets and concatenation of lists"""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lists], out=offsets[1:])
+    return offsets, list(chain.from_iterable(lists))
+
+
 def regroup_categories(df: pd.DataFrame, cat_col: str, id_col: str, lists: bool = True,
                        transform_prohibited: bool = False, add_word: Optional[str] = 'Category:') -> pd.DataFrame:
     """
@@ -65,6 +130,8 @@ def regroup_categories(df: pd.DataFrame, cat_col: str, id_col: str, lists: bool
     For example, from [category, list_of_ids_belong_to_category, list_of_infracategories_of_category]
     it will be transformed to
     [infracategory, list_of_ids_belong_to_infracategory]
+    Rows are converted to flat edges (infracategory, id), which are grouped by regroup_edges, so time is linear in
+    number of edges. Categories are sorted, ids of each category are sorted and unique
     :param df: DataFrame, result of previous stage
     :param cat_col: name of column in df, where lists of categories are staged
     :param id_col: name of column in df, where lists of ids of articles are staged
@@ -76,26 +143,42 @@ def regroup_categories(df: pd.DataFrame, cat_col: str, id_col: str, lists: bool
     """
     if not transform_prohibited:
         if lists:
-            try:
-                df[id_col] = df[id_col].apply(ast.literal_eval)
-            except ValueError:
-                pass
+            df[id_col] = df[id_col].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
         else:
             df[id_col] = df[id_col].astype(int)
-    agg_func = {id_col: 'sum'} if lists else {id_col: pd.Series.tolist}
-    df = df.explode(cat_col).groupby(cat_col).agg(agg_func).reset_index()
-    df[id_col] = df[id_col].apply(set).apply(list)
+    cat_offsets, categories = _flat([x if isinstance(x, list) else [x] for x in df[cat_col]])
+    id_offsets, ids = _flat([x if isinstance(x, list) else [] for x in df[id_col]] if lists
+                            else [[x] for x in df[id_col]])
+    cat_codes, categories = pd.factorize(pd.Series(categories, dtype=object), sort=True)  # NaN has code -1
+    id_codes, ids = pd.factorize(pd.Series(ids, dtype=object if transform_prohibited else None), sort=True)
+    rows = np.repeat(np.arange(len(df)), np.diff(cat_offsets))[cat_codes >= 0]
+    cat_codes = cat_codes[cat_codes >= 0]
+    counts = np.diff(id_offsets)[rows]  # each category of row gets all ids of row
+    starts = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=starts[1:])
+    positions = np.repeat(id_offsets[rows] - starts[:-1], counts) + np.arange(starts[-1])
+    edge_ids = id_codes[positions]
+    known = edge_ids >= 0  # missing ids have code -1
+    indptr, items = regroup_edges(np.repeat(cat_codes, counts)[known], edge_ids[known], len(categories))
+    values = np.asarray(ids)[items].tolist()
+    df = pd.DataFrame({cat_col: np.asarray(categories, dtype=object),
+                       id_col: [values[start: stop] for start, stop in zip(indptr[:-1], indptr[1:])]})
     if add_word is not None:
         df[cat_col] = add_word + df[cat_col]
     return df
 
 
-def data_path(stage: Sequence[str], project: str, data_folder_name: str = 'data') -> str:
-    """Make path to csv backups, according to stage name and project name"""
+def data_path(stage: Sequence[str], project: str, data_folder_name: str = 'data', fmt: Optional[str] = None) -> str:
+    """
+    Make path to stage backups, according to stage name and project name. Extension is format of project files
+    (see storage.set_project_format), unless fmt is set
+    """
+    if fmt is None:
+        fmt = project_format(project, data_folder_name)
     if len(stage) == 1:
-        return f'{data_folder_name}/{project}/{stage[0]}.csv'
+        return f'{data_folder_name}/{project}/{stage[0]}.{fmt}'
     if len(stage) == 2:
-        return f'{data_folder_name}/{project}/{stage[0]}_with_{stage[1]}.csv'
+        return f'{data_folder_name}/{project}/{stage[0]}_with_{stage[1]}.{fmt}'
 
 
 def generate_stages(n: int, final_file: str = 'final') -> list[tuple[str, ...], ...]:
@@ -123,65 +206,41 @@ def convert_lists(df: pd.DataFrame, col: str) -> pd.DataFrame:
     :return: converted column. Data could be resampled: all not-null at first and all null after them
     """
     nonnull_part = df[~df[col].isna()].copy()
-    nonnull_part[col] = nonnull_part[col].apply(ast.literal_eval)
+    nonnull_part[col] = nonnull_part[col].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
     return pd.concat([nonnull_part, df[df[col].isna()]])
 
 
-def get_args_dict(f: Callable, args: Sequence, kwargs: dict) -> dict:
+def timing(printed_args=None):
     """
-    By given function and passed args list and kwargs dict, return dictionary with names and values of all arguments,
-    passed to the function, including defaults for those which wasn't passed
-    :param f: any function
-    :param args: all positional arguments, passed to function f
-    :param kwargs: all named arguments passed to function f
-    :return: dictionary with all parameters of the function. If function have **kwargs unpacking, there will be 'kwargs'
-    parameter in resulting dict with all unpacked arguments,
-    and also all this arguments will be in resulting dict by themselves
+    Decorator which measure time of function. Each call is recorded as span of instrumentation.RECORDER (with printed
+    args as attributes), positions of printed args are found once, when function is decorated. Time is printed only
+    if recorder is verbose (see instrumentation.configure)
     """
-    var_names = f.__code__.co_varnames
-    pos_arg_count = min(f.__code__.co_argcount, len(args))
-    flags = '{:04b}'.format(f.__code__.co_flags)
-    has_args = int(flags[-3])
-    has_kwargs = int(flags[-4])
-    kwarg_name = [None, var_names[-1]][has_kwargs]
-    arg_name = [None, var_names[-1 - has_kwargs]][has_args]
-    kwargs.update(zip(var_names[:pos_arg_count], args[:pos_arg_count]))
-    if has_kwargs:
-        kwargs[kwarg_name] = {i: kwargs[i] for i in kwargs if (i not in var_names) or (i in [arg_name, kwarg_name])}
-
-    if has_args:
-        kwargs[arg_name] = args[pos_arg_count:]
-        defaults = f.__kwdefaults__ or {}
-    else:
-        args_from_named = var_names[pos_arg_count: len(args)]
-        args_from_named_values = args[pos_arg_count:]
-        kwargs.update(zip(args_from_named, args_from_named_values))
-
-        defaults = f.__defaults__ or []
-        defaults = dict(zip(
-            var_names[-len(defaults) - has_kwargs:(-1 if has_kwargs else None)],
-            defaults
-        ))
-    defaults.update(kwargs)
-    return defaults
-
-
-def timing(printed_args=None):
-    """Decorator which measure time of function """
     def decorator(f):
+        parameters = inspect.signature(f).parameters
+        positions = {name: i for i, name in enumerate(parameters)}
+        wanted = [] if printed_args in (None, 'all') else [name for name in parameters if name in printed_args]
+
         @wraps(f)
         def wrap(*args, **kwargs):
-            ts = time()
-            result = f(*args, **kwargs)
-            te = time()
-            if printed_args is None:
-                print(f'function {f.__name__} run by {te - ts:2.4f} sec')
-            elif printed_args == 'all':
-                print(f'function {f.__name__} with args {args} and kwargs{kwargs} run by {te - ts:2.4f} sec')
-            else:
-                args_dict = get_args_dict(f, args, kwargs)
-                args_want_to_see = {i: args_dict[i] for i in args_dict if i in printed_args}
-                print(f'function {f.__name__} with args {args_want_to_see} run by {te - ts:2.4f} sec')
+            args_want_to_see = {}
+            for name in wanted:
+                if positions[name] < len(args):
+                    args_want_to_see[name] = args[positions[name]]
+                else:
+                    args_want_to_see[name] = kwargs.get(name, parameters[name].default)
+            with span(f.__name__, attrs=args_want_to_see) as s:
+                result = f(*args, **kwargs)
+                shape = getattr(result, 'shape', None)
+                if shape:
+                    s.rows_out = shape[0]
+            if RECORDER.verbose:
+                if printed_args is None:
+                    print(f'function {f.__name__} run by {s.wall:2.4f} sec')
+                elif printed_args == 'all':
+                    print(f'function {f.__name__} with args {args} and kwargs{kwargs} run by {s.wall:2.4f} sec')
+                else:
+                    print(f'function {f.__name__} with args {args_want_to_see} run by {s.wall:2.4f} sec')
             return result
 
         return wrap
@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import monotonic
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class MockAPI:
+    """
+    Local HTTP server in place of Wikipedia API. Each GET request is logged as (time, params) and answered by
+    handler(params) -> (status, body, headers), which is set by test
+    """
+    def __init__(self):
+        self.calls = []
+        self.handler = lambda params: (200, {}, {})
+        self._lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                with mock._lock:
+                    mock.calls.append((monotonic(), params))
+                status, body, headers = mock.handler(params)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.api_url = f'http://127.0.0.1:{self.server.server_port}/{{lang}}/api.php'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def categories_handler(categories: dict[str, list[str]], page_size: int = 500):
+    """
+    Handler, which answers prop=categories queries like API: categories of each title (without "Category:" prefix)
+    are returned by pages of page_size, with clcontinue for next page
+    """
+    def handler(params):
+        page = int(params.get('clcontinue', 0))
+        pages = {}
+        for num, title in enumerate(params['titles'].split('|')):
+            cats = categories.get(title, [])[page * page_size: (page + 1) * page_size]
+            pages[str(-num - 1)] = {'title': title, 'categories': [{'title': f'Category:{cat}'} for cat in cats]}
+        body = {'query': {'pages': pages}}
+        if any(len(cats) > (page + 1) * page_size for title, cats in categories.items()
+               if title in params['titles'].split('|')):
+            body['continue'] = {'clcontinue': str(page + 1), 'continue': '||'}
+        return 200, body, {}
+    return handler
+
+
+@pytest.fixture
+def mock_api():
+    api = MockAPI()
+    yield api
+    api.close()
@@ -0,0 +1,72 @@
+from time import monotonic
+
+import pytest
+import requests
+
+from conftest import categories_handler
+from fetcher import CategoryFetcher, RateLimiter
+
+
+def test_rate_limiter_spreads_requests():
+    limiter = RateLimiter(50)
+    start = monotonic()
+    for _ in range(11):
+        limiter.wait()
+    assert monotonic() - start >= 10 / 50 * 0.9
+
+
+def test_requests_rate_is_limited(mock_api):
+    titles = [f'Article {i}' for i in range(21)]
+    mock_api.handler = categories_handler({title: ['A'] for title in titles})
+    fetcher = CategoryFetcher(requests_per_second=20, max_in_flight=4, n=1, api_url=mock_api.api_url)
+    res = fetcher(titles)
+    assert res == {title: ['A'] for title in titles}
+    times = sorted(time for time, _ in mock_api.calls)
+    assert len(times) == 21
+    assert times[-1] - times[0] >= 20 / 20 * 0.9
+
+
+def test_429_is_retried_after_retry_after(mock_api):
+    ok = categories_handler({'A': ['B']})
+    mock_api.handler = lambda params: (429, {}, {'Retry-After': '0.3'}) if len(mock_api.calls) == 1 else ok(params)
+    fetcher = CategoryFetcher(requests_per_second=None, backoff=10, api_url=mock_api.api_url)
+    start = monotonic()
+    assert fetcher(['A']) == {'A': ['B']}
+    assert len(mock_api.calls) == 2
+    assert 0.3 <= monotonic() - start < 5  # Retry-After is used instead of backoff
+
+
+def test_5xx_are_retried(mock_api):
+    ok = categories_handler({'A': ['B']})
+    statuses = [503, 500]
+    mock_api.handler = lambda params: (statuses.pop(0), {}, {}) if statuses else ok(params)
+    fetcher = CategoryFetcher(requests_per_second=None, backoff=0.01, api_url=mock_api.api_url)
+    assert fetcher(['A']) == {'A': ['B']}
+    assert len(mock_api.calls) == 3
+
+
+def test_error_after_max_retries(mock_api):
+    mock_api.handler = lambda params: (502, {}, {})
+    fetcher = CategoryFetcher(requests_per_second=None, max_retries=2, backoff=0.01, api_url=mock_api.api_url)
+    with pytest.raises(requests.exceptions.RetryError):
+        fetcher(['A'])
+    assert len(mock_api.calls) == 3
+
+
+def test_maxlag_is_retried(mock_api):
+    ok = categories_handler({'A': ['B']})
+    lagged = (200, {'error': {'code': 'maxlag', 'info': 'Waiting for db: 6 seconds lagged'}}, {'Retry-After': '0'})
+    mock_api.handler = lambda params: lagged if len(mock_api.calls) == 1 else ok(params)
+    fetcher = CategoryFetcher(requests_per_second=None, maxlag=5, api_url=mock_api.api_url)
+    assert fetcher(['A']) == {'A': ['B']}
+    assert len(mock_api.calls) == 2
+    assert all(params['maxlag'] == '5' for _, params in mock_api.calls)
+
+
+def test_clcontinue_is_drained(mock_api):
+    categories = {'A': [f'A{i}' for i in range(7)], 'B': ['B0'], 'C': []}
+    mock_api.handler = categories_handler(categories, page_size=3)
+    fetcher = CategoryFetcher(requests_per_second=None, api_url=mock_api.api_url)
+    assert fetcher(['A', 'B', 'C']) == categories
+    assert [params.get('clcontinue') for _, params in mock_api.calls] == [None, '1', '2']
+    assert all(params['clshow'] == '!hidden' for _, params in mock_api.calls)
@@ -0,0 +1,39 @@
+import pytest
+
+import incremental_similarity
+from benchmark_suite import synthetic_project
+from category_graph import project_graph
+from incremental_similarity import project_similarity
+from storage import read_stage_file, write_stage_file
+from support_functions import data_path
+
+MULTS = [1, 0.5, 0.25]
+
+
+def assert_same(a, b) -> None:
+    assert a.shape == b.shape and abs(a - b).max() < 1e-6
+
+
+def test_cache_is_used_until_stage_files_change(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    synthetic_project('p', 300, levels=3, data_folder_name=folder, fmt='npz')
+    first = project_similarity('p', 3, MULTS, folder)
+    assert_same(first, project_graph('p', 3, folder).similarity(mults=MULTS))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('index is rebuilt for unchanged stage files')
+    with monkeypatch.context() as m:
+        m.setattr(incremental_similarity, 'project_graph', fail)
+        assert_same(project_similarity('p', 3, MULTS, folder), first)
+        assert_same(project_similarity('p', 2, [1, 0.1], folder),
+                    project_graph('p', 3, folder).similarity(mults=[1, 0.1]))
+        with pytest.raises(AssertionError):
+            project_similarity('p', 4, MULTS, folder)  # level, which is not cached
+
+    path = data_path(('title', 'category'), 'p', folder)
+    df = read_stage_file(path)
+    df.at[0, 'category'] = df['category'][1]
+    write_stage_file(df, path)
+    updated = project_similarity('p', 3, MULTS, folder)
+    assert_same(updated, project_graph('p', 3, folder, rebuild=True).similarity(mults=MULTS))
+    assert abs(updated - first).max() > 0
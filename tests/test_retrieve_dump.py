@@ -0,0 +1,67 @@
+import os
+import shutil
+from os.path import join
+
+from conftest import FIXTURES, categories_handler
+from fetcher import CategoryFetcher
+from retrieve import get_articles_with_infracategories
+from retrieve_dump import (iter_dump_rows, read_hidden_category_ids, read_pages, read_category_links,
+                           get_articles_with_infracategories_from_dump)
+from storage import read_stage_file
+
+PAGE_DUMP = join(FIXTURES, 'page.sql.gz')
+CATEGORYLINKS_DUMP = join(FIXTURES, 'categorylinks.sql.gz')
+PAGE_PROPS_DUMP = join(FIXTURES, 'page_props.sql.gz')
+
+# what API returns for the same wiki (titles with spaces, without hidden categories)
+API_CATEGORIES = {'Apple': ['Fruits (botany)'],
+                  'Banana (fruit)': ['Fruits (botany)'],
+                  "O'Reilly, Tim": ['Food'],
+                  'Back\\slash': ['Food'],
+                  'Cherry': ['Fruits (botany)', 'Plants'],
+                  'Category:Fruits (botany)': ['Food', 'Plants'],
+                  'Category:Plants': ['Life'],
+                  'Category:Food': ['Life'],
+                  'Category:Life': []}
+
+
+def test_iter_dump_rows_parses_literals():
+    rows = list(iter_dump_rows(PAGE_DUMP, ['page_title', 'page_lang', 'page_id']))
+    assert rows[:3] == [('Apple', None, 1), ('Banana_(fruit)', 'en', 2), ("O'Reilly,_Tim", None, 3)]
+    assert ('Back\\slash', None, 8) in rows
+    assert ('Articles_with_(hidden)_notes', None, 7) in rows
+    assert len(rows) == 12  # rows of both INSERT statements
+    props = list(iter_dump_rows(PAGE_PROPS_DUMP, ['pp_sortkey', 'pp_value', 'pp_page']))
+    assert props == [(None, 'Q89', 1), (None, '', 7), (1.5, 'Food, (all)', 9)]
+    links = list(iter_dump_rows(CATEGORYLINKS_DUMP, ['cl_sortkey', 'cl_type']))
+    assert links[3] == ("O'REILLY, TIM", 'page')
+
+
+def test_read_pages():
+    hidden_ids = read_hidden_category_ids(PAGE_PROPS_DUMP)
+    assert hidden_ids == {7}
+    articles, category_ids, hidden = read_pages(PAGE_DUMP, hidden_ids=hidden_ids)
+    assert articles == {1: 'Apple', 2: 'Banana (fruit)', 3: "O'Reilly, Tim", 8: 'Back\\slash', 11: 'Cherry'}
+    assert category_ids == {'Fruits (botany)': 5, 'Plants': 6, 'Articles with (hidden) notes': 7, 'Food': 9,
+                            'Life': 10}
+    assert hidden == {'Articles with (hidden) notes'}
+    assert read_category_links(CATEGORYLINKS_DUMP, articles, hidden) == {
+        title: cats for title, cats in API_CATEGORIES.items() if not title.startswith('Category:')}
+
+
+def test_dump_stage_files_match_api_crawl(tmp_path, mock_api):
+    dump_folder, api_folder = str(tmp_path / 'dump'), str(tmp_path / 'api')
+    get_articles_with_infracategories_from_dump(None, 2, 'p', PAGE_DUMP, CATEGORYLINKS_DUMP, PAGE_PROPS_DUMP,
+                                                data_folder_name=dump_folder)
+    os.makedirs(join(api_folder, 'p'))
+    shutil.copy(join(dump_folder, 'p', 'title.csv'), join(api_folder, 'p', 'title.csv'))  # the same sample
+    mock_api.handler = categories_handler(API_CATEGORIES)
+    get_articles_with_infracategories(None, 2, 'p', data_folder_name=api_folder,
+                                      fetcher=CategoryFetcher(requests_per_second=None, api_url=mock_api.api_url))
+    stage_files = sorted(name for name in os.listdir(join(dump_folder, 'p')) if name.endswith('.csv'))
+    assert stage_files == ['category_with_infra1.csv', 'final.csv', 'infra1_with_infra2.csv', 'title.csv',
+                           'title_with_category.csv']
+    for name in stage_files:
+        dump_df = read_stage_file(join(dump_folder, 'p', name))
+        api_df = read_stage_file(join(api_folder, 'p', name))
+        assert dump_df.equals(api_df), name
@@ -0,0 +1,85 @@
+import random
+
+from fetcher import CategoryFetcher
+from retrieve import get_random_articles_titles
+from retrieve_dump import sample_dump
+from sampler import Reservoir, allocate, sample_api
+
+
+def write_page_dump(path, n: int) -> None:
+    """Page dump with n pages: every 5th is category, every 7th is redirect"""
+    rows = [f"({i},{14 if i % 5 == 0 else 0},'Page_{i}',{1 if i % 7 == 0 else 0})" for i in range(1, n + 1)]
+    with open(path, 'w') as f:
+        f.write('CREATE TABLE `page` (\n  `page_id` int,\n  `page_namespace` int,\n  `page_title` varbinary(255),\n'
+                '  `page_is_redirect` tinyint\n) ENGINE=InnoDB;\n')
+        for start in range(0, n, 100):
+            f.write('INSERT INTO `page` VALUES ' + ','.join(rows[start: start + 100]) + ';\n')
+
+
+def random_handler(pool: int, seed: int = 0):
+    """Handler of list=random queries, which returns titles from pool of titles with repetitions"""
+    rng = random.Random(seed)
+
+    def handler(params):
+        ids = [rng.randrange(pool) for _ in range(int(params['rnlimit']))]
+        return 200, {'query': {'random': [{'id': i, 'ns': 0, 'title': f'T{i}'} for i in ids]}}, {}
+    return handler
+
+
+def test_allocate_largest_remainders():
+    assert allocate({'a': 10, 'b': 20, 'c': 3}, 10) == {'a': 3, 'b': 6, 'c': 1}  # quotas 3.03, 6.06, 0.91
+    assert allocate({'a': 6, 'b': 7, 'c': 7}, 5) == {'a': 1, 'b': 2, 'c': 2}  # quotas 1.5, 1.75, 1.75
+    assert allocate({'a': 5, 'b': 3, 'c': 2}, 5) == {'a': 3, 'b': 1, 'c': 1}  # tie of 2.5 and 1.5 goes to first
+    assert allocate({'a': 1, 'b': 2}, 10) == {'a': 1, 'b': 2}
+
+
+def test_reservoir_keeps_short_stream():
+    reservoir = Reservoir(10, random.Random(0))
+    for i in range(7):
+        reservoir.offer(i)
+    assert reservoir.items == list(range(7))
+
+
+def test_sample_dump_is_reproducible(tmp_path):
+    path = str(tmp_path / 'page.sql')
+    write_page_dump(path, 2000)
+    first = sample_dump(path, 100, seed=1)
+    assert first.equals(sample_dump(path, 100, seed=1))
+    assert not first.equals(sample_dump(path, 100, seed=2))
+    assert len(first) == 100 and first['id'].is_unique and first['id'].is_monotonic_increasing
+    assert (first['namespace'] == 0).all() and (first['id'] % 7 != 0).all()
+    assert first['title'].str.startswith('Page ').all()
+
+
+def test_sample_dump_stratified(tmp_path):
+    path = str(tmp_path / 'page.sql')
+    write_page_dump(path, 2000)
+    by_namespace = sample_dump(path, 100, seed=0, namespaces=(0, 14), strata='namespace', redirects=True)
+    assert by_namespace['namespace'].value_counts().to_dict() == {0: 80, 14: 20}
+    strata = {i: 'even' if i % 2 == 0 else 'odd' for i in range(1, 2001)}
+    sized = sample_dump(path, 0, seed=0, strata=strata, sizes={'even': 30})
+    assert len(sized) == 30 and (sized['stratum'] == 'even').all() and (sized['id'] % 2 == 0).all()
+
+
+def test_sample_api_removes_duplicates(mock_api):
+    mock_api.handler = random_handler(50)
+    fetcher = CategoryFetcher(requests_per_second=None, api_url=mock_api.api_url)
+    df = sample_api(40, id_=True, fetcher=fetcher)
+    assert len(df) == 40 and df['title'].is_unique
+    assert (df['title'] == 'T' + df['id'].astype(str)).all()
+    df = sample_api(60, fetcher=fetcher, max_stale=5)  # there are only 50 titles
+    assert sorted(df['title']) == sorted(f'T{i}' for i in range(50))
+
+
+def test_random_titles_resume_from_part_file(mock_api, tmp_path):
+    path = str(tmp_path / 'title.csv.part')
+    with open(path, 'w') as f:
+        f.write('1001\tSaved 1\n1002\tSaved 2\n1003\tSaved 3\n1004\tTor')  # interrupted while writing
+    mock_api.handler = random_handler(1000)
+    fetcher = CategoryFetcher(requests_per_second=None, api_url=mock_api.api_url)
+    df = get_random_articles_titles(20, path=path, fetcher=fetcher)
+    assert list(df['title'][:3]) == ['Saved 1', 'Saved 2', 'Saved 3']
+    assert len(df) == 20 and df['title'].is_unique
+    assert mock_api.calls[0][1]['rnlimit'] == '17'
+    with open(path) as f:
+        assert [line.split('\t')[1] for line in f.read().splitlines()][:20] == list(df['title'])
@@ -0,0 +1,37 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from storage import read_stage_file, write_stage_file
+
+
+def test_npz_strings_keep_new_lines(tmp_path):
+    path = str(tmp_path / 'stage.npz')
+    df = pd.DataFrame({'title': ['A', 'B', 'C', 'D'],
+                       'text': ['Para one.\nPara two.', None, 'Second text\n', 'Third'],
+                       'cats': [['X\nY', 'Z'], [], None, ['Ü', None]]})
+    write_stage_file(df, path)
+    res = read_stage_file(path)
+    assert res['text'].tolist() == df['text'].tolist()
+    assert res['cats'].tolist() == df['cats'].tolist()
+
+
+def test_npz_count_mismatch_raises(tmp_path):
+    path = str(tmp_path / 'stage.npz')
+    write_stage_file(pd.DataFrame({'title': ['A', 'B', 'C']}), path)
+    with np.load(path) as data:
+        arrays = dict(data)
+    meta = json.loads(arrays['meta'].tobytes().decode())
+    meta['columns'][0]['count'] = 2
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    np.savez(path, **arrays)
+    with pytest.raises(ValueError):
+        read_stage_file(path)
+    meta['columns'][0]['count'] = 3
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+    arrays['0.str_offsets'] = arrays['0.str_offsets'][:-1]  # offsets of 2 strings
+    np.savez(path, **arrays)
+    with pytest.raises(ValueError):
+        read_stage_file(path)
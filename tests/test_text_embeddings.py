@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+
+from storage import set_project_format, write_stage_file
+from support_functions import data_path
+from text_embeddings import TEXT_STAGE, project_texts
+
+EXTRACTS = {'First': 'Para one.\nPara two.', 'Second': 'Second text', 'Third': 'Third\n\nwith empty line\n',
+            'Fourth': None}
+
+
+def fetch_extracts(titles, lang='en'):
+    return {title: EXTRACTS[title] for title in titles}
+
+
+@pytest.mark.parametrize('fmt', ['npz', 'csv'])
+def test_texts_with_new_lines_stay_with_their_titles(tmp_path, fmt):
+    folder = str(tmp_path)
+    set_project_format('p', fmt, folder)
+    write_stage_file(pd.DataFrame({'title': list(EXTRACTS)}), data_path(TEXT_STAGE[:1], 'p', folder))
+    first = project_texts('p', folder, fetcher=fetch_extracts, n=2)
+    reloaded = project_texts('p', folder, fetcher=None)  # from stage file, fetcher is not used
+    for df in (first, reloaded):
+        assert df['title'].tolist() == list(EXTRACTS)
+        assert [None if pd.isna(text) else text for text in df['text']] == list(EXTRACTS.values())
+        assert df['index'].tolist() == [0, 1, 2, 3]
@@ -0,0 +1,210 @@
+import json
+import os
+import re
+from os.path import exists
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, spmatrix
+
+from category_graph import project_graph
+from category_filter import project_filter
+from fetcher import ExtractsFetcher
+from storage import read_stage_file
+from support_functions import data_path, apply_with_interim_saving, timing
+
+TEXT_STAGE = ('title', 'text')
+EMBEDDINGS_FOLDER = 'embeddings'
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+
+
+class EmbeddingStore:
+    """
+    Vectors of articles in memory-mapped float16 file, row i is vector of article with index i, and mask of articles,
+    which have vectors. Vectors are written before mask, so after interruption only fully written vectors are
+    treated as present, and encoding could be continued from missing ones. File grows when bigger index is put
+    """
+    def __init__(self, folder: str, dim: Optional[int] = None, size: int = 1024):
+        """
+        :param folder: folder of store, it is created if not exists
+        :param dim: dimension of vectors, needed only for new store
+        :param size: initial number of rows of new store
+        """
+        self.folder = folder
+        if exists(f'{folder}/store.json'):
+            with open(f'{folder}/store.json') as f:
+                meta = json.load(f)
+            if dim is not None and dim != meta['dim']:
+                raise ValueError(f'Store {folder} has vectors of dimension {meta["dim"]}, not {dim}')
+            self.dim, self.size = meta['dim'], meta['size']
+        else:
+            if dim is None:
+                raise ValueError(f'No store in {folder}, set dim to create new one')
+            os.makedirs(folder, exist_ok=True)
+            self.dim, self.size = dim, 0
+            self._resize(max(size, 1))
+        self._open()
+
+    def _open(self) -> None:
+        self.vectors = np.memmap(f'{self.folder}/vectors.f16', dtype=np.float16, mode='r+',
+                                 shape=(self.size, self.dim))
+        self.present = np.memmap(f'{self.folder}/present.u8', dtype=np.uint8, mode='r+', shape=(self.size, ))
+
+    def _resize(self, size: int) -> None:
+        for name, row_bytes in (('vectors.f16', self.dim * 2), ('present.u8', 1)):
+            with open(f'{self.folder}/{name}', 'ab') as f:
+                f.truncate(size * row_bytes)  # new rows are zeros
+        self.size = size
+        with open(f'{self.folder}/store.json', 'w') as f:
+            json.dump({'dim': self.dim, 'size': size}, f)
+
+    def missing(self, ids: Sequence[int]) -> np.ndarray:
+        """Ids of articles, which have no vectors"""
+        ids = np.asarray(ids, dtype=np.int64)
+        known = ids < self.size
+        known[known] = self.present[ids[known]].astype(bool)
+        return ids[~known]
+
+    def put(self, ids: Sequence[int], vectors: np.ndarray) -> None:
+        """Save vectors of articles ids"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) and ids.max() >= self.size:
+            del self.vectors, self.present
+            self._resize(max(int(ids.max()) + 1, 2 * self.size))
+            self._open()
+        self.vectors[ids] = np.asarray(vectors, dtype=np.float16)
+        self.vectors.flush()
+        self.present[ids] = 1
+        self.present.flush()
+
+    def get(self, ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Vectors of articles (all rows by default), zeros for missing ones"""
+        if ids is None:
+            return self.vectors
+        ids = np.asarray(ids, dtype=np.int64)
+        res = np.zeros((len(ids), self.dim), dtype=np.float16)
+        known = ids < self.size
+        res[known] = self.vectors[ids[known]]
+        return res
+
+
+def project_texts(project: str, data_folder_name: str = 'data', lang: str = 'en',
+                  fetcher: Optional[ExtractsFetcher] = None, n: int = 1000) -> pd.DataFrame:
+    """
+    Introductions of all articles of project, retrieved by batches and saved to stage file title_with_text with
+    checkpoints (see apply_with_interim_saving), so texts are downloaded only once and interrupted download is
+    continued
+    :param project: name of subfolder in data folder
+    :param data_folder_name: name of data folder
+    :param lang: wikipedia language code
+    :param fetcher: ExtractsFetcher(), if None
+    :param n: number of articles between checkpoints
+    :return: DataFrame with columns title, index, text (paragraphs of texts are separated by new lines)
+    """
+    path = data_path(TEXT_STAGE, project, data_folder_name)
+    if exists(path):  # stage file is written when all texts are retrieved
+        return read_stage_file(path)
+    df = read_stage_file(data_path(TEXT_STAGE[:1], project, data_folder_name), dtype=str)
+    df = df.reset_index()[['title', 'index']]
+    return apply_with_interim_saving(df, f=fetcher or ExtractsFetcher(), col_to_apply='title', new_col='text',
+                                     csv_name=path, n=n, one_by_one=False, lang=lang)
+
+
+def _model_folder(model_name: str) -> str:
+    return re.sub(r'[^\w.-]+', '_', model_name)
+
+
+@timing(printed_args=['project', 'model_name'])
+def project_embeddings(project: str, data_folder_name: str = 'data', lang: str = 'en',
+                       model_name: str = DEFAULT_MODEL, model=None, batch_size: int = 64, chunk: int = 1024,
+                       fetcher: Optional[ExtractsFetcher] = None) -> EmbeddingStore:
+    """
+    Encode introductions of articles of project by sentence-transformers model and keep vectors in EmbeddingStore
+    <data_folder_name>/<project>/embeddings/<model_name>. Only articles without vectors are encoded, by chunks, each
+    chunk is saved at once, so next runs (and interrupted ones) don't encode anything twice. Vectors are normalized,
+    so cosine similarity is dot product. Articles without text are encoded by their titles
+    :param project: name of subfolder in data folder
+    :param data_folder_name: name of data folder
+    :param lang: wikipedia language code
+    :param model_name: name of sentence-transformers model
+    :param model: loaded model (with encode method), SentenceTransformer(model_name) if None
+    :param batch_size: batch size of model on CPU
+    :param chunk: number of articles, encoded between saves
+    :param fetcher: fetcher of texts, ExtractsFetcher() if None
+    :return: EmbeddingStore
+    """
+    folder = f'{data_folder_name}/{project}/{EMBEDDINGS_FOLDER}/{_model_folder(model_name)}'
+    texts = project_texts(project, data_folder_name, lang, fetcher)
+    store = EmbeddingStore(folder) if exists(f'{folder}/store.json') else None
+    missing = texts['index'].values if store is None else store.missing(texts['index'].values)
+    if not len(missing):
+        return store
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name, device='cpu')
+    texts = texts.set_index('index')
+    texts = texts['text'].where(texts['text'].fillna('').astype(str).str.len() > 0, texts['title'])
+    print(f'Encoding {len(missing)} articles')
+    for start in range(0, len(missing), chunk):
+        ids = missing[start: start + chunk]
+        vectors = model.encode(texts.loc[ids].astype(str).tolist(), batch_size=batch_size,
+                               normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False)
+        if store is None:
+            store = EmbeddingStore(folder, vectors.shape[1], int(texts.index.max()) + 1)
+        store.put(ids, vectors)
+    return store
+
+
+def blended_similarity(similarity: spmatrix, store: EmbeddingStore, alpha: float = 0.3,
+                       ids: Optional[Sequence[int]] = None, chunk: int = 1_000_000) -> csr_matrix:
+    """
+    Blend category similarity with cosine similarity of text vectors: (1 - alpha) * category + alpha * text. Text
+    similarity is calculated only for pairs, which have non-zero category similarity, so result has the same
+    sparsity. If one of articles has no vector, category similarity is kept
+    :param similarity: sparse category similarity (like CategoryGraph.similarity)
+    :param store: vectors of articles (project_embeddings)
+    :param alpha: weight of text similarity
+    :param ids: article index of each row (and column) of similarity, if rows are not article indexes
+    :param chunk: number of pairs processed at once
+    :return: sparse matrix with blended similarities
+    """
+    similarity = csr_matrix(similarity, dtype=np.float32, copy=True)
+    n = similarity.shape[0]
+    ids = np.arange(n) if ids is None else np.asarray(ids, dtype=np.int64)
+    vectors = store.get(ids)
+    present = np.zeros(n, dtype=bool)
+    present[np.isin(ids, store.missing(ids), invert=True)] = True
+    rows = np.repeat(np.arange(n), np.diff(similarity.indptr))
+    for start in range(0, similarity.nnz, chunk):
+        i, j = rows[start: start + chunk], similarity.indices[start: start + chunk]
+        cosine = np.einsum('ij,ij->i', vectors[i].astype(np.float32), vectors[j].astype(np.float32))
+        data = similarity.data[start: start + chunk]
+        both = present[i] & present[j]
+        data[both] = (1 - alpha) * data[both] + alpha * np.clip(cosine[both], 0, 1)
+    return similarity
+
+
+def project_blended_similarity(project: str, stages_num: int, mults: Optional[Sequence[float]] = None,
+                               alpha: float = 0.3, data_folder_name: str = 'data', lang: str = 'en',
+                               model_name: str = DEFAULT_MODEL, min_similarity: Optional[float] = None,
+                               **kwargs) -> csr_matrix:
+    """
+    Category similarity of project (CategoryGraph.similarity) blended with text similarity of article introductions,
+    both graph and vectors are loaded from project folder if they were saved before
+    :param project: name of subfolder in data folder
+    :param stages_num: number of levels (1 for categories only, 2 for categories and infra1 etc.)
+    :param mults: weight of each level, if None - all weights =1
+    :param alpha: weight of text similarity
+    :param data_folder_name: name of data folder
+    :param lang: wikipedia language code
+    :param model_name: name of sentence-transformers model
+    :param min_similarity: if set, category similarities less than it are removed before blending
+    :param kwargs: other arguments of project_embeddings (model, batch_size, fetcher)
+    :return: sparse matrix with blended similarities, rows are article indexes
+    """
+    graph = project_graph(project, stages_num, data_folder_name, lang)
+    similarity = graph.similarity(mults, stages_num if mults is None else None,
+                                  project_filter(project, lang, data_folder_name), min_similarity)
+    store = project_embeddings(project, data_folder_name, lang, model_name, **kwargs)
+    return blended_similarity(similarity, store, alpha)
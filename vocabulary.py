@@ -0,0 +1,114 @@
+from collections.abc import Iterable, Sequence
+from itertools import chain
+from os.path import exists
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+VOCABULARY_FILE = 'vocabulary.txt'
+PREFIX = 'Category:'
+
+
+def strip_prefix(name: str) -> str:
+    """Remove "Category:" prefix, which is added to category names by regroup_categories"""
+    return name[len(PREFIX):] if name.startswith(PREFIX) else name
+
+
+def flatten_lists(lists: Sequence[Optional[list]], dtype: type = np.int64) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert sequence of lists of ints to CSR form: i-th list is values[offsets[i]:offsets[i + 1]]. Missing lists
+    (None) are treated as empty
+    :param lists: sequence of lists of ints
+    :param dtype: dtype of values
+    :return: offsets (int64) and values arrays
+    """
+    lists = [x if isinstance(x, list) else [] for x in lists]
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lists], out=offsets[1:])
+    return offsets, np.fromiter(chain.from_iterable(lists), dtype=dtype, count=offsets[-1])
+
+
+class CategoryVocabulary:
+    """
+    Dictionary of categories names (without "Category:" prefix) and their int32 ids. Ids are given in order of
+    adding, so vocabulary could be extended at each stage, and old ids remain valid
+    """
+    def __init__(self, names: Optional[Iterable[str]] = None):
+        self.names = []
+        self.ids = {}
+        if names is not None:
+            self.encode(names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def encode(self, names: Iterable[str]) -> np.ndarray:
+        """Get ids of categories (with or without "Category:" prefix), new categories are added to vocabulary"""
+        res = []
+        for name in names:
+            name = strip_prefix(name)
+            category_id = self.ids.get(name)
+            if category_id is None:
+                category_id = self.ids[name] = len(self.names)
+                self.names.append(name)
+            res.append(category_id)
+        return np.array(res, dtype=np.int32)
+
+    def encode_lists(self, lists: Sequence[Optional[list]]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Encode column with lists of categories in CSR form: ids of categories of i-th list are
+        values[offsets[i]:offsets[i + 1]]. Missing lists (None) are treated as empty, lists of ints are treated as
+        already encoded
+        :param lists: sequence of lists of categories names
+        :return: offsets (int64) and values (int32) arrays
+        """
+        lists = [x if isinstance(x, list) else [] for x in lists]
+        first = next((x[0] for x in lists if x), None)
+        if first is None or isinstance(first, (int, np.integer)):
+            return flatten_lists(lists, np.int32)
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in lists], out=offsets[1:])
+        return offsets, self.encode(chain.from_iterable(lists))
+
+    def decode(self, ids: Iterable[int]) -> list[str]:
+        """Get names of categories (without "Category:" prefix) by ids"""
+        return [self.names[i] for i in ids]
+
+    def save(self, path: str) -> None:
+        """Save vocabulary as text file, one name per line (names of Wikipedia pages can't contain new line)"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.names))
+
+    @classmethod
+    def load(cls, path: str) -> 'CategoryVocabulary':
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        return cls(text.split('\n') if text else [])
+
+
+def project_vocabulary(project: str, data_folder_name: str = 'data') -> CategoryVocabulary:
+    """Load vocabulary saved with project, or create empty one"""
+    path = f'{data_folder_name}/{project}/{VOCABULARY_FILE}'
+    return CategoryVocabulary.load(path) if exists(path) else CategoryVocabulary()
+
+
+def update_project_vocabulary(df: pd.DataFrame, cols: Sequence[str], project: str,
+                              data_folder_name: str = 'data') -> CategoryVocabulary:
+    """
+    Add categories from columns of stage DataFrame to vocabulary of project and save it next to stage files
+    :param df: stage DataFrame
+    :param cols: columns with categories (lists of names or single names)
+    :param project: name of subfolder in data folder
+    :param data_folder_name: name of data folder
+    :return: updated vocabulary
+    """
+    vocabulary = project_vocabulary(project, data_folder_name)
+    for col in cols:
+        values = df[col].dropna()
+        if len(values) and isinstance(values.iloc[0], list):
+            vocabulary.encode_lists(values.tolist())
+        else:
+            vocabulary.encode(values.astype(str))
+    vocabulary.save(f'{data_folder_name}/{project}/{VOCABULARY_FILE}')
+    return vocabulary